@@ -13,29 +13,122 @@
 #    See the License for the specific language governing permissions and
 #    limitations under the License.
 
+"""
+Freesurfer color lookup table.
+
+The LUT file is parsed once per process into label ids, names and an RGB
+array; get_lut_array() gives a dense (max id + 1, 3) uint8 array for
+vectorized color mapping. With a cache dir (argument or $FS_LUT_CACHE_DIR)
+the parsed table is also kept as a .npz there and reused as long as the
+LUT file's mtime and size match, which saves the parsing in fresh workers.
+"""
+
 from collections import OrderedDict
 import os
+import hashlib
 
-def remove_values_from_list(the_list, val):
-   return [value for value in the_list if value != val]
+import numpy as np
 
+_lut_cache = {}
 
 
-def get_lut():
+def get_lut_path():
 
     if "FREESURFER_HOME" in os.environ:
-        lookup_table_path = os.path.join(os.environ.get('FREESURFER_HOME'), 'FreeSurferColorLUT.txt')
-    else:
-        lookup_table_path = '/opt/freesurfer/FreeSurferColorLUT.txt'
+        return os.path.join(os.environ.get('FREESURFER_HOME'), 'FreeSurferColorLUT.txt')
+    return '/opt/freesurfer/FreeSurferColorLUT.txt'
+
 
-    lut = OrderedDict()
+def parse_lut(lookup_table_path):
+    """(ids, names, rgb) of a Freesurfer color LUT file"""
+    ids, names, rgb = [], [], []
     with open(lookup_table_path, 'r') as f:
         for line in f:
-            if line[0] == '#' or line[0] == '\n':
-                pass
-            else:
-                clean_line = remove_values_from_list(line.split(' '), '')
-                rgb = [int(clean_line[2]), int(clean_line[3]), int(clean_line[4])]
-                lut[str(clean_line[0])] = rgb
+            clean_line = line.split()
+            if clean_line and not clean_line[0].startswith('#'):
+                ids.append(int(clean_line[0]))
+                names.append(clean_line[1])
+                rgb.append([int(clean_line[2]), int(clean_line[3]), int(clean_line[4])])
+    return (np.array(ids, dtype=np.int64), names,
+            np.array(rgb, dtype=np.uint8).reshape(-1, 3))
+
+
+def _disk_cache_file(cache_dir, lookup_table_path):
+    key = hashlib.sha1(os.path.abspath(lookup_table_path).encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir, 'fs_colorlut_%s.npz' % key)
+
+
+def _read_disk_cache(fname, stamp):
+    try:
+        with np.load(fname) as data:
+            if tuple(data['stamp'].tolist()) != stamp:
+                return None
+            return data['ids'], [str(n) for n in data['names']], data['rgb']
+    except (IOError, OSError, KeyError, ValueError):
+        return None
+
+
+def _write_disk_cache(fname, stamp, lut):
+    ids, names, rgb = lut
+    try:
+        if not os.path.exists(os.path.dirname(fname)):
+            os.makedirs(os.path.dirname(fname))
+        tmp = '%s.%d.tmp' % (fname, os.getpid())
+        with open(tmp, 'wb') as fp:
+            np.savez(fp, stamp=np.array(stamp, dtype=np.int64), ids=ids,
+                     names=np.array(names), rgb=rgb)
+        os.rename(tmp, fname)
+    except (IOError, OSError):
+        #the cache is optional
+        pass
+
+
+def load_lut(lookup_table_path=None, cache_dir=None):
+    """(ids, names, rgb) of a color LUT, parsed once per process and LUT
+    file version"""
+    lookup_table_path = lookup_table_path or get_lut_path()
+    st = os.stat(lookup_table_path)
+    stamp = (int(st.st_mtime * 1e9), st.st_size)
+    key = os.path.abspath(lookup_table_path)
+    cached = _lut_cache.get(key)
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+
+    cache_dir = cache_dir or os.environ.get('FS_LUT_CACHE_DIR')
+    lut = None
+    if cache_dir:
+        fname = _disk_cache_file(cache_dir, lookup_table_path)
+        lut = _read_disk_cache(fname, stamp)
+    if lut is None:
+        lut = parse_lut(lookup_table_path)
+        if cache_dir:
+            _write_disk_cache(fname, stamp, lut)
+    _lut_cache[key] = (stamp, lut)
     return lut
 
+
+def get_lut_array(lookup_table_path=None, cache_dir=None):
+    """Dense (max label id + 1, 3) uint8 RGB array, rows of ids missing in
+    the LUT are black"""
+    lookup_table_path = lookup_table_path or get_lut_path()
+    ids, _, rgb = load_lut(lookup_table_path, cache_dir)
+    key = ('dense', os.path.abspath(lookup_table_path))
+    cached = _lut_cache.get(key)
+    if cached is None or cached[0] is not rgb:
+        dense = np.zeros((int(ids.max()) + 1 if len(ids) else 0, 3), dtype=np.uint8)
+        dense[ids] = rgb
+        dense.flags.writeable = False
+        cached = _lut_cache[key] = (rgb, dense)
+    return cached[1]
+
+
+def get_label_names(lookup_table_path=None):
+    """{label id: structure name} of a Freesurfer color LUT"""
+    ids, names, _ = load_lut(lookup_table_path)
+    return OrderedDict(zip(ids.tolist(), names))
+
+
+def get_lut(lookup_table_path=None):
+    """{str(label id): [r, g, b]} of a Freesurfer color LUT"""
+    ids, _, rgb = load_lut(lookup_table_path)
+    return OrderedDict(zip([str(i) for i in ids.tolist()], rgb.tolist()))
@@ -30,6 +30,9 @@ from .reconall_hsfs import ReconAllHSFS
 from .jsonify_stats import JsonifyStats
 from nipype.interfaces.io import FreeSurferSource    
 from .screenshot import create_mri_screenshots
+from .hsfs_screenshot import create_hsfs_screenshots
+from .qc_metrics import write_qc_metrics
+from .stats_aggregator import write_cohort_stats
 
 def get_full_path(subjectid, data_dir, filepattern):
     
@@ -60,6 +63,22 @@ def get_T2_path_tup(subjectid, data_dir,ID):
         
     return t2filetup
 
+def create_hsfs_qc_node(subjects_dir, analysis_id, name):
+    #zoomed qc snapshots of the subfield labels of one hsfs analysis
+    hsfs_qc = pe.Node(interface=util.Function(input_names=['subject_id','subjects_dir','analysis_id',
+                                                           'num_slices','padd','spacing','nrows',
+                                                           'image_extension'],
+                                              output_names=['hsfs_snapshots'],
+                                              function=create_hsfs_screenshots), name=name)
+    hsfs_qc.inputs.subjects_dir = subjects_dir
+    hsfs_qc.inputs.analysis_id = analysis_id
+    hsfs_qc.inputs.num_slices = 20
+    hsfs_qc.inputs.padd = 8
+    hsfs_qc.inputs.spacing = 3
+    hsfs_qc.inputs.nrows = 2
+    hsfs_qc.inputs.image_extension = 'png'
+    return hsfs_qc
+
 def get_summary_filename(subjectid,subjects_dir):
     
     import os
@@ -69,7 +88,7 @@ def get_summary_filename(subjectid,subjects_dir):
     
 def create_fs_pipeline(scans_dir, subject_ids, work_dir, fs_base_sub_dir, nthreads, reconargs,
                          useT2=False, hsfsT1=False, hsfsT2=False,
-                         hsfsT1T2=False, wfname='fs_pipeline'):
+                         hsfsT1T2=False, wfname='fs_pipeline', cohort_table=False):
    
     awf = pe.Workflow(name=wfname)
     
@@ -122,8 +141,8 @@ def create_fs_pipeline(scans_dir, subject_ids, work_dir, fs_base_sub_dir, nthrea
     jsonify_stats.inputs.subjects_dir = subjectsdir
 
     #qc snapshots
-    qcsnapshots = pe.Node(interface=util.Function(input_names=['path_orig','path_aseg','out_dir','subject_id', 'num_slices','padd','spacing','image_extension'],
-                                                  output_names=['dual_sagittal','dual_axial'],
+    qcsnapshots = pe.Node(interface=util.Function(input_names=['path_orig','path_aseg','out_dir','subject_id', 'num_slices','padd','spacing','image_extension','nrows'],
+                                                  output_names=['dual_sagittal','dual_axial','dual_coronal'],
                                                   function=create_mri_screenshots),name='create_qc_snapshots')
 
     qcsnapshots.inputs.out_dir=subjectsdir
@@ -131,6 +150,15 @@ def create_fs_pipeline(scans_dir, subject_ids, work_dir, fs_base_sub_dir, nthrea
     qcsnapshots.inputs.padd=4
     qcsnapshots.inputs.spacing=3
     qcsnapshots.inputs.image_extension='png'
+    qcsnapshots.inputs.nrows=1
+
+    #quantitative qc metrics, parsed into the stats json and the cohort table
+    qcmetrics = pe.Node(interface=util.Function(input_names=['subject_id','subjects_dir'],
+                                                output_names=['qc_metrics_file'],
+                                                function=write_qc_metrics),name='create_qc_metrics')
+    qcmetrics.inputs.subjects_dir=subjectsdir
+    awf.connect(reconall, 'subject_id', qcmetrics, 'subject_id')
+    awf.connect(qcmetrics, 'qc_metrics_file', jsonify_stats, 'qc_metrics_file')
 
 
     if hsfsT1 or hsfsT2 or hsfsT1T2:
@@ -156,6 +184,9 @@ def create_fs_pipeline(scans_dir, subject_ids, work_dir, fs_base_sub_dir, nthrea
                     segstats, 'summary_file')
         awf.connect(reconall_hsfsT1, 'subject_id',    jsonify_stats, 'subject_id')
         awf.connect(segstats,        'summary_file',  jsonify_stats, 'segstats_file')
+
+        hsfs_qcT1 = create_hsfs_qc_node(subjectsdir, 'T1', 'create_hsfs_qc_snapshotsT1')
+        awf.connect(reconall_hsfsT1, 'subject_id', hsfs_qcT1, 'subject_id')
         
     if hsfsT2:
         reconall_hsfsT2 = pe.Node(interface=ReconAllHSFS(), name='reconall_hsfsT2')
@@ -180,6 +211,9 @@ def create_fs_pipeline(scans_dir, subject_ids, work_dir, fs_base_sub_dir, nthrea
                     segstats, 'summary_file')        
         awf.connect(reconall_hsfsT2, 'subject_id',    jsonify_stats, 'subject_id')
         awf.connect(segstats,        'summary_file',  jsonify_stats, 'segstats_file')
+
+        hsfs_qcT2 = create_hsfs_qc_node(subjectsdir, 'T2', 'create_hsfs_qc_snapshotsT2')
+        awf.connect(reconall_hsfsT2, 'subject_id', hsfs_qcT2, 'subject_id')
         
     if hsfsT1T2:
        reconall_hsfsT1T2 = pe.Node(interface=ReconAllHSFS(), name='reconall_hsfsT1T2')
@@ -203,6 +237,9 @@ def create_fs_pipeline(scans_dir, subject_ids, work_dir, fs_base_sub_dir, nthrea
                     segstats, 'summary_file')       
        awf.connect(reconall_hsfsT1T2, 'subject_id',    jsonify_stats, 'subject_id')
        awf.connect(segstats,          'summary_file',  jsonify_stats, 'segstats_file')
+
+       hsfs_qcT1T2 = create_hsfs_qc_node(subjectsdir, 'T1-T1T2', 'create_hsfs_qc_snapshotsT1T2')
+       awf.connect(reconall_hsfsT1T2, 'subject_id', hsfs_qcT1T2, 'subject_id')
     
     #wf order change if hsfs done/not done
     if not hsfsT1 and not hsfsT2 and not hsfsT1T2:
@@ -216,7 +253,23 @@ def create_fs_pipeline(scans_dir, subject_ids, work_dir, fs_base_sub_dir, nthrea
                     segstats, 'summary_file')            
         awf.connect(reconall, 'subject_id',    jsonify_stats, 'subject_id')
         awf.connect(segstats, 'summary_file',  jsonify_stats, 'segstats_file')
-        
+
+    #cohort table of all subjects of this run, from the measures jsonify_stats already parsed
+    if cohort_table:
+        cohort_stats = pe.JoinNode(interface=util.Function(input_names=['compact_stats','subjects_dir','out_prefix',
+                                                                        'parse_hsfs','selection','batch_size'],
+                                                           output_names=['cohort_files'],
+                                                           function=write_cohort_stats),
+                                   joinsource='inputnode', joinfield=['compact_stats'],
+                                   name='cohort_stats')
+        cohort_stats.inputs.subjects_dir = subjectsdir
+        #run specific prefix, the cohort_stats table of aggregate_fs_stats covers all subjects
+        cohort_stats.inputs.out_prefix = os.path.join(subjectsdir, 'cohort_stats_%s' % wfname)
+        cohort_stats.inputs.parse_hsfs = hsfsT1 or hsfsT2 or hsfsT1T2
+        cohort_stats.inputs.batch_size = 256
+        jsonify_stats.inputs.compact_output = True
+
+        awf.connect(jsonify_stats, 'compact_stats', cohort_stats, 'compact_stats')
     
     return awf
     
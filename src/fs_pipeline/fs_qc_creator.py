@@ -37,7 +37,7 @@ def get_path(subjectid, output_dir, filepattern):
     return full_path
 
     
-def create_qc_wf(output_dir, subject_ids, work_dir, name="fs_qc_snapshot"):
+def create_qc_wf(output_dir, subject_ids, work_dir, name="fs_qc_snapshot", image_extension='png'):
    
     cwf = pe.Workflow(name=name)
     
@@ -50,15 +50,16 @@ def create_qc_wf(output_dir, subject_ids, work_dir, name="fs_qc_snapshot"):
             
 
     #qc snapshots
-    qcsnapshots = pe.Node(interface=util.Function(input_names=['path_orig','path_aseg','out_dir','subject_id', 'num_slices','padd','spacing','image_extension'],
-                                                  output_names=['dual_sagittal','dual_axial'],
+    qcsnapshots = pe.Node(interface=util.Function(input_names=['path_orig','path_aseg','out_dir','subject_id', 'num_slices','padd','spacing','image_extension','nrows'],
+                                                  output_names=['dual_sagittal','dual_axial','dual_coronal'],
                                                   function=create_mri_screenshots),name='create_qc_snapshots')
 
     qcsnapshots.inputs.out_dir=output_dir
     qcsnapshots.inputs.num_slices=60
     qcsnapshots.inputs.padd=4
     qcsnapshots.inputs.spacing=3
-    qcsnapshots.inputs.image_extension='png'
+    qcsnapshots.inputs.image_extension=image_extension
+    qcsnapshots.inputs.nrows=1
 
 
     cwf.connect(inputnode, 'subject_ids', qcsnapshots, 'subject_id')
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2023 Population Health Sciences, German Center for Neurodegenerative Diseases (DZNE)
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+Zoomed coronal QC montages of the hippocampal subfield segmentations.
+
+The high resolution mri/?h.hippoSfLabels-<analysis>.v??.mgz volumes are
+cropped to their label bounding box (scanned in slabs through the array
+proxy), and the T1 (mri/norm.mgz) and, for T2 analyses, the registered
+additional scan (mri/<ID>.FSspace.mgz) are sampled on the montage slices of
+that grid only, reading just the region they cover. The rendering is the one
+of the whole brain snapshots: gray mosaics above the label overlay, with the
+subfield colors of the Freesurfer LUT.
+"""
+
+import os
+import re
+from os.path import join, exists
+
+import numpy as np
+
+HSFS_LABELS_RE = re.compile(r'^(lh|rh)\.hippoSfLabels-([^.]+)\.v\d+\.mgz$')
+
+
+def hsfs_label_files(subject_dir, analysis_id=None):
+    """[(hemi, analysis id, path)] of the subfield label volumes in mri/,
+    only those of analysis_id if given (T1, <ID> or T1-<ID>)"""
+    mri = join(subject_dir, 'mri')
+    found = []
+    for fname in sorted(os.listdir(mri)) if exists(mri) else []:
+        match = HSFS_LABELS_RE.match(fname)
+        if match and analysis_id in (None, match.group(2)):
+            found.append((match.group(1), match.group(2), join(mri, fname)))
+    return found
+
+
+def hsfs_intensity_files(subject_dir, analysis_id):
+    """T1 and registered additional scan shown with the labels of an analysis"""
+    mri = join(subject_dir, 'mri')
+    files = []
+    if analysis_id == 'T1' or analysis_id.startswith('T1-'):
+        files.append(join(mri, 'norm.mgz'))
+    if analysis_id != 'T1':
+        files.append(join(mri, '%s.FSspace.mgz' % analysis_id.split('-', 1)[-1]))
+    return [f for f in files if exists(f)]
+
+
+def coronal_frame(affine, start, shape):
+    """
+    Voxel axes of a cropped volume ordered as (row, column, slice) of
+    coronal views, superior up and left on the right like the whole brain
+    snapshots
+
+    :return
+        (axes, flips, 4x4 matrix from (row, column, slice) indices to voxel
+        indices of the full volume)
+    """
+    import nibabel as nib
+
+    codes = nib.aff2axcodes(affine)
+    axes = [[a for a, c in enumerate(codes) if c in pair][0] for pair in ('SI', 'LR', 'AP')]
+    flips = [codes[axes[0]] == 'S', codes[axes[1]] == 'R', False]
+    frame = np.eye(4)
+    frame[:3, :3] = 0
+    for d, (a, flip) in enumerate(zip(axes, flips)):
+        frame[a, d] = -1 if flip else 1
+        frame[a, 3] = start[a] + (shape[a] - 1 if flip else 0)
+    return axes, flips, frame
+
+
+def resample_region(img, affine, points):
+    """Trilinear values of img at (3, ...) points given in the voxel space
+    of affine, reading only the region of img they cover"""
+    from scipy import ndimage
+
+    vox = np.linalg.inv(img.affine).dot(affine)
+    coords = np.tensordot(vox[:3, :3], points, axes=1) + \
+        vox[:3, 3].reshape((3,) + (1,) * (points.ndim - 1))
+    flat = coords.reshape(3, -1)
+    lo = np.maximum(np.floor(flat.min(axis=1)).astype(int) - 1, 0)
+    hi = np.minimum(np.ceil(flat.max(axis=1)).astype(int) + 2, img.shape[:3])
+    if np.any(hi <= lo):
+        return np.zeros(points.shape[1:], dtype=np.float32)
+    region = np.asarray(img.dataobj[lo[0]:hi[0], lo[1]:hi[1], lo[2]:hi[2]], dtype=np.float32)
+    return ndimage.map_coordinates(region, coords - lo.reshape((3,) + (1,) * (points.ndim - 1)),
+                                   order=1, cval=0)
+
+
+def hsfs_montage(path_labels, intensity_files=(), num_slices=20, padd=8, spacing=3, nrows=2):
+    """
+    RGBA montage of the coronal slices of a subfield label volume: a gray
+    row for each intensity file, then the labels over the first one (or the
+    labels alone without intensity files)
+    """
+    import nibabel as nib
+    from .screenshot import (scan_label_volume, relabel_consecutive, label_colormap,
+                             render_slices_grid, render_slices_overlay, _roundtrip_table)
+
+    labels_img = nib.load(path_labels)
+    shape = labels_img.shape[:3]
+    _, extent = scan_label_volume(labels_img.dataobj)
+    start = [max(lo - padd, 0) for lo, _ in extent]
+    stop = [min(hi + padd + 1, n) for (_, hi), n in zip(extent, shape)]
+    crop = np.asanyarray(labels_img.dataobj[start[0]:stop[0], start[1]:stop[1],
+                                            start[2]:stop[2]])
+
+    axes, flips, frame = coronal_frame(labels_img.affine, start, crop.shape)
+    view = np.transpose(crop, axes)[::-1 if flips[0] else 1, ::-1 if flips[1] else 1]
+    lo, hi = extent[axes[2]][0] - start[axes[2]], extent[axes[2]][1] - start[axes[2]]
+    slice_idx = np.unique(np.round(np.linspace(lo, hi, num_slices)).astype(int))
+
+    labels, mapped = relabel_consecutive(view[:, :, slice_idx])
+    cmap = label_colormap(labels)
+    img_labels = render_slices_grid([mapped[:, :, k] for k in range(len(slice_idx))], cmap,
+                                    order=0, label_map=True, nrows=nrows, spacing=spacing)
+
+    rows, cols = view.shape[:2]
+    points = np.array(np.meshgrid(np.arange(rows), np.arange(cols), slice_idx, indexing='ij'),
+                      dtype=np.float64)
+    affine = labels_img.affine.dot(frame)
+    grays = []
+    for fname in intensity_files:
+        values = resample_region(nib.load(fname), affine, points)
+        grays.append(render_slices_grid([values[:, :, k] for k in range(len(slice_idx))],
+                                        "gray", order=3, nrows=nrows, spacing=spacing))
+    if not grays:
+        return img_labels
+    return _roundtrip_table('decode')[np.concatenate(grays + [render_slices_overlay(grays[0],
+                                                                                    img_labels)])]
+
+
+def create_hsfs_screenshots(subject_id, subjects_dir, analysis_id=None, num_slices=20, padd=8,
+                            spacing=3, nrows=2, image_extension='png'):
+    '''
+    Function to create zoomed coronal screenshots of the hippocampal subfield
+    segmentations of a subject, qcsnapshots/img_hsfs_<hemi>_<analysis>.<ext>
+
+    :arg
+        subject_id : subject id in subjects_dir
+        subjects_dir : freesurfer subjects dir
+        analysis_id : only the label volumes of this analysis (T1, <ID> or T1-<ID>), all by default
+        num_slices(int) : number of coronal slices of each hemisphere (default : 20)
+        padd(int) : voxels around the label bounding box (default : 8)
+        spacing(int) : spacing between the slices (default : 3)
+        nrows(int) : number of rows of the slice grid (default : 2)
+        image_extension(str) : image encoder, see fs_pipeline.image_encoders (default : png)
+
+    :return
+        paths of the written images
+    '''
+    import os
+    from fs_pipeline.hsfs_screenshot import (hsfs_label_files, hsfs_intensity_files,
+                                             hsfs_montage)
+    from fs_pipeline.image_encoders import encode_image, encoder_extension
+
+    subject_dir = os.path.join(subjects_dir, subject_id)
+    out_dir = os.path.join(subject_dir, 'qcsnapshots')
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    written = []
+    for hemi, analysis, path_labels in hsfs_label_files(subject_dir, analysis_id):
+        montage = hsfs_montage(path_labels, hsfs_intensity_files(subject_dir, analysis),
+                               num_slices, padd, spacing, nrows)
+        out_file = os.path.join(out_dir, 'img_hsfs_%s_%s.%s'
+                                % (hemi, analysis, encoder_extension(image_extension)))
+        written.append(encode_image(montage, out_file, image_extension))
+    return written
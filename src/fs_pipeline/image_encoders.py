@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2023 Population Health Sciences, German Center for Neurodegenerative Diseases (DZNE)
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+Image encoders of the QC snapshots.
+
+The rendered RGBA mosaics are written with Pillow directly, with one of the
+presets in ENCODERS (format, save options and whether the image is reduced
+to a 256 color palette first). 'png' matches what mpimg.imsave wrote; the
+plain extensions 'jpg' and 'jpeg' are accepted as before.
+"""
+
+import os
+import time
+
+# name: (file extension, Pillow format, save options, palette)
+ENCODERS = {
+    'png': ('png', 'PNG', {'compress_level': 6}, False),
+    'png-fast': ('png', 'PNG', {'compress_level': 1}, False),
+    'png-small': ('png', 'PNG', {'compress_level': 9}, False),
+    'png-palette': ('png', 'PNG', {'compress_level': 6}, True),
+    'jpeg': ('jpeg', 'JPEG', {'quality': 90}, False),
+    'jpg': ('jpg', 'JPEG', {'quality': 90}, False),
+    'jpeg-small': ('jpeg', 'JPEG', {'quality': 75}, False),
+    'webp': ('webp', 'WEBP', {'quality': 90, 'method': 4}, False),
+    'webp-fast': ('webp', 'WEBP', {'quality': 80, 'method': 0}, False),
+    'webp-lossless': ('webp', 'WEBP', {'lossless': True, 'quality': 0, 'method': 0}, False),
+}
+
+
+def _encoder(name):
+    try:
+        return ENCODERS[name]
+    except KeyError:
+        raise ValueError("Unknown image encoder %s, use one of %s"
+                         % (name, ', '.join(sorted(ENCODERS))))
+
+
+def encoder_extension(name):
+    """File extension of the images of an encoder"""
+    return _encoder(name)[0]
+
+
+def encode_image(rgba, out_file, encoder='png'):
+    """Write an (h, w, 4) uint8 image atomically with an encoder preset
+
+    :return
+        out_file
+    """
+    from PIL import Image
+
+    _, fmt, options, palette = _encoder(encoder)
+    img = Image.fromarray(rgba, 'RGBA')
+    if palette:
+        img = img.convert('RGB').quantize(256, method=Image.FASTOCTREE)
+    elif fmt == 'JPEG' or (fmt == 'WEBP' and (rgba[..., 3] == 255).all()):
+        img = img.convert('RGB')
+    tmp = out_file + '.tmp'
+    img.save(tmp, format=fmt, **options)
+    os.rename(tmp, out_file)
+    return out_file
+
+
+def benchmark_encoders(images, out_dir, encoders=None):
+    """Encode images, a list of (name, rgba), with every encoder
+
+    :return
+        {encoder: (total bytes, total milliseconds)}
+    """
+    results = {}
+    # jpg only differs from jpeg by its extension
+    for encoder in encoders or sorted(e for e in ENCODERS if e != 'jpg'):
+        size = 0
+        start = time.time()
+        for name, rgba in images:
+            out_file = os.path.join(out_dir, '%s.%s' % (name, encoder_extension(encoder)))
+            size += os.path.getsize(encode_image(rgba, out_file, encoder))
+            os.remove(out_file)
+        results[encoder] = (size, 1000 * (time.time() - start))
+    return results
@@ -20,11 +20,12 @@ Created on Mon Jul 17 12:56:06 2017
 @author: shahidm
 """
 
-from .parse_stats import Subject
+from .parse_stats import Subject, StatsSelection
 from .parse_hsfs_stats import HSFSSubject
+from .stats_binary import write_stats_binary, get_stats_binary, compact_measures
 
 from nipype.interfaces.base import BaseInterface, \
-    BaseInterfaceInputSpec, traits, Directory, File, TraitedSpec
+    BaseInterfaceInputSpec, traits, Directory, File, TraitedSpec, isdefined
 from nipype.utils.filemanip import copyfile
 import os
 import json
@@ -35,9 +36,26 @@ class JsonifyStatsInputSpec(BaseInterfaceInputSpec):
     subject_id = traits.String(desc='Subject ID', mandatory=True)
     parse_hsfs = traits.Bool(desc='if true, parse ?h.hippoSFVolumes-ID.txt file(s)', default=False)
     segstats_file = traits.File(exists=True,desc='SegStats file')
+    qc_metrics_file = traits.File(exists=True, desc='qcmetrics.stats file (see qc_metrics), '
+                                  'it is parsed with the other stats files')
+    selection = traits.List(traits.Str, desc='only extract the measures matching these '
+                            'file:structure[:measure] patterns (see StatsSelection), '
+                            'all measures if not set')
+    output_format = traits.Enum('json', 'binary', 'both', usedefault=True,
+                                desc='write <subject>_stats.json, the compact <subject>_stats.npz '
+                                '(see stats_binary) or both')
+    binary_dtype = traits.Enum('float64', 'float32', usedefault=True,
+                               desc='value type of the binary stats')
+    compact_output = traits.Bool(False, usedefault=True,
+                                 desc='also output compact_stats, e.g. for a cohort table JoinNode '
+                                 '(stores the column dictionary in subjects_dir)')
 
 class JsonifyStatsOutputSpec(TraitedSpec):
     json_file = File(exists=True, desc="output json file")
+    binary_file = File(exists=True, desc="output binary stats file")
+    compact_stats = traits.Any(desc="(subject_id, columns hash, float64 values) of the measures "
+                               "with compact_output, the column dictionary is stored in "
+                               "subjects_dir (see stats_binary)")
 
 
 class JsonifyStats(BaseInterface):
@@ -52,14 +70,24 @@ class JsonifyStats(BaseInterface):
         #copyfile(self.inputs.segstats_file, new_segstats_filename, copy=True, hashmethod='content')
 
         fname = os.path.join(statsdir, self.inputs.subject_id + '_stats.json')
-        subject = Subject(self.inputs.subjects_dir, self.inputs.subject_id)
+        selection = None
+        if isdefined(self.inputs.selection) and self.inputs.selection:
+            selection = StatsSelection(self.inputs.selection)
+        subject = Subject(self.inputs.subjects_dir, self.inputs.subject_id, selection)
         outdict = subject.get_measures_dict()
         if self.inputs.parse_hsfs==True:
-            hsfs_subject = HSFSSubject(self.inputs.subjects_dir, self.inputs.subject_id)
+            hsfs_subject = HSFSSubject(self.inputs.subjects_dir, self.inputs.subject_id, selection)
             hsfs_dict = hsfs_subject.get_measures_dict()
             outdict.update(hsfs_dict)
-        with open(fname, 'w') as fp:
-            json.dump(outdict, fp)
+        if self.inputs.output_format in ('json', 'both'):
+            with open(fname, 'w') as fp:
+                json.dump(outdict, fp)
+        if self.inputs.output_format in ('binary', 'both'):
+            write_stats_binary(self.inputs.subjects_dir, self.inputs.subject_id, outdict,
+                               dtype=self.inputs.binary_dtype)
+        if self.inputs.compact_output:
+            chash, values = compact_measures(self.inputs.subjects_dir, outdict)
+            self._compact_stats = (self.inputs.subject_id, chash, values)
         
         return runtime
 
@@ -67,7 +95,13 @@ class JsonifyStats(BaseInterface):
         
         outputs = self._outputs().get()
         fname = os.path.join(self.inputs.subjects_dir, self.inputs.subject_id, 'stats', self.inputs.subject_id + '_stats.json')
-        outputs["json_file"] = os.path.abspath(fname)
+        if self.inputs.output_format in ('json', 'both'):
+            outputs["json_file"] = os.path.abspath(fname)
+        if self.inputs.output_format in ('binary', 'both'):
+            outputs["binary_file"] = os.path.abspath(get_stats_binary(self.inputs.subjects_dir,
+                                                                      self.inputs.subject_id))
+        if hasattr(self, '_compact_stats'):
+            outputs["compact_stats"] = self._compact_stats
         
         return outputs
 
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2023 Population Health Sciences, German Center for Neurodegenerative Diseases (DZNE)
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+Drop-in for the nipype SegStats node of the pipeline that runs the
+segstats engine in process instead of starting mri_segstats.
+"""
+
+from .segstats import segstats
+from .fs_colorlut import get_label_names
+
+from nipype.interfaces.base import BaseInterface, \
+    BaseInterfaceInputSpec, traits, File, TraitedSpec, isdefined
+import os
+
+
+class NativeSegStatsInputSpec(BaseInterfaceInputSpec):
+    segmentation_file = File(exists=True, desc='segmentation volume, e.g. aseg.mgz', mandatory=True)
+    segment_id = traits.List(traits.Either(traits.Int, traits.Str), mandatory=True,
+                             desc='label ids to report')
+    partial_volume_file = File(exists=True, desc='intensity volume for the partial volume '
+                               'correction of the volumes, e.g. norm.mgz')
+    in_file = File(exists=True, desc='intensity volume for the Mean/StdDev/Min/Max/Range columns')
+    in_intensity_name = traits.Str('', usedefault=True, desc='prefix of the intensity columns')
+    summary_file = File(desc='output summary file', mandatory=True)
+    color_table_file = File(exists=True, desc='color table for the structure names, '
+                            'FreeSurferColorLUT.txt if not set')
+    default_color_table = traits.Bool(desc='use FreeSurferColorLUT.txt (the default)')
+
+
+class NativeSegStatsOutputSpec(TraitedSpec):
+    summary_file = File(exists=True, desc="output summary file")
+
+
+class NativeSegStats(BaseInterface):
+    input_spec = NativeSegStatsInputSpec
+    output_spec = NativeSegStatsOutputSpec
+
+    def _run_interface(self, runtime):
+
+        color_table = None
+        if isdefined(self.inputs.color_table_file):
+            color_table = self.inputs.color_table_file
+        try:
+            names = get_label_names(color_table)
+        except IOError:
+            names = {}
+
+        segstats(self.inputs.segmentation_file,
+                 self.inputs.segment_id,
+                 os.path.abspath(self.inputs.summary_file),
+                 partial_volume_file=self.inputs.partial_volume_file if isdefined(self.inputs.partial_volume_file) else None,
+                 in_file=self.inputs.in_file if isdefined(self.inputs.in_file) else None,
+                 names=names,
+                 intensity_name=self.inputs.in_intensity_name)
+
+        return runtime
+
+    def _list_outputs(self):
+
+        outputs = self._outputs().get()
+        outputs["summary_file"] = os.path.abspath(self.inputs.summary_file)
+
+        return outputs
@@ -22,49 +22,63 @@ Created on Mon Jul 17 12:56:06 2017
 
 
 import os
+import numpy as np
 from os.path import isdir, join, basename
 
+from .parse_stats import StatsTable, StatsSelection
+from .subject_index import get_subject_index, HSFS
 
 
 class HSFSSubject(object):
-    def __init__(self, subjects_dir, name):
+    def __init__(self, subjects_dir, name, selection=None):
 
         self.name = name
+        self.subjects_dir = subjects_dir
         self.mri_dir = join(subjects_dir, name, 'mri')
+        self.selection = StatsSelection.create(selection)
 
         if not isdir(self.mri_dir):
             raise ValueError("Not a subject directory or this subject doesn't have an 'mri' dir")
 
-    def get_measures(self):
-        measures = []
+    def get_tables(self):
+        tables = []
         id=''
         hemi=''
-        for root, d, fnames in os.walk(self.mri_dir):
-            for fname in fnames:
-                fullname = join(root, fname)
-                if 'hippoSfVolumes' in fname:
-                    if 'rh.' in fname:
-                        id='_'.join(fname.split('.')[1].split('-')[1:])
-                        hemi='rh'
-                    if 'lh.' in fname:
-                        id='_'.join(fname.split('.')[1].split('-')[1:])
-                        hemi='lh'
-                    p = HSFSParser(fullname, hemi,id)
-                    measures.extend(p.measures)
+        for fullname in get_subject_index(self.subjects_dir, self.name).files(HSFS):
+            fname = basename(fullname)
+            if 'rh.' in fname:
+                id='_'.join(fname.split('.')[1].split('-')[1:])
+                hemi='rh'
+            if 'lh.' in fname:
+                id='_'.join(fname.split('.')[1].split('-')[1:])
+                hemi='lh'
+            rules = None
+            if self.selection is not None:
+                #selected by file name without extension, e.g. lh.hippoSfVolumes-T1.v10
+                rules = self.selection.rules_for(os.path.splitext(fname)[0])
+                if not rules:
+                    continue
+            p = HSFSParser(fullname, hemi,id, rules)
+            tables.append(p.table)
+        self.tables = tables
+        return tables
+
+    def get_measures(self):
+        if not hasattr(self, 'tables'):
+            self.get_tables()
+        measures = []
+        for table in self.tables:
+            hemi, id = table.hemi, table.id
+            for i, meas in enumerate(table.structures):
+                measures.append(HSFSMeasure(meas, table.data[0, i], hemi, id))
         self.measures = measures
 
     def get_measures_dict(self):
-        if not hasattr(self, 'measures'):
-            self.get_measures()
+        if not hasattr(self, 'tables'):
+            self.get_tables()
         data = {}
-        for m in self.measures:
-            mclass = m.name().split('_')[0]
-            mname = '_'.join(m.name().split('_')[1:])
-            if mclass in data:
-                data[mclass].update({mname:m.value_as_float()})
-            else:
-                data[mclass] = {mname:m.value_as_float()}
-            #data[m.name()] = m.value_as_str()
+        for table in self.tables:
+            table.update_dict(data)
         return data
         
 
@@ -101,29 +115,41 @@ class HSFSMeasure(object):
 
 class HSFSParser(object):
 
-    def __init__(self, fname,hemi,id):
+    def __init__(self, fname,hemi,id, rules=None):
         self.type = basename(fname)
         self.hemi=hemi
         self.id = id
+        self.rules = rules
         with open(fname) as f:
-            self.raw = map(lambda x: x.strip(), f.read().splitlines())
+            self.raw = [x.strip() for x in f.read().splitlines()]
         
-        self.measures = self.parse(self.raw)
+        self.table = self.parse(self.raw)
         
 
     def __repr__(self):
         return "<Parser(%s)>" % self.type
 
+    @property
+    def measures(self):
+        return [HSFSMeasure(meas, self.table.data[0, i], self.hemi, self.id)
+                for i, meas in enumerate(self.table.structures)]
         
     def parse(self,raw):
         measure_lines = raw #filter(lambda x: x.startswith('# Measure'), raw)
-        measures = []
+        names = []
+        values = []
         for ml in measure_lines:
-            splat = ml.split()
-            pieces = map(lambda x: x.strip(), splat)
-            meas, val = pieces
-            meas = meas.replace('-', '_')
-            m = HSFSMeasure(meas, val,self.hemi,self.id)
-            measures.append(m)
-        
-        return measures
+            meas, val = ml.split()
+            if self.rules is not None and not StatsSelection.match(self.rules, [meas], '')[0]:
+                continue
+            names.append(meas.replace('-', '_').lower())
+            values.append(val)
+
+        # one 'structure' per subfield and a single unnamed volume column,
+        # so that the measure names come out as hippoSF_<id>_<hemi>_<subfield>
+        table = StatsTable('hippoSF_%s_%s' % (self.id.replace('-', '_'), self.hemi),
+                           structures=names, columns=[''],
+                           data=np.array([values], dtype=np.float64).reshape(1, -1))
+        table.hemi = self.hemi
+        table.id = self.id
+        return table
@@ -15,44 +15,181 @@ url='http://github.com/sburns/recon-stats'
 
 
 import os
+import re
+import fnmatch
 from os.path import isdir, join, basename
+from collections import OrderedDict
 
+import numpy as np
+
+from .subject_index import get_subject_index, STATS
 
 
 class Subject(object):
-    def __init__(self, subjects_dir, name):
+    def __init__(self, subjects_dir, name, selection=None):
 
         self.name = name
+        self.subjects_dir = subjects_dir
         self.stat_dir = join(subjects_dir, name, 'stats')
+        self.selection = StatsSelection.create(selection)
 
         if not isdir(self.stat_dir):
             raise ValueError("Not a subject directory or this subject doesn't have a 'stats' dir")
 
+    def get_tables(self):
+        tables = []
+        for fullname in get_subject_index(self.subjects_dir, self.name).files(STATS):
+            #print "parsing ",fullname
+            if Parser.can_parse(fullname, self.selection):
+                p = Parser(fullname, self.selection)
+                tables.append(p.table)
+        self.tables = tables
+        return tables
+
     def get_measures(self):
+        if not hasattr(self, 'tables'):
+            self.get_tables()
         measures = []
-        for root, d, fnames in os.walk(self.stat_dir):
-            for fname in fnames:
-                fullname = join(root, fname)
-                #print "parsing ",fullname
-                if Parser.can_parse(fullname):
-                    p = Parser(fullname)
-                    measures.extend(p.measures)
+        for table in self.tables:
+            measures.extend(table.iter_measures())
         self.measures = measures
 
     def get_measures_dict(self):
-        if not hasattr(self, 'measures'):
-            self.get_measures()
+        if not hasattr(self, 'tables'):
+            self.get_tables()
         data = {}
-        for m in self.measures:
-            mclass = m.name().split('_')[0]
-            mname = '_'.join(m.name().split('_')[1:])
-            if mclass in data:
-                data[mclass].update({mname:m.value_as_float()})
-            else:
-                data[mclass] = {mname:m.value_as_float()}
-            #data[m.name()] = m.value_as_str()
+        for table in self.tables:
+            table.update_dict(data)
         return data
-        
+
+
+class StatsSelection(object):
+    """A list of 'file:structure[:measure]' patterns, compiled once.
+
+    The parts are case insensitive shell patterns matched against the stats
+    file name without extension (e.g. 'lh.aparc.DKTatlas', 'aseg'), the
+    structure or header measure name as written in the file (e.g.
+    'Left-Hippocampus', 'eTIV') and the table column (e.g. 'Volume_mm3').
+    Header measures have an empty column, so 'aseg:eTIV' selects eTIV and
+    'aseg:Left-Hippocampus:Volume_mm3' a single table cell. Structure and
+    measure default to '*'.
+    """
+    def __init__(self, patterns):
+        self.patterns = list(patterns)
+        self.rules = []
+        for pattern in self.patterns:
+            pieces = pattern.split(':')
+            if not 1 <= len(pieces) <= 3 or not pieces[0]:
+                raise ValueError("Invalid stats selection pattern %s, expected file:structure[:measure]" % pattern)
+            pieces += ['*'] * (3 - len(pieces))
+            self.rules.append(tuple(re.compile(fnmatch.translate(p or '*'), re.IGNORECASE)
+                                    for p in pieces))
+
+    def __repr__(self):
+        return "<StatsSelection(%s)>" % ', '.join(self.patterns)
+
+    @classmethod
+    def create(cls, selection):
+        if selection is None or isinstance(selection, cls):
+            return selection
+        return cls(selection)
+
+    @classmethod
+    def from_topvars(cls):
+        """The curated header measures of Parser.topVars"""
+        return cls(['%s:%s' % (fname, meas) for fname in sorted(Parser.topVars)
+                    for meas in Parser.topVars[fname]])
+
+    def rules_for(self, statsfilename):
+        """(structure, measure) patterns that apply to a stats file"""
+        return [(struct, meas) for fname, struct, meas in self.rules
+                if fname.match(statsfilename)]
+
+    @staticmethod
+    def match(rules, names, column):
+        """Boolean mask of the names selected for column by rules"""
+        rules = [struct for struct, meas in rules if meas.match(column)]
+        return np.array([any(struct.match(n) or struct.match(n.replace('-', '_')) for struct in rules)
+                         for n in names], dtype=bool)
+
+
+class StatsTable(object):
+    """Columnar storage for all measures of a single stats file.
+
+    The header measures are kept as scalars, the table part as one array of
+    structure names and one float64 array per measure column (the rows of
+    ``data``). Measure names and the nested dict are only built on request.
+    An optional boolean ``mask`` of the shape of ``data`` restricts the table
+    to the selected cells.
+    """
+    def __init__(self, statsfilename, header=None, structures=(), columns=(),
+                 data=None, units=None, mask=None):
+        self.statsfilename = statsfilename
+        self.sfn = statsfilename.replace('rh.','').replace('lh.','')
+        self.header = header if header is not None else OrderedDict()
+        self.structures = np.array(structures, dtype=str)
+        self.columns = list(columns)
+        if data is None:
+            data = np.zeros((len(self.columns), len(self.structures)))
+        self.data = np.asarray(data, dtype=np.float64)
+        self.units = units if units is not None else {}
+        self.mask = mask
+
+        #the measure class is everything before the first '_' of the full
+        #measure name, which may already cut into the stats file name
+        splat = self.sfn.split('_', 1)
+        self.mclass = splat[0]
+        self._prefix = splat[1] + '_' if len(splat) > 1 else ''
+
+    def __repr__(self):
+        return "<StatsTable(%s)[%d x %d]>" % \
+            (self.statsfilename, len(self.structures), len(self.columns))
+
+    def __len__(self):
+        if self.mask is not None:
+            return len(self.header) + int(self.mask.sum())
+        return len(self.header) + self.data.size
+
+    def column(self, name):
+        return self.data[self.columns.index(name)]
+
+    def mnames(self):
+        names = [self._prefix + h for h in self.header]
+        for i, struct in enumerate(self.structures):
+            prefix = self._prefix + struct
+            names.extend([prefix + '_' + col if col else prefix
+                          for j, col in enumerate(self.columns)
+                          if self.mask is None or self.mask[j, i]])
+        return names
+
+    def keys(self):
+        return [(self.mclass, mname) for mname in self.mnames()]
+
+    def values(self):
+        header = np.fromiter(self.header.values(), dtype=np.float64,
+                             count=len(self.header))
+        if self.mask is not None:
+            return np.concatenate((header, self.data.T[self.mask.T]))
+        return np.concatenate((header, self.data.T.ravel()))
+
+    def update_dict(self, data):
+        if not len(self):
+            return data
+        values = self.values()
+        values[np.isnan(values)] = 0.0
+        data.setdefault(self.mclass, {}).update(zip(self.mnames(), values.tolist()))
+        return data
+
+    def iter_measures(self):
+        for name, value in self.header.items():
+            yield Measure(self.statsfilename, name, '', value, self.units.get(name, ''))
+        for i, struct in enumerate(self.structures):
+            for j, col in enumerate(self.columns):
+                if self.mask is not None and not self.mask[j, i]:
+                    continue
+                yield Measure(self.statsfilename, struct, col, self.data[j, i],
+                              self.units.get(col, ''))
+
 
 class Measure(object):
     """Basic class for storing statistical measures"""
@@ -109,7 +246,8 @@ class Parser(object):
                  'rh.BA_exvivo.thresh.stats',
                  'lh.w-g.pct.stats',
                  'rh.w-g.pct.stats',
-                 'wmgm.aseg.stats'
+                 'wmgm.aseg.stats',
+                 'qcmetrics.stats'
                  )
     parseableforheader = ('aseg',
                  'wmparc',
@@ -125,7 +263,8 @@ class Parser(object):
                  'rh.BA_exvivo.thresh',
                  'lh.w-g.pct',
                  'rh.w-g.pct',
-                 'wmgm.aseg'
+                 'wmgm.aseg',
+                 'qcmetrics'
                  )
  
     topVars = {'aseg':['BrainSegVol',
@@ -152,22 +291,36 @@ class Parser(object):
                
     
 
-    @classmethod
-    def can_parse(cls, fname):
-        return basename(fname) in cls.parseable
+    # additional surface parcellations, e.g. from surface_stats
+    extra_aparc = re.compile(r'^[lr]h\.aparc\.[^/]+\.stats$')
 
-    def __init__(self, fname):
+    @classmethod
+    def can_parse(cls, fname, selection=None):
+        if basename(fname) not in cls.parseable and not cls.extra_aparc.match(basename(fname)):
+            return False
+        if selection is not None:
+            return len(selection.rules_for(os.path.splitext(basename(fname))[0])) > 0
+        return True
+
+    def __init__(self, fname, selection=None):
         self.type = basename(fname)
         self.statsfilename = os.path.splitext(self.type)[0]
+        self.rules = None
+        if selection is not None:
+            self.rules = selection.rules_for(self.statsfilename)
         
         with open(fname) as f:
-            self.raw = map(lambda x: x.strip(), f.read().splitlines())
+            self.raw = [x.strip() for x in f.read().splitlines()]
         self.parser_fxn = self.get_parser()
-        self.measures = self.parse()
+        self.table = self.parse()
 
     def __repr__(self):
         return "<Parser(%s)>" % self.type
 
+    @property
+    def measures(self):
+        return list(self.table.iter_measures())
+
     def get_parser(self):
         def _common(raw):
             """Johanna: 
@@ -189,170 +342,154 @@ class Parser(object):
             else:
                 hemi=hemi+'_'
 
+            header = OrderedDict()
+            units = {}
+            if self.rules is not None:
+                header_rules = [(struct, meas) for struct, meas in self.rules if meas.match('')]
+                if not header_rules:
+                    return header, units
             if any(s in self.statsfilename for s in self.parseableforheader):
-                measure_lines = filter(lambda x: x.startswith('# Measure'), raw)
-                measures = []
+                measure_lines = [x for x in raw if x.startswith('# Measure')]
                 for ml in measure_lines:
                     splat = ml.replace('# Measure', '').split(',')
-                    pieces = map(lambda x: x.strip(), splat)
+                    pieces = [x.strip() for x in splat]
                     #some stats files from new fs6.0 lack a comma in common headers
                     if len(pieces)==4:
-                        meas, descrip, val, units = pieces
+                        meas, descrip, val, unit = pieces
                         meas = descrip.split()[0]
-                        descrip = descrip.split()[1:]
                     else:
-                        str, meas, descrip, val, units = pieces
+                        _, meas, descrip, val, unit = pieces
                     #UPDATE: 11.10.2017. From Johanna. We should include the top part from each stats file and not discard any measure.
                     #therefore, the exclude line below is commented.
                     #if meas in self.topVars[self.statsfilename]:
-                    m = Measure(self.statsfilename, hemi+ meas.replace('-','_'), '', val, units, descrip=descrip)
-                    measures.append(m)
-                return measures
+                    #a StatsSelection (e.g. StatsSelection.from_topvars()) can select them again
+                    if self.rules is not None and not StatsSelection.match(header_rules, [meas], '')[0]:
+                        continue
+                    name = (hemi + meas.replace('-','_')).lower()
+                    header[name] = float(val)
+                    units[name] = unit.lower()
+            return header, units
 
         def _get_columns(raw):
-            tablecol = filter(lambda x: x.startswith('# TableCol'), raw)
-            ncols = int(filter(lambda x: x.startswith('# NTableCols'), raw)[0].split('# NTableCols')[1])
+            ncols = int([x for x in raw if x.startswith('# NTableCols')][0].split('# NTableCols')[1])
+            fields = {}
+            for x in raw:
+                if x.startswith('# TableCol'):
+                    splat = x.split(None, 4)
+                    fields[(int(splat[2]), splat[3])] = splat[4].strip() if len(splat) > 4 else ''
             columns = []
             for i in range(1, ncols + 1):
-                i_table_rows = filter(lambda x: ' %d ' % i in x, tablecol)
                 tup = (
                         i - 1,
-                        filter(lambda x: 'ColHeader' in x, i_table_rows)[0].split(' ColHeader ')[-1].strip(),
-                        filter(lambda x: 'FieldName' in x, i_table_rows)[0].split(' FieldName ')[-1].strip(),
-                        filter(lambda x: 'Units' in x, i_table_rows)[0].split(' Units ')[-1].strip(),
+                        fields[(i, 'ColHeader')],
+                        fields[(i, 'FieldName')],
+                        fields[(i, 'Units')],
                     )
                 columns.append(tup)
             return columns
 
-        def _grab(columns, col_name, ss_row):
-            i, name, field, units = filter(lambda x: x[1] == col_name, columns)[0]
-            return ss_row[i], field, units
+        def _table(raw, columns_to_measure, hemi=None, common=True):
+            """Parse the table part of a stats file into one float64 array
+            per measure column, all cells converted in a single pass"""
+            if common:
+                header, units = _common(raw)
+            else:
+                header, units = OrderedDict(), {}
+            columns = _get_columns(raw)
+            index = {}
+            for i, name, field, unit in columns:
+                index.setdefault(name, (i, unit))
+            #tables written by other tools may only have some of the columns
+            columns_to_measure = [col for col in columns_to_measure if col in index]
+            rows = [x.split() for x in raw if x and not x.startswith('#')]
+            struct_idx = index['StructName'][0]
+            structures = np.array([row[struct_idx] for row in rows], dtype=str)
+
+            mask = None
+            if self.rules is not None:
+                #only the selected rows and columns are converted at all, none
+                #if the rules of the file only select header measures
+                mask = np.zeros((len(columns_to_measure), len(structures)), dtype=bool)
+                table_rules = [(struct, meas) for struct, meas in self.rules
+                               if any(meas.match(col) for col in columns_to_measure)]
+                if table_rules:
+                    for j, col in enumerate(columns_to_measure):
+                        mask[j] = StatsSelection.match(table_rules, structures, col)
+                cols = mask.any(axis=1)
+                keep = mask.any(axis=0)
+                columns_to_measure = [col for col, k in zip(columns_to_measure, cols) if k]
+                mask = mask[cols][:, keep]
+                rows = [row for row, k in zip(rows, keep) if k]
+                structures = structures[keep]
+                if mask.all():
+                    mask = None
+
+            if rows:
+                cells = np.array(rows, dtype=str)
+            else:
+                cells = np.empty((0, len(columns)), dtype=str)
+
+            col_idx = [index[col][0] for col in columns_to_measure]
+            data = cells[:, col_idx].astype(np.float64).T
+            structures = [s.replace('-', '_').lower() for s in structures]
+            if hemi:
+                structures = ['%s_%s' % (hemi, s) for s in structures]
+            for col in columns_to_measure:
+                units[col.lower()] = index[col][1].lower()
+
+            return StatsTable(self.statsfilename, header, structures,
+                              [col.lower() for col in columns_to_measure],
+                              data, units, mask)
 
         def _aseg(raw):
-            common = _common(raw)
-            columns = _get_columns(raw)
-            rows = filter(lambda x: not x.startswith('#'), raw)
-            measures = []
-            
-            for row in rows:
-                ss_row = row.strip().split()
-                #jk->ms select few measures
-                #measure_cols = ['Volume_mm3', 'normMean', 'normStdDev', 'normMin', 'normMax', 'normRange']
-                measure_cols = ['NVoxels', 'Volume_mm3']
-                measures.extend(_parse_row(ss_row, columns, measure_cols))
-            
-            return common + measures
+            #jk->ms select few measures
+            #measure_cols = ['Volume_mm3', 'normMean', 'normStdDev', 'normMin', 'normMax', 'normRange']
+            measure_cols = ['NVoxels', 'Volume_mm3']
+            return _table(raw, measure_cols)
 
         def _wmparc(raw):
-            common = _common(raw)
-            columns = _get_columns(raw)
-            rows = filter(lambda x: not x.startswith('#'), raw)
-            measures = []
-            
-            for row in rows:
-                ss_row = row.strip().split()
-                #jk->ms select few measures
-                #measure_cols = ['Volume_mm3', 'normMean', 'normStdDev', 'normMin', 'normMax', 'normRange']
-                measure_cols = ['NVoxels', 'Volume_mm3']
-                measures.extend(_parse_row(ss_row, columns, measure_cols))
-            
-            return common + measures
-            
-        def _parse_row(ss_row, columns, columns_to_measure, hemi=None):
-            struct, _, _ = _grab(columns, 'StructName', ss_row)
-            struct = struct.replace('-', '_')
-            measures = []
-            for col in columns_to_measure:
-                value, descrip, units = _grab(columns, col, ss_row)
-                m = Measure(self.statsfilename, struct, col, value, units, descrip=descrip)
-                if hemi:
-                    m.structure = '%s_%s' % (hemi, m.structure)
-                    # m.descrip = '%s %s' % (hemi, m.descrip)
-                measures.append(m)
-            return measures
+            #jk->ms select few measures
+            #measure_cols = ['Volume_mm3', 'normMean', 'normStdDev', 'normMin', 'normMax', 'normRange']
+            measure_cols = ['NVoxels', 'Volume_mm3']
+            return _table(raw, measure_cols)
 
         def _hemi(raw):
 
             hemi=''
-            hemi_strlist = filter(lambda x: x.startswith('# hemi'), raw)
+            hemi_strlist = [x for x in raw if x.startswith('# hemi')]
 
             if hemi_strlist and len(hemi_strlist)>=1:
-                hemi = filter(lambda x: x.startswith('# hemi'), raw)[0].split('hemi')[1].strip()
+                hemi = hemi_strlist[0].split('hemi')[1].strip()
             else:
-                hemi_strlist = filter(lambda x: x.startswith('# InVolFile '), raw)
+                hemi_strlist = [x for x in raw if x.startswith('# InVolFile ')]
                 if hemi_strlist and len(hemi_strlist) >=1:
-                    hemi = filter(lambda x: x.startswith('# InVolFile '), raw)[0].split('/')[-1].split('.')[0].strip()
+                    hemi = hemi_strlist[0].split('/')[-1].split('.')[0].strip()
             
             return hemi
 
         def _aparc(raw):
-            # need common part here too
-            common = _common(raw)
-            # update these measures with hemisphere
+            # need common part here too, update the table measures with hemisphere
             hemi = _hemi(raw)
-            
-            #for meas in common:
-            #    meas.structure = hemi + meas.structure
-            
-            rows = filter(lambda x: not x.startswith('#'), raw)
-            columns = _get_columns(raw)
-            measures = []
-            
-            for row in rows:
-                ss_row = row.strip().split()
-                #wh->ms select few cols
-                measure_cols = ['NumVert', 'SurfArea', 'GrayVol', 'ThickAvg',
-                    'ThickStd', 'MeanCurv', 'GausCurv', 'FoldInd', 'CurvInd']
-                measures.extend(_parse_row(ss_row, columns, measure_cols, hemi=hemi))
-            
-
-            return common + measures
-
-        def _a2009s(raw):
-            # need common part here too
-            common = _common(raw)
-            hemi = _hemi(raw)
-            rows = filter(lambda x: not x.startswith('#'), raw)
-            columns = _get_columns(raw)
-            measures = []
-            
-            for row in rows:
-                ss_row = row.strip().split()
-                measure_cols = ['NumVert', 'SurfArea', 'GrayVol', 'ThickAvg',
-                    'ThickStd', 'MeanCurv', 'GausCurv', 'FoldInd', 'CurvInd']
-                measures.extend(_parse_row(ss_row, columns, measure_cols, hemi=hemi))
-            
-            return common + measures
+            #wh->ms select few cols
+            measure_cols = ['NumVert', 'SurfArea', 'GrayVol', 'ThickAvg',
+                'ThickStd', 'MeanCurv', 'GausCurv', 'FoldInd', 'CurvInd']
+            return _table(raw, measure_cols, hemi=hemi)
 
         def _wgpct(raw):
             # need common part here too
-            common = _common(raw)
             hemi = _hemi(raw)
-            rows = filter(lambda x: not x.startswith('#'), raw)
-            columns = _get_columns(raw)
-            measures = []
-            
-            for row in rows:
-                ss_row = row.strip().split()
-                measure_cols = ['NVertices', 'Area_mm2',  'Mean', 'StdDev', 'Min', 'Max', 'Range', 'SNR']
-                measures.extend(_parse_row(ss_row, columns, measure_cols, hemi=hemi))
-            
-            return common + measures
+            measure_cols = ['NVertices', 'Area_mm2',  'Mean', 'StdDev', 'Min', 'Max', 'Range', 'SNR']
+            return _table(raw, measure_cols, hemi=hemi)
 
         def _wmgm(raw):
             # Don't need to do common
-            #common = _common(raw)
-            hemi = ""
-            rows = filter(lambda x: not x.startswith('#'), raw)
-            columns = _get_columns(raw)
-            measures = []
-            
-            for row in rows:
-                ss_row = row.strip().split()
-                measure_cols = ['NVoxels', 'Volume_mm3']
-                measures.extend(_parse_row(ss_row, columns, measure_cols, hemi=hemi))
-            
-            return measures
+            measure_cols = ['NVoxels', 'Volume_mm3']
+            return _table(raw, measure_cols, hemi="", common=False)
+
+        def _header(raw):
+            # only '# Measure' lines, e.g. qc_metrics
+            header, units = _common(raw)
+            return StatsTable(self.statsfilename, header, units=units)
             
         key_parsers = {
             'aseg.stats': _aseg,
@@ -370,7 +507,10 @@ class Parser(object):
             'lh.w-g.pct.stats':_wgpct,
             'rh.w-g.pct.stats':_wgpct,
             'wmgm.aseg.stats':_wmgm,
+            'qcmetrics.stats':_header,
         }
+        if self.type not in key_parsers and self.extra_aparc.match(self.type):
+            return _aparc
         return key_parsers[self.type]
 
     def parse(self):
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2023 Population Health Sciences, German Center for Neurodegenerative Diseases (DZNE)
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+QC snapshots of many subjects without a nipype workflow.
+
+Subject ids are streamed into a pool of workers that import the rendering
+modules and parse the color LUT once when they start, then call
+create_mri_screenshots for one subject after another. Subjects whose
+snapshots are up to date with their orig/aseg and the rendering parameters
+(see screenshot.snapshots_up_to_date) are skipped unless forced. With a
+gallery dir the workers also update the qc_gallery entries of their
+subjects, and the gallery page is rewritten as the batch progresses. Workers are recycled
+after a number of subjects to keep their memory bounded, a subject without a
+result within a timeout (its worker was killed) is reported as failed. The
+status of every subject is appended to a csv file as soon as it is known.
+
+benchmark_qc_encoders renders the snapshots of some subjects once and
+reports the bytes and encoding time per subject of every image encoder.
+"""
+
+import os
+import time
+import shutil
+import tempfile
+import threading
+import multiprocessing
+from os.path import join, exists
+
+STATUS_FILE = 'qc_snapshot_status.csv'
+
+
+def _init_worker():
+    import matplotlib.cm
+    import matplotlib.image
+    import scipy.ndimage
+    import nibabel
+    from .fs_colorlut import load_lut, get_lut_path
+    if exists(get_lut_path()):
+        load_lut()
+
+
+def subject_volumes(output_dir, subject_id):
+    mri = join(output_dir, subject_id, 'mri')
+    return join(mri, 'orig.mgz'), join(mri, 'aseg.mgz')
+
+
+def stale_subjects(output_dir, subject_ids, **snapshot_args):
+    """subject_ids whose QC snapshots are missing or out of date"""
+    from .screenshot import snapshots_up_to_date
+    return [s for s in subject_ids
+            if not snapshots_up_to_date(join(output_dir, s, 'qcsnapshots'),
+                                        *subject_volumes(output_dir, s), **snapshot_args)]
+
+
+def _render_subject(args):
+    output_dir, subject_id, force, snapshot_args, gallery = args
+    from .screenshot import create_mri_screenshots, snapshots_up_to_date
+
+    start = time.time()
+    status = 'up-to-date'
+    entry = None
+    try:
+        path_orig, path_aseg = subject_volumes(output_dir, subject_id)
+        if force or not snapshots_up_to_date(join(output_dir, subject_id, 'qcsnapshots'),
+                                             path_orig, path_aseg, **snapshot_args):
+            create_mri_screenshots(path_orig, path_aseg, output_dir, subject_id, **snapshot_args)
+            status = 'ok'
+        if gallery is not None:
+            from .qc_gallery import gallery_entry
+            gallery_dir, entry = gallery
+            entry = gallery_entry(output_dir, gallery_dir, subject_id, entry,
+                                  snapshot_args.get('image_extension', 'png'))
+    except Exception as e:
+        return subject_id, 'failed', time.time() - start, '%s: %s' % (type(e).__name__, e), None
+    return subject_id, status, time.time() - start, '', entry
+
+
+def _next_finished(pending, done, timeout):
+    """Pop the first (subject_id, result, submitted) of pending whose result is
+    ready or that has run for more than timeout seconds"""
+    while True:
+        done.clear()
+        for i, (_, result, submitted) in enumerate(pending):
+            if result.ready() or (timeout and time.time() > submitted + timeout):
+                return pending.pop(i)
+        done.wait(1.0)
+
+
+def render_qc_batch(output_dir, subject_ids, processes=1, status_file=None,
+                    tasks_per_worker=200, force=False, gallery_dir=None, timeout=1800,
+                    **snapshot_args):
+    """Create the QC snapshots of subject_ids with a pool of warm workers
+
+    snapshot_args are passed on to create_mri_screenshots (num_slices,
+    padd, spacing, image_extension, nrows). A subject without a result after
+    timeout seconds (None to wait forever), e.g. because its worker was
+    killed, is reported as failed. The status rows are appended to
+    status_file, after those of earlier runs.
+
+    :return
+        {subject_id: error message} of the failed subjects
+    """
+    status_file = status_file or join(output_dir, STATUS_FILE)
+    gallery = None
+    if gallery_dir:
+        from .qc_gallery import GalleryUpdater
+        gallery = GalleryUpdater(gallery_dir)
+    tasks = ((output_dir, s, force, snapshot_args,
+              (gallery.gallery_dir, gallery.entries.get(s)) if gallery else None)
+             for s in subject_ids)
+    failed = {}
+    lost = []
+    done = threading.Event()
+    pool = multiprocessing.Pool(processes, initializer=_init_worker,
+                                maxtasksperchild=tasks_per_worker)
+
+    def _finish(fp, subject_id, result, submitted):
+        if not result.ready():
+            # a killed worker's task is never completed, the pool replaces the worker
+            lost.append(subject_id)
+            subject_id, status, seconds, error, entry = (
+                subject_id, 'failed', time.time() - submitted,
+                'no result after %d seconds, the worker was killed or hangs' % timeout, None)
+        elif not result.successful():
+            # without a callback, found by the poll of _next_finished
+            try:
+                result.get()
+            except Exception as e:
+                status, seconds, error, entry = ('failed', time.time() - submitted,
+                                                 '%s: %s' % (type(e).__name__, e), None)
+        else:
+            subject_id, status, seconds, error, entry = result.get()
+        if error:
+            failed[subject_id] = error
+        elif gallery:
+            gallery.add(subject_id, entry)
+        fp.write('%s,%s,%.2f,"%s"\n' % (subject_id, status, seconds,
+                                        error.replace('"', "'").replace('\n', ' ')))
+        fp.flush()
+
+    try:
+        new_file = not exists(status_file) or os.path.getsize(status_file) == 0
+        with open(status_file, 'a') as fp:
+            if new_file:
+                fp.write('subject,status,seconds,error\n')
+            # at most one task per worker in flight, so a task starts about when it
+            # is submitted and its deadline counts from there
+            pending = []
+            for task in tasks:
+                pending.append((task[1], pool.apply_async(_render_subject, (task,),
+                                                          callback=lambda _: done.set()),
+                                time.time()))
+                if len(pending) >= processes:
+                    _finish(fp, *_next_finished(pending, done, timeout))
+            while pending:
+                _finish(fp, *_next_finished(pending, done, timeout))
+        if not lost:
+            pool.close()
+            pool.join()
+    finally:
+        pool.terminate()
+    if gallery:
+        gallery.write()
+    return failed
+
+
+def benchmark_qc_encoders(output_dir, subject_ids, encoders=None, **snapshot_args):
+    """Encode the snapshots of subject_ids with every encoder in a temporary
+    dir of output_dir, to measure on the storage they are written to
+
+    :return
+        {encoder: (bytes per subject, milliseconds per subject)}
+    """
+    from .screenshot import render_subject_planes
+    from .image_encoders import benchmark_encoders
+
+    snapshot_args.pop('image_extension', None)
+    totals = {}
+    tmp_dir = tempfile.mkdtemp(prefix='qc_encoders_', dir=output_dir)
+    try:
+        for subject_id in subject_ids:
+            images = list(render_subject_planes(*subject_volumes(output_dir, subject_id),
+                                                **snapshot_args))
+            for encoder, (size, ms) in benchmark_encoders(images, tmp_dir, encoders).items():
+                total = totals.setdefault(encoder, [0, 0.0])
+                total[0] += size
+                total[1] += ms
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    n = float(max(len(subject_ids), 1))
+    return dict((encoder, (size / n, ms / n)) for encoder, (size, ms) in totals.items())
@@ -0,0 +1,349 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2023 Population Health Sciences, German Center for Neurodegenerative Diseases (DZNE)
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+Static HTML gallery of the QC snapshots of a cohort.
+
+For every subject the wide qcsnapshots/img_dual_<plane>.png mosaics are
+turned into a small thumbnail and full resolution tiles of a fixed width in
+<gallery>/<subject>/. gallery_index.json keeps one entry per subject with the
+mtime and size of the snapshots (and of qc_rank.json, whose rank and score
+are shown), so re-running only converts subjects with new snapshots.
+index.html is a static page that reads gallery_data.js, so it also works
+from a shared drive over file://, and pages, sorts and filters the subjects
+with lazy-loaded images.
+"""
+
+import os
+import json
+import multiprocessing
+from os.path import join, exists
+
+from .image_encoders import encoder_extension
+
+GALLERY_VERSION = 1
+GALLERY_INDEX = 'gallery_index.json'
+GALLERY_DATA = 'gallery_data.js'
+PLANES = ('sagittal', 'axial', 'coronal')
+RANK_KEYS = ('rank', 'score', 'n_outliers', 'worst_measures')
+
+
+def _stamp(fname):
+    try:
+        st = os.stat(fname)
+    except OSError:
+        return None
+    return [st.st_mtime, st.st_size]
+
+
+def snapshot_files(output_dir, subject_id, image_extension='png'):
+    qc_dir = join(output_dir, subject_id, 'qcsnapshots')
+    extension = encoder_extension(image_extension)
+    return dict((plane, join(qc_dir, 'img_dual_%s.%s' % (plane, extension))) for plane in PLANES)
+
+
+def subject_stamps(output_dir, subject_id, image_extension='png'):
+    """{file key: [mtime, size]} of the inputs of a gallery entry"""
+    stamps = dict((plane, _stamp(f)) for plane, f
+                  in snapshot_files(output_dir, subject_id, image_extension).items())
+    stamps['rank'] = _stamp(join(output_dir, subject_id, 'qcsnapshots', 'qc_rank.json'))
+    return stamps
+
+
+def _save_jpeg(img, fname, quality):
+    img.convert('RGB').save(fname + '.tmp', format='JPEG', quality=quality)
+    os.rename(fname + '.tmp', fname)
+
+
+def make_subject_images(snapshot, out_dir, prefix, thumb_width=1200, tile_width=1024,
+                        quality=85):
+    """Thumbnail and tiles of one snapshot mosaic
+
+    :return
+        dict with width, height, thumb and tiles, paths relative to the
+        gallery dir
+    """
+    from PIL import Image
+
+    img = Image.open(snapshot)
+    img.load()
+    width, height = img.size
+    subject_dir = os.path.basename(out_dir)
+
+    scale = min(1.0, float(thumb_width) / width)
+    thumb = img.resize((max(1, int(round(width * scale))), max(1, int(round(height * scale)))),
+                       Image.LANCZOS) if scale < 1 else img
+    thumb_name = '%s_thumb.jpg' % prefix
+    _save_jpeg(thumb, join(out_dir, thumb_name), quality)
+
+    tiles = []
+    for i, x in enumerate(range(0, width, tile_width)):
+        tile_name = '%s_tile%03d.jpg' % (prefix, i)
+        _save_jpeg(img.crop((x, 0, min(x + tile_width, width), height)), join(out_dir, tile_name),
+                   quality)
+        tiles.append('%s/%s' % (subject_dir, tile_name))
+    return {'width': width, 'height': height, 'thumb': '%s/%s' % (subject_dir, thumb_name),
+            'tiles': tiles}
+
+
+def _read_rank(output_dir, subject_id):
+    try:
+        with open(join(output_dir, subject_id, 'qcsnapshots', 'qc_rank.json')) as fp:
+            rank = json.load(fp)
+    except (IOError, OSError, ValueError):
+        return {}
+    return dict((k, rank.get(k)) for k in RANK_KEYS)
+
+
+def gallery_entry(output_dir, gallery_dir, subject_id, entry=None, image_extension='png',
+                  force=False, **image_options):
+    """Up to date gallery entry of a subject, given its current entry (None
+    if it is new). Images are only made again if the snapshots changed.
+
+    :return
+        the entry, None if the subject has no snapshots
+    """
+    stamps = subject_stamps(output_dir, subject_id, image_extension)
+    if not any(stamps[plane] for plane in PLANES):
+        return None
+    if not force and entry is not None and all(entry['stamps'].get(p) == stamps[p] for p in PLANES):
+        if entry['stamps'].get('rank') == stamps['rank']:
+            return entry
+        entry = dict((k, v) for k, v in entry.items() if k not in RANK_KEYS)
+    else:
+        entry = {'subject': subject_id, 'planes': {}}
+        out_dir = join(gallery_dir, subject_id)
+        if not exists(out_dir):
+            os.makedirs(out_dir)
+        for plane, snapshot in sorted(snapshot_files(output_dir, subject_id,
+                                                     image_extension).items()):
+            if stamps[plane]:
+                entry['planes'][plane] = make_subject_images(snapshot, out_dir, plane,
+                                                             **image_options)
+        entry['mtime'] = max(stamps[plane][0] for plane in entry['planes'])
+    entry['stamps'] = stamps
+    entry.update(_read_rank(output_dir, subject_id))
+    return entry
+
+
+def _gallery_worker(args):
+    output_dir, gallery_dir, subject_id, entry, options = args
+    try:
+        return subject_id, gallery_entry(output_dir, gallery_dir, subject_id, entry, **options), None
+    except Exception as e:
+        return subject_id, entry, '%s: %s' % (type(e).__name__, e)
+
+
+def load_gallery_index(gallery_dir):
+    try:
+        with open(join(gallery_dir, GALLERY_INDEX)) as fp:
+            index = json.load(fp)
+    except (IOError, OSError, ValueError):
+        return {}
+    if index.get('version') != GALLERY_VERSION:
+        return {}
+    return index.get('subjects', {})
+
+
+def _write_atomic(fname, text):
+    with open(fname + '.tmp', 'w') as fp:
+        fp.write(text)
+    os.rename(fname + '.tmp', fname)
+
+
+def write_gallery(gallery_dir, entries):
+    """Write the index, the page data and the static page"""
+    _write_atomic(join(gallery_dir, GALLERY_INDEX),
+                  json.dumps({'version': GALLERY_VERSION, 'subjects': entries}))
+    rows = [dict((k, v) for k, v in entries[s].items() if k != 'stamps') for s in sorted(entries)]
+    _write_atomic(join(gallery_dir, GALLERY_DATA), 'var QC_GALLERY = %s;\n' % json.dumps(rows))
+    page = join(gallery_dir, 'index.html')
+    if exists(page):
+        with open(page) as fp:
+            if fp.read() == INDEX_HTML:
+                return
+    _write_atomic(page, INDEX_HTML)
+
+
+class GalleryUpdater(object):
+    """Collects updated entries and rewrites the gallery every write_every
+    updates, so the page follows a running batch"""
+
+    def __init__(self, gallery_dir, write_every=100):
+        self.gallery_dir = gallery_dir
+        self.write_every = write_every
+        if not exists(gallery_dir):
+            os.makedirs(gallery_dir)
+        self.entries = load_gallery_index(gallery_dir)
+        self.updated = []
+        self._pending = 0
+
+    def add(self, subject_id, entry):
+        if entry is None or entry == self.entries.get(subject_id):
+            return
+        self.entries[subject_id] = entry
+        self.updated.append(subject_id)
+        self._pending += 1
+        if self._pending >= self.write_every:
+            self.write()
+
+    def write(self):
+        write_gallery(self.gallery_dir, self.entries)
+        self._pending = 0
+
+
+def update_gallery(output_dir, subject_ids, gallery_dir=None, processes=1, image_extension='png',
+                   thumb_width=1200, tile_width=1024, write_every=100, force=False):
+    """Add or refresh the gallery entries of subject_ids whose snapshots or
+    rank changed
+
+    :return
+        (updated subject ids, {subject_id: error message})
+    """
+    gallery = GalleryUpdater(gallery_dir or join(output_dir, 'qc_gallery'), write_every)
+    options = {'image_extension': image_extension, 'force': force,
+               'thumb_width': thumb_width, 'tile_width': tile_width}
+    tasks = ((output_dir, gallery.gallery_dir, s, gallery.entries.get(s), options)
+             for s in subject_ids)
+    failed = {}
+    pool = multiprocessing.Pool(processes)
+    try:
+        for subject_id, entry, error in pool.imap_unordered(_gallery_worker, tasks, chunksize=8):
+            if error:
+                failed[subject_id] = error
+            else:
+                gallery.add(subject_id, entry)
+        pool.close()
+        pool.join()
+    finally:
+        pool.terminate()
+    gallery.write()
+    return gallery.updated, failed
+
+
+INDEX_HTML = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>QC snapshots</title>
+<style>
+body { font-family: sans-serif; margin: 1em; background: #111; color: #ddd; }
+#controls { position: sticky; top: 0; background: #111; padding: 0.5em 0; }
+input, select, button { font-size: 1em; }
+.subject { margin: 0.5em 0 1.5em 0; }
+.subject h3 { margin: 0.2em 0; font-size: 1em; cursor: pointer; }
+.subject img { display: block; max-width: 100%; margin-bottom: 2px; }
+.tiles { white-space: nowrap; overflow-x: auto; }
+.tiles img { display: inline-block; max-width: none; }
+.meta { color: #999; font-size: 0.9em; }
+</style>
+<script src="gallery_data.js"></script>
+</head>
+<body>
+<div id="controls">
+  <input id="filter" placeholder="filter subjects">
+  <select id="sort">
+    <option value="rank">QC rank</option>
+    <option value="subject">subject</option>
+    <option value="score">score</option>
+    <option value="mtime">last updated</option>
+  </select>
+  <button id="prev">&lt;</button> <span id="page"></span> <button id="next">&gt;</button>
+  <span id="count" class="meta"></span>
+</div>
+<div id="list"></div>
+<script>
+var PAGE_SIZE = 25, PLANES = ['sagittal', 'axial', 'coronal'], page = 0, rows = [];
+var data = window.QC_GALLERY || [];
+
+function compare(key) {
+  return function(a, b) {
+    var x = a[key], y = b[key];
+    if (key == 'score' || key == 'mtime') { x = -(x || 0); y = -(y || 0); }
+    if (key == 'rank') { x = x == null ? Infinity : x; y = y == null ? Infinity : y; }
+    return x < y ? -1 : x > y ? 1 : (a.subject < b.subject ? -1 : 1);
+  };
+}
+
+function image(src) {
+  var img = document.createElement('img');
+  img.loading = 'lazy';
+  img.src = src;
+  return img;
+}
+
+function toggleTiles(div, row) {
+  var tiles = div.querySelector('.tiles');
+  if (tiles) { div.removeChild(tiles); return; }
+  tiles = document.createElement('div');
+  tiles.className = 'tiles';
+  PLANES.forEach(function(plane) {
+    var p = row.planes[plane];
+    if (!p) return;
+    var line = document.createElement('div');
+    p.tiles.forEach(function(t) { line.appendChild(image(t)); });
+    tiles.appendChild(line);
+  });
+  div.appendChild(tiles);
+}
+
+function render() {
+  var list = document.getElementById('list');
+  var pages = Math.max(1, Math.ceil(rows.length / PAGE_SIZE));
+  page = Math.min(Math.max(page, 0), pages - 1);
+  list.innerHTML = '';
+  rows.slice(page * PAGE_SIZE, (page + 1) * PAGE_SIZE).forEach(function(row) {
+    var div = document.createElement('div');
+    div.className = 'subject';
+    var h = document.createElement('h3');
+    h.textContent = row.subject;
+    h.title = 'full resolution tiles';
+    h.onclick = function() { toggleTiles(div, row); };
+    div.appendChild(h);
+    var meta = document.createElement('div');
+    meta.className = 'meta';
+    var text = [];
+    if (row.rank != null) text.push('rank ' + row.rank + ', score ' + row.score);
+    if (row.worst_measures) text.push(row.worst_measures.map(function(w) { return w[0] + ' ' + w[1]; }).join(', '));
+    text.push('updated ' + new Date(row.mtime * 1000).toLocaleString());
+    meta.textContent = text.join(' | ');
+    div.appendChild(meta);
+    PLANES.forEach(function(plane) {
+      if (row.planes[plane]) div.appendChild(image(row.planes[plane].thumb));
+    });
+    list.appendChild(div);
+  });
+  document.getElementById('page').textContent = (page + 1) + ' / ' + pages;
+  document.getElementById('count').textContent = rows.length + ' of ' + data.length + ' subjects';
+}
+
+function update() {
+  var f = document.getElementById('filter').value.toLowerCase();
+  rows = data.filter(function(r) { return r.subject.toLowerCase().indexOf(f) >= 0; });
+  rows.sort(compare(document.getElementById('sort').value));
+  page = 0;
+  render();
+}
+
+document.getElementById('filter').oninput = update;
+document.getElementById('sort').onchange = update;
+document.getElementById('prev').onclick = function() { page--; render(); };
+document.getElementById('next').onclick = function() { page++; render(); };
+update();
+</script>
+</body>
+</html>
+"""
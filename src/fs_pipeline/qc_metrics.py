@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2023 Population Health Sciences, German Center for Neurodegenerative Diseases (DZNE)
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+Quantitative QC metrics of a subject, written to stats/qcmetrics.stats.
+
+Intensity statistics of every aseg label are summed in one pass with
+np.bincount over norm.mgz, from which the WM/GM SNR and CNR come, along with
+the orig.mgz sums; the background noise is the spread of orig.mgz in its
+corners. The label counts
+give hemisphere asymmetries and missing structures, ribbon.mgz the holes
+and pieces of the cortical ribbon. The Euler number, holes and non-manifold
+edges of ?h.orig.nofix come from counting the unique edges of its faces.
+
+The file has the '# Measure' header lines of the Freesurfer stats files, so
+Parser reads it into the subject json and the cohort table like aseg.stats.
+Metrics that cannot be computed (NaN) get no line.
+"""
+
+import os
+from os.path import join, exists
+
+import numpy as np
+
+QC_METRICS_FILE = 'qcmetrics.stats'
+
+WM_LABELS = (2, 41)
+GM_LABELS = (3, 42)
+
+# (name, left label, right label) of the asymmetry checks
+ASYMMETRY_PAIRS = (('CerebralWhiteMatter', 2, 41),
+                   ('CerebralCortex', 3, 42),
+                   ('LateralVentricle', 4, 43),
+                   ('CerebellumCortex', 8, 47),
+                   ('Thalamus', 10, 49),
+                   ('Caudate', 11, 50),
+                   ('Putamen', 12, 51),
+                   ('Pallidum', 13, 52),
+                   ('Hippocampus', 17, 53),
+                   ('Amygdala', 18, 54))
+
+# structures every aseg should have
+EXPECTED_LABELS = tuple(sorted(set([l for _, left, right in ASYMMETRY_PAIRS
+                                    for l in (left, right)] + [7, 16, 46])))
+
+
+def _measure(measures, structure, name, description, value, unit):
+    measures.append((structure, name, description, float(value), unit))
+
+
+def _ratio(a, b):
+    return a / b if b else float('nan')
+
+
+def label_intensity_stats(aseg, intensity, other=None):
+    """(voxel counts, sums, sums of squares) of intensity per aseg label,
+    indexed by label, with other also the sums of other from the same
+    flattened labels"""
+    arrays = [np.asarray(a) for a in (aseg, intensity, other) if a is not None]
+    # mgz volumes are in Fortran order, flatten them without a copy then
+    order = 'F' if all(a.flags.f_contiguous for a in arrays) else 'C'
+    labels = arrays[0].ravel(order)
+    values = arrays[1].ravel(order).astype(np.float64)
+    counts = np.bincount(labels)
+    sums = np.bincount(labels, values, minlength=len(counts))
+    squares = np.bincount(labels, values * values, minlength=len(counts))
+    if other is None:
+        return counts, sums, squares
+    return counts, sums, squares, np.bincount(labels, arrays[2].ravel(order), minlength=len(counts))
+
+
+def _tissue(stats, labels):
+    counts, sums, squares = (np.take(a, [l for l in labels if l < len(a)]).sum() for a in stats)
+    if not counts:
+        return float('nan'), float('nan')
+    mean = sums / counts
+    return mean, np.sqrt(max(squares / counts - mean * mean, 0))
+
+
+def corner_background(orig, corner=16):
+    """voxels of the eight corner cubes of a volume"""
+    orig = np.asarray(orig)
+    blocks = []
+    for i in (np.s_[:corner], np.s_[-corner:]):
+        for j in (np.s_[:corner], np.s_[-corner:]):
+            for k in (np.s_[:corner], np.s_[-corner:]):
+                blocks.append(orig[i, j, k].ravel())
+    return np.concatenate(blocks).astype(np.float64)
+
+
+def tissue_metrics(orig, norm, aseg, measures, corner=16):
+    counts, sums, squares, orig_sums = label_intensity_stats(aseg, norm, orig)
+    stats = counts, sums, squares
+    wm_mean, wm_std = _tissue(stats, WM_LABELS)
+    gm_mean, gm_std = _tissue(stats, GM_LABELS)
+    _measure(measures, 'WM', 'WMMean', 'Cerebral white matter mean intensity (norm)', wm_mean, 'unitless')
+    _measure(measures, 'WM', 'WMStd', 'Cerebral white matter intensity standard deviation (norm)', wm_std, 'unitless')
+    _measure(measures, 'GM', 'GMMean', 'Cerebral cortex mean intensity (norm)', gm_mean, 'unitless')
+    _measure(measures, 'GM', 'GMStd', 'Cerebral cortex intensity standard deviation (norm)', gm_std, 'unitless')
+    _measure(measures, 'WM', 'WMSNR', 'White matter mean over standard deviation', _ratio(wm_mean, wm_std), 'unitless')
+    _measure(measures, 'GM', 'GMSNR', 'Cortex mean over standard deviation', _ratio(gm_mean, gm_std), 'unitless')
+    _measure(measures, 'Brain', 'CNR', 'WM/GM contrast to noise ratio',
+             _ratio(abs(wm_mean - gm_mean), np.sqrt(wm_std ** 2 + gm_std ** 2)), 'unitless')
+
+    background = corner_background(orig, corner)
+    wm = [l for l in WM_LABELS if l < len(counts)]
+    orig_wm_mean = _ratio(orig_sums[wm].sum(), counts[wm].sum())
+    bg_std = background.std()
+    _measure(measures, 'Background', 'BackgroundMean', 'Mean intensity of the corners of orig', background.mean(), 'unitless')
+    _measure(measures, 'Background', 'BackgroundNoise', 'Intensity standard deviation of the corners of orig', bg_std, 'unitless')
+    # Rayleigh corrected SNR of the white matter over the background noise
+    _measure(measures, 'WM', 'WMSNRBackground', 'White matter mean of orig over the background noise',
+             _ratio(orig_wm_mean, bg_std * np.sqrt(2 / (4 - np.pi))), 'unitless')
+    return counts
+
+
+def label_metrics(counts, voxel_volume, measures):
+    """Hemisphere asymmetry indices (|L - R| / mean(L, R)) and missing
+    structures from the aseg label voxel counts"""
+    counts = np.concatenate((counts, np.zeros(max(EXPECTED_LABELS) + 1, dtype=counts.dtype)))
+    worst = 0.0
+    for name, left, right in ASYMMETRY_PAIRS:
+        l, r = counts[left] * voxel_volume, counts[right] * voxel_volume
+        asym = _ratio(2.0 * abs(l - r), l + r)
+        worst = max(worst, asym) if asym == asym else worst
+        _measure(measures, name, name + 'Asymmetry', '%s left/right volume asymmetry' % name, asym, 'unitless')
+    _measure(measures, 'Brain', 'MaxAsymmetry', 'Largest left/right volume asymmetry', worst, 'unitless')
+    missing = int((counts[list(EXPECTED_LABELS)] == 0).sum())
+    _measure(measures, 'Brain', 'MissingLabels', 'Number of expected aseg structures without voxels',
+             missing, 'unitless')
+
+
+def ribbon_metrics(ribbon, measures):
+    """Voxels enclosed by the ribbon of a hemisphere that are not part of it
+    and the number of pieces of its cortex"""
+    from scipy import ndimage
+    from .screenshot import nonzero_extent
+
+    ribbon = np.asarray(ribbon)
+    for hemi, wm, gm in (('lh', 2, 3), ('rh', 41, 42)):
+        mask = (ribbon == wm) | (ribbon == gm)
+        holes, pieces = 0, 0
+        if mask.any():
+            crop = tuple(slice(max(lo - 1, 0), hi + 2) for lo, hi in nonzero_extent(mask))
+            mask = mask[crop]
+            holes = int((ndimage.binary_fill_holes(mask) & ~mask).sum())
+            pieces = ndimage.label(ribbon[crop] == gm)[1]
+        _measure(measures, hemi, hemi + 'RibbonHoles',
+                 'Voxels enclosed by the %s ribbon that are not part of it' % hemi, holes, 'voxels')
+        _measure(measures, hemi, hemi + 'CortexPieces',
+                 'Connected components of the %s cortical ribbon' % hemi, pieces, 'unitless')
+
+
+def surface_topology(n_vertices, faces):
+    """(Euler number, holes, non-manifold edges) of a triangle mesh, from
+    the unique edges of its faces"""
+    faces = np.asarray(faces, dtype=np.int64)
+    edges = np.sort(faces[:, [0, 1, 1, 2, 2, 0]].reshape(-1, 2), axis=1)
+    _, uses = np.unique(edges[:, 0] * max(n_vertices, 1) + edges[:, 1], return_counts=True)
+    euler = n_vertices - len(uses) + len(faces)
+    return int(euler), max((2 - int(euler)) // 2, 0), int((uses != 2).sum())
+
+
+def surface_metrics(surf_dir, measures, surface='orig.nofix'):
+    from nibabel.freesurfer import read_geometry
+    for hemi in ('lh', 'rh'):
+        fname = join(surf_dir, '%s.%s' % (hemi, surface))
+        if not exists(fname):
+            continue
+        vertices, faces = read_geometry(fname)
+        euler, holes, nonmanifold = surface_topology(len(vertices), faces)
+        _measure(measures, hemi, hemi + 'EulerNumber', 'Euler number of %s.%s' % (hemi, surface),
+                 euler, 'unitless')
+        _measure(measures, hemi, hemi + 'DefectHoles', 'Holes of %s.%s from (2 - euler) / 2' % (hemi, surface),
+                 holes, 'unitless')
+        _measure(measures, hemi, hemi + 'NonManifoldEdges',
+                 'Edges of %s.%s not shared by exactly two faces' % (hemi, surface), nonmanifold, 'unitless')
+
+
+def subject_qc_metrics(subject_dir):
+    """[(structure, name, description, value, unit)] of a subject dir, the
+    metrics of missing inputs are left out"""
+    import nibabel as nib
+
+    mri = join(subject_dir, 'mri')
+    measures = []
+    aseg_img = nib.load(join(mri, 'aseg.mgz'))
+    aseg = np.asanyarray(aseg_img.dataobj)
+    if aseg.dtype.kind not in 'ui' or aseg.min() < 0:
+        aseg = aseg.astype(np.int64)
+    orig = np.asanyarray(nib.load(join(mri, 'orig.mgz')).dataobj)
+    norm_file = join(mri, 'norm.mgz')
+    norm = np.asanyarray(nib.load(norm_file).dataobj) if exists(norm_file) else orig
+
+    counts = tissue_metrics(orig, norm, aseg, measures)
+    del orig, norm
+    label_metrics(counts, float(np.prod(aseg_img.header.get_zooms()[:3])), measures)
+    del aseg
+    ribbon_file = join(mri, 'ribbon.mgz')
+    if exists(ribbon_file):
+        ribbon_metrics(np.asanyarray(nib.load(ribbon_file).dataobj), measures)
+    surface_metrics(join(subject_dir, 'surf'), measures)
+    return measures
+
+
+def _format_value(value):
+    if value == int(value):
+        return '%d' % value
+    return '%f' % value
+
+
+def write_qc_metrics_stats(fname, measures):
+    """Write measures as the header of a Freesurfer stats file
+
+    Measures that could not be computed (NaN) are left out, the stats
+    parser would store them as 0, a good score (e.g. the asymmetry of two
+    missing structures). They are missing in the subject json and NaN in
+    the cohort table instead.
+    """
+    lines = ['# Table of quantitative QC metrics ', '#',
+             '# generating_program fs_pipeline.qc_metrics']
+    for structure, name, description, value, unit in measures:
+        if value != value:
+            continue
+        lines.append('# Measure %s, %s, %s, %s, %s' % (structure, name, description,
+                                                        _format_value(value), unit))
+    with open(fname + '.tmp', 'w') as fp:
+        fp.write('\n'.join(lines) + '\n')
+    os.rename(fname + '.tmp', fname)
+    return fname
+
+
+def write_qc_metrics(subject_id, subjects_dir):
+    '''
+    Function to compute the quantitative QC metrics of a freesurfer subject
+    into stats/qcmetrics.stats
+
+    :arg
+        subject_id : subject id in subjects_dir
+        subjects_dir : freesurfer subjects dir
+
+    :return
+        path of the stats file
+    '''
+    import os
+    from fs_pipeline.qc_metrics import subject_qc_metrics, write_qc_metrics_stats, QC_METRICS_FILE
+
+    subject_dir = os.path.join(subjects_dir, subject_id)
+    return os.path.abspath(write_qc_metrics_stats(os.path.join(subject_dir, 'stats', QC_METRICS_FILE),
+                                                  subject_qc_metrics(subject_dir)))
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2023 Population Health Sciences, German Center for Neurodegenerative Diseases (DZNE)
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+Cohort outlier ranking to prioritise the manual QC of the snapshots.
+
+Key measures are read from the cohort stats store, volumes and areas are
+normalised by eTIV, and every measure is turned into a robust z-score
+(median and MAD over the cohort), zero volumes of absent structures
+included. Subjects are ranked by their largest
+absolute z-score; the rank is written to qcsnapshots/qc_rank.json of every
+subject whose ranking changed.
+"""
+
+import os
+import re
+import json
+import warnings
+from os.path import join, exists
+
+import numpy as np
+
+ETIV = 'aseg/etiv'
+
+# (column regex, normalise by eTIV)
+KEY_MEASURES = [
+    (r'^aseg/.*_volume_mm3$', True),
+    (r'^aseg/(?!etiv$)(?!.*_to_etiv$).*vol(notvent)?$', True),
+    (r'^aparc/[lr]h_.*_(grayvol|surfarea)$', True),
+    (r'^aparc/[lr]h_.*_thickavg$', False),
+    (r'^hippoSF/.*_whole_hippocampus$', True),
+]
+
+MAD_SCALE = 1.4826
+RANK_FILE = 'qc_rank.json'
+
+
+def key_measures(measures, key_measures=KEY_MEASURES):
+    """(column names, normalise flags) of the key measures out of measures"""
+    patterns = [(re.compile(p), norm) for p, norm in key_measures]
+    columns = []
+    normalise = []
+    for m in measures:
+        for p, norm in patterns:
+            if p.match(m):
+                columns.append(m)
+                normalise.append(norm)
+                break
+    return columns, np.array(normalise, dtype=bool)
+
+
+def robust_zscores(values):
+    """Column-wise (x - median) / (1.4826 * MAD), NaN aware; constant
+    columns give 0"""
+    with warnings.catch_warnings():
+        #all-NaN columns
+        warnings.simplefilter('ignore', RuntimeWarning)
+        median = np.nanmedian(values, axis=0)
+        mad = MAD_SCALE * np.nanmedian(np.abs(values - median), axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        z = (values - median) / mad
+    z[:, ~(mad > 0)] = 0.0
+    return z
+
+
+def score_cohort(store, subjects=None, threshold=3.5):
+    """Robust z-scores of the key measures of subjects (all in the store if None)
+
+    :return
+        dict with subjects, columns, z (subjects x columns), score (max |z|
+        per subject), n_outliers (|z| > threshold) and rank (1 = review first)
+    """
+    subjects = list(store.subjects) if subjects is None else list(subjects)
+    columns, normalise = key_measures(store.measures)
+    if not columns:
+        raise ValueError("None of the key QC measures are in the cohort stats store")
+
+    #NaN only if the subject lacks the stats file; a zero volume is an absent
+    #structure, usually a failed segmentation, and scored like any other value
+    values = store.get(subjects, columns)
+    if normalise.any():
+        if ETIV not in store.measures:
+            raise ValueError("%s is needed to normalise the QC measures" % ETIV)
+        etiv = store.measure(ETIV, subjects)
+        etiv[~(etiv > 0)] = np.nan
+        values[:, normalise] /= etiv[:, np.newaxis]
+
+    z = robust_zscores(values)
+    absz = np.abs(z)
+    absz[np.isnan(absz)] = 0.0
+    score = absz.max(axis=1) if len(columns) else np.zeros(len(subjects))
+    n_outliers = (absz > threshold).sum(axis=1)
+
+    order = np.lexsort((np.array(subjects, dtype=object).astype(str), -score))
+    rank = np.empty(len(subjects), dtype=int)
+    rank[order] = np.arange(1, len(subjects) + 1)
+    return {'subjects': subjects, 'columns': columns, 'z': z, 'score': score,
+            'n_outliers': n_outliers, 'rank': rank, 'threshold': threshold}
+
+
+def _worst(result, i, top=5):
+    z = result['z'][i]
+    absz = np.where(np.isnan(z), 0.0, np.abs(z))
+    worst = np.argsort(-absz, kind='mergesort')[:top]
+    return [(result['columns'][j], round(float(z[j]), 2)) for j in worst if absz[j] > 0]
+
+
+def write_review_list(result, fname, top=3):
+    """CSV of all subjects in review order"""
+    with open(fname + '.tmp', 'w') as fp:
+        fp.write('rank,subject,score,n_outliers,worst_measures\n')
+        for i in np.argsort(result['rank']):
+            worst = ' '.join('%s:%+.2f' % w for w in _worst(result, i, top))
+            fp.write('%d,%s,%.3f,%d,%s\n' % (result['rank'][i], result['subjects'][i],
+                                             result['score'][i], result['n_outliers'][i], worst))
+    os.rename(fname + '.tmp', fname)
+    return fname
+
+
+def write_subject_ranks(subjects_dir, result, top=5):
+    """Write <subject>/qcsnapshots/qc_rank.json, only where it changed
+
+    :return
+        subject ids whose rank file was (re)written
+    """
+    n = len(result['subjects'])
+    written = []
+    for i, subject_id in enumerate(result['subjects']):
+        rank = {'rank': int(result['rank'][i]), 'n_subjects': n,
+                'score': round(float(result['score'][i]), 3),
+                'n_outliers': int(result['n_outliers'][i]),
+                'threshold': result['threshold'],
+                'worst_measures': [[m, z] for m, z in _worst(result, i, top)]}
+        qc_dir = join(subjects_dir, subject_id, 'qcsnapshots')
+        fname = join(qc_dir, RANK_FILE)
+        if exists(fname):
+            try:
+                with open(fname) as fp:
+                    if json.load(fp) == rank:
+                        continue
+            except ValueError:
+                pass
+        if not exists(qc_dir):
+            os.makedirs(qc_dir)
+        with open(fname + '.tmp', 'w') as fp:
+            json.dump(rank, fp, indent=1)
+        os.rename(fname + '.tmp', fname)
+        written.append(subject_id)
+    return written
+
+
+def rank_cohort(subjects_dir, store, review_list=None, threshold=3.5):
+    """Score all subjects in the store, write the review list and the
+    changed per-subject ranks
+
+    :return
+        (score_cohort() result, subject ids with an updated rank file)
+    """
+    subjects = [s for s in store.subjects if exists(join(subjects_dir, s))]
+    result = score_cohort(store, subjects, threshold)
+    if review_list:
+        write_review_list(result, review_list)
+    return result, write_subject_ranks(subjects_dir, result)
@@ -28,9 +28,10 @@ from itertools import chain
 
 def create_anat_pipeline(scans_dir, work_dir, output_dir, subject_ids, nthreads, reconargs,
                         useT2=False, hsfsT1=False, hsfsT2=False, hsfsT1T2=False,
-                        wfname='fs_pipeline'):
+                        wfname='fs_pipeline', cohort_table=False):
 
-    fswf = create_fs_pipeline(scans_dir, subject_ids, work_dir, output_dir, nthreads, reconargs, useT2, hsfsT1, hsfsT2, hsfsT1T2, wfname)
+    fswf = create_fs_pipeline(scans_dir, subject_ids, work_dir, output_dir, nthreads, reconargs, useT2, hsfsT1, hsfsT2, hsfsT1T2, wfname,
+                              cohort_table)
     
     #fswf.inputs.inputnode.subject_ids = subject_ids
     
@@ -93,6 +94,11 @@ def main():
     
     parser.add_argument('-n', '--wfname', help='Pipeline workflow name, default fs_pipeline.', 
                         default='fs_pipeline')
+
+    parser.add_argument('-c', '--cohort-table', dest='cohort_table', action='store_true',
+                        help='Also collect the stats of all subjects of this run into '\
+                        '<outputdir>/cohort_stats_<wfname>.csv/.npy (see -n)', required=False, default=False)
+
     
     args = parser.parse_args()
     
@@ -153,7 +159,7 @@ def main():
 
     anat_pipeline = create_anat_pipeline(scans_dir, work_dir, output_dir, subject_ids,nthreads,
                                            reconargs, useT2, hsfsT1, hsfsT2, hsfsT1T2,
-                                           wfname=wfname)
+                                           wfname=wfname, cohort_table=args.cohort_table)
     
     # Visualize workflow
     if args.debug:
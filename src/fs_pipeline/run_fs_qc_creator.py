@@ -23,6 +23,9 @@ import argparse
 from itertools import chain
 
 from .fs_qc_creator import create_qc_wf
+from .subject_index import get_subject_index
+from .qc_batch import render_qc_batch, stale_subjects, benchmark_qc_encoders, STATUS_FILE
+from .image_encoders import ENCODERS
     
 def main():
     """
@@ -32,6 +35,8 @@ def main():
     epilogstr = 'Example-1: {prog}  -o ~/data/outsubjectsdir  ' \
                 '[--subjects [subjid1 subjid2...] ] -w ~/data/work [-j] [-z] \n' \
                 'nExample-2: {prog} -o ~/data/outputsubjectsdir  -w ~/data/work -p 10 '\
+                '\nExample-3: {prog} -o ~/data/outputsubjectsdir --batch -p 32 '\
+                '\nExample-4: {prog} -o ~/data/outputsubjectsdir --subjects subjid1 subjid2 --benchmark-encoders '\
                 '\n\n'
 
     parser = argparse.ArgumentParser(description=descr,
@@ -41,7 +46,7 @@ def main():
                                      RawTextHelpFormatter)
 
     parser.add_argument('-w', '--workdir', help='Processing directory where workflow data' \
-                        ' is processed for each subject.', required=True)
+                        ' is processed for each subject (not needed with --batch).', required=False)
 
     parser.add_argument('-o', '--outputdir', help='Freesurfer outputs direcroty (subjects_dir)',required=True)
 
@@ -51,6 +56,33 @@ def main():
         
     parser.add_argument('-p', '--processes', help='parallel processes', \
                         default=1, type=int)
+
+    parser.add_argument('-b', '--batch', action='store_true',
+                        help='Render directly with a pool of worker processes instead of a nipype '
+                        'workflow,\nthe status of each subject is written to %s in the outputdir.'
+                        % STATUS_FILE, required=False, default=False)
+
+    parser.add_argument('-g', '--gallery', nargs='?', const='qc_gallery', default=None,
+                        help='With --batch, also update the HTML gallery of the snapshots in this directory'
+                        '\n(default: <outputdir>/qc_gallery), see gallery_fs_qc.', required=False)
+
+    parser.add_argument('-t', '--timeout', type=int, default=1800,
+                        help='With --batch, seconds after which a subject without result (e.g. its worker'
+                        '\nwas killed for running out of memory) is reported as failed (default: 1800).',
+                        required=False)
+
+    parser.add_argument('-f', '--force', action='store_true',
+                        help='Re-create all snapshots, by default only those whose orig.mgz, aseg.mgz'
+                        '\nor rendering parameters changed since they were created.',
+                        required=False, default=False)
+
+    parser.add_argument('-e', '--encoder', choices=sorted(ENCODERS), default='png',
+                        help='Image encoder of the snapshots (default: png), png-fast is the quickest'
+                        '\nlossless one, jpeg and webp are the smallest.', required=False)
+
+    parser.add_argument('--benchmark-encoders', action='store_true',
+                        help='Only print the size and encoding time per subject of every encoder.',
+                        required=False, default=False)
     
         
     args = parser.parse_args()
@@ -64,26 +96,49 @@ def main():
     #explicity check for uuid like subjects and freesurfer output directory
     if args.subjects:
         subject_id_list = list(chain.from_iterable(args.subjects))
-        for subjid in subject_id_list:
-            subdir_list = os.listdir( os.path.join(output_dir, subjid))
-            if set(['mri', 'label','stats', 'surf']).issubset(subdir_list):
-                subject_ids.append(subjid)
-            else:
-                print("Warning: %s doesn't look like a Freesurfer output directory, skipped.\n" % subjid)
-  
     else:
         subject_id_list = [s.rstrip('/') for s in os.listdir(output_dir) if re.match(r'\w{8}-\w{4}-\w{4}-\w{4}-\w{12}', s)]
-        for subjid in subject_id_list:
-            subject_dir=os.path.join(output_dir, subjid)
-            if os.path.isdir(subject_dir):
-                subdir_list = os.listdir( subject_dir )
-                if set(['mri', 'label','stats', 'surf']).issubset(subdir_list):
-                    subject_ids.append(subjid)
-                else:
-                    print("Warning: %s doesn't look like a Freesurfer output directory, skipped.\n" % subjid) 
+    for subjid in subject_id_list:
+        if get_subject_index(output_dir, subjid).is_fs_subject():
+            subject_ids.append(subjid)
+        else:
+            print("Warning: %s doesn't look like a Freesurfer output directory, skipped.\n" % subjid)
                 
     if len(subject_ids) ==0:
-	raise ValueError("Error: No subject ids found in %s."% output_dir)
+        raise ValueError("Error: No subject ids found in %s."% output_dir)
+
+    snapshot_args = dict(num_slices=60, padd=4, spacing=3, image_extension=args.encoder, nrows=1)
+
+    if args.benchmark_encoders:
+        results = benchmark_qc_encoders(output_dir, subject_ids, **snapshot_args)
+        print('%-15s %15s %12s' % ('encoder', 'bytes/subject', 'ms/subject'))
+        for encoder, (size, ms) in sorted(results.items(), key=lambda r: r[1][1]):
+            print('%-15s %15d %12.0f' % (encoder, size, ms))
+        return
+
+    if args.batch:
+        gallery_dir = None
+        if args.gallery:
+            gallery_dir = os.path.join(output_dir, os.path.expanduser(args.gallery))
+        failed = render_qc_batch(output_dir, subject_ids, processes=args.processes,
+                                 force=args.force, gallery_dir=gallery_dir, timeout=args.timeout,
+                                 **snapshot_args)
+        for subjid in sorted(failed):
+            print("Warning: %s failed, %s" % (subjid, failed[subjid]))
+        print('Done FS QC Snapshots creation!!! (%d of %d subjects)'
+              % (len(subject_ids) - len(failed), len(subject_ids)))
+        return
+
+    if not args.workdir:
+        parser.error('-w/--workdir is required without --batch')
+
+    if not args.force:
+        n_subjects = len(subject_ids)
+        subject_ids = stale_subjects(output_dir, subject_ids, **snapshot_args)
+        print("%d of %d subjects have up to date snapshots." % (n_subjects - len(subject_ids), n_subjects))
+        if not subject_ids:
+            print('Done FS QC Snapshots creation!!!')
+            return
 
     work_dir = os.path.abspath(os.path.expanduser(args.workdir))
     if not os.path.exists(work_dir):
@@ -107,7 +162,8 @@ def main():
     logging.update_logging(config)
         
 
-    cwf = create_qc_wf(output_dir, subject_ids, work_dir, name="fs_qc_snapshot")
+    cwf = create_qc_wf(output_dir, subject_ids, work_dir, name="fs_qc_snapshot",
+                       image_extension=args.encoder)
      
     cwf.run(plugin='MultiProc',   plugin_args={'n_procs' : args.processes  } )
     
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+
+# Copyright 2023 Population Health Sciences, German Center for Neurodegenerative Diseases (DZNE)
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+
+from __future__ import print_function
+
+import os, sys
+import argparse
+from itertools import chain
+
+from .qc_gallery import update_gallery
+
+
+def main():
+    """
+    Command line wrapper for the QC snapshot gallery
+    """
+    descr = 'Thumbnails, tiles and a static HTML page of the QC snapshots of all subjects.'
+    epilogstr = 'Example-1: {prog} -o ~/data/outsubjectsdir -p 8 \n' \
+                'Example-2: {prog} -o ~/data/outsubjectsdir -g /shared/qc_gallery --subjects subjid1 subjid2\n\n'
+
+    parser = argparse.ArgumentParser(description=descr,
+                                     epilog=epilogstr.format(prog=os.path.basename\
+                                             (sys.argv[0])),\
+                                     formatter_class=argparse.\
+                                     RawTextHelpFormatter)
+
+    parser.add_argument('-o', '--outputdir', help='Freesurfer outputs directory (subjects_dir)', required=True)
+
+    parser.add_argument('--subjects', help='One or more subject IDs'\
+                        '(space separated), if omitted, all subjects with qcsnapshots in the outputdir.', \
+                        default=None, required=False, nargs='+', action='append')
+
+    parser.add_argument('-g', '--gallery', help='Gallery directory (default: <outputdir>/qc_gallery)',
+                        default=None, required=False)
+
+    parser.add_argument('--thumb-width', dest='thumb_width', help='Thumbnail width in pixels (default: 1200)',
+                        default=1200, type=int)
+
+    parser.add_argument('--tile-width', dest='tile_width', help='Full resolution tile width in pixels (default: 1024)',
+                        default=1024, type=int)
+
+    parser.add_argument('-f', '--force', action='store_true',
+                        help='Convert all snapshots again, by default only new or changed ones',
+                        required=False, default=False)
+
+    parser.add_argument('-p', '--processes', help='parallel processes', \
+                        default=1, type=int)
+
+    args = parser.parse_args()
+
+    output_dir = os.path.abspath(os.path.expanduser(args.outputdir))
+    if not os.path.exists(output_dir):
+        raise ValueError("Error. %s directory doesn't exist." % output_dir)
+
+    if args.subjects:
+        subject_ids = list(chain.from_iterable(args.subjects))
+    else:
+        subject_ids = sorted(s for s in os.listdir(output_dir)
+                             if os.path.isdir(os.path.join(output_dir, s, 'qcsnapshots')))
+
+    if len(subject_ids) == 0:
+        raise ValueError("Error: No subjects with QC snapshots found in %s." % output_dir)
+
+    gallery_dir = os.path.abspath(os.path.expanduser(args.gallery)) if args.gallery else None
+    updated, failed = update_gallery(output_dir, subject_ids, gallery_dir, processes=args.processes,
+                                     thumb_width=args.thumb_width, tile_width=args.tile_width,
+                                     force=args.force)
+    for subject_id in sorted(failed):
+        print("Warning: %s skipped, %s" % (subject_id, failed[subject_id]))
+
+    print('Updated %d of %d subjects in the gallery' % (len(updated), len(subject_ids)))
+    print('Done FS QC gallery!!!')
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+
+# Copyright 2023 Population Health Sciences, German Center for Neurodegenerative Diseases (DZNE)
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+
+from __future__ import print_function
+
+import os, sys
+import argparse
+from itertools import chain
+
+from .stats_aggregator import find_subjects
+from .stats_store import CohortStatsStore, update_store
+from .qc_ranking import rank_cohort
+
+
+def main():
+    """
+    Command line wrapper for ranking the subjects of a cohort for manual QC
+    """
+    descr = 'Rank the subjects of a cohort by how much their key stats deviate from the cohort, '\
+            'to decide which QC snapshots to review first.'
+    epilogstr = 'Example-1: {prog} -o ~/data/outsubjectsdir -p 10 \n' \
+                'Example-2: {prog} -o ~/data/outsubjectsdir -s ~/data/cohort_store --hsfs -t 3\n\n'
+
+    parser = argparse.ArgumentParser(description=descr,
+                                     epilog=epilogstr.format(prog=os.path.basename\
+                                             (sys.argv[0])),\
+                                     formatter_class=argparse.\
+                                     RawTextHelpFormatter)
+
+    parser.add_argument('-o', '--outputdir', help='Freesurfer outputs directory (subjects_dir)', required=True)
+
+    parser.add_argument('--subjects', help='One or more subject IDs'\
+                        '(space separated), if omitted, all subjects with a stats dir.', \
+                        default=None, required=False, nargs='+', action='append')
+
+    parser.add_argument('-s', '--store', help='Cohort stats store, default <outputdir>/cohort_store. '\
+                        'Subjects not yet in the store are parsed and added first.',
+                        default=None)
+
+    parser.add_argument('-l', '--review-list', dest='review_list',
+                        help='Ranked review list, default <outputdir>/qc_review_list.csv',
+                        default=None)
+
+    parser.add_argument('-f', '--hsfs', action='store_true', help='Also parse ?h.hippoSfVolumes*.txt files',
+                        required=False, default=False)
+
+    parser.add_argument('-t', '--threshold', help='|z| above which a measure counts as outlier', \
+                        default=3.5, type=float)
+
+    parser.add_argument('-p', '--processes', help='parallel processes', \
+                        default=1, type=int)
+
+    args = parser.parse_args()
+
+    output_dir = os.path.abspath(os.path.expanduser(args.outputdir))
+    if not os.path.exists(output_dir):
+        raise ValueError("Error. %s directory doesn't exist." % output_dir)
+
+    if args.subjects:
+        subject_ids = list(chain.from_iterable(args.subjects))
+    else:
+        subject_ids = find_subjects(output_dir)
+
+    store_dir = os.path.abspath(os.path.expanduser(args.store or os.path.join(output_dir, 'cohort_store')))
+    review_list = os.path.abspath(os.path.expanduser(args.review_list or
+                                                     os.path.join(output_dir, 'qc_review_list.csv')))
+
+    added, failed = update_store(store_dir, output_dir, subject_ids,
+                                 parse_hsfs=args.hsfs, processes=args.processes)
+    for subject_id, error in failed.items():
+        print("Warning: %s skipped, %s" % (subject_id, error))
+
+    store = CohortStatsStore(store_dir)
+    if len(store) == 0:
+        raise ValueError("Error: No subjects in the cohort stats store %s." % store_dir)
+
+    result, updated = rank_cohort(output_dir, store, review_list, args.threshold)
+
+    print('Added %d subjects, ranked %d subjects on %d measures, %d ranks changed'
+          % (len(added), len(result['subjects']), len(result['columns']), len(updated)))
+    print('Review list written to %s' % review_list)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
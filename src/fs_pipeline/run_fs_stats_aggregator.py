@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+
+# Copyright 2023 Population Health Sciences, German Center for Neurodegenerative Diseases (DZNE)
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+
+from __future__ import print_function
+
+import os, sys
+import argparse
+from itertools import chain
+
+from .stats_aggregator import aggregate_cohort, find_subjects
+from .parse_stats import StatsSelection
+from .stats_store import update_store
+
+
+def main():
+    """
+    Command line wrapper for aggregating the stats of a cohort
+    """
+    descr = 'Aggregate the Freesurfer stats of all subjects into one subjects x measures table.'
+    epilogstr = 'Example-1: {prog} -o ~/data/outsubjectsdir -p 10 \n' \
+                'Example-2: {prog} -o ~/data/outsubjectsdir --subjects subjid1 subjid2 ' \
+                '-t ~/data/cohort_stats --hsfs\n\n'
+
+    parser = argparse.ArgumentParser(description=descr,
+                                     epilog=epilogstr.format(prog=os.path.basename\
+                                             (sys.argv[0])),\
+                                     formatter_class=argparse.\
+                                     RawTextHelpFormatter)
+
+    parser.add_argument('-o', '--outputdir', help='Freesurfer outputs directory (subjects_dir)', required=True)
+
+    parser.add_argument('--subjects', help='One or more subject IDs'\
+                        '(space separated), if omitted, all subjects with a stats dir are aggregated.', \
+                        default=None, required=False, nargs='+', action='append')
+
+    parser.add_argument('-t', '--table', help='Output table path without extension, '\
+                        'default <outputdir>/cohort_stats. Writes .csv, .npy and _index.json',
+                        default=None)
+
+    parser.add_argument('-f', '--hsfs', action='store_true', help='Also parse ?h.hippoSfVolumes*.txt files',
+                        required=False, default=False)
+
+    parser.add_argument('-j', '--from-json', action='store_true', dest='from_json',
+                        help='Read the existing <subject>_stats.json files instead of parsing the stats files',
+                        required=False, default=False)
+
+    parser.add_argument('--select', help='Only aggregate the measures matching these '\
+                        'file:structure[:measure] patterns, e.g. aseg:eTIV aseg:Left-Hippocampus:Volume_mm3',
+                        default=None, required=False, nargs='+', action='append')
+
+    parser.add_argument('--topvars', action='store_true',
+                        help='Only aggregate the curated Parser.topVars header measures',
+                        required=False, default=False)
+
+    parser.add_argument('-r', '--rebuild', action='store_true',
+                        help='Re-parse all subjects instead of only new or changed ones',
+                        required=False, default=False)
+
+    parser.add_argument('-s', '--store', help='Also append new subjects to the queryable '\
+                        'cohort stats store in this directory (see fs_pipeline.stats_store)',
+                        default=None, required=False)
+
+    parser.add_argument('-p', '--processes', help='parallel processes', \
+                        default=1, type=int)
+
+    parser.add_argument('-b', '--batch-size', dest='batch_size', help='subjects per spooled row batch', \
+                        default=256, type=int)
+
+    args = parser.parse_args()
+
+    output_dir = os.path.abspath(os.path.expanduser(args.outputdir))
+    if not os.path.exists(output_dir):
+        raise ValueError("Error. %s directory doesn't exist." % output_dir)
+
+    if args.subjects:
+        subject_ids = list(chain.from_iterable(args.subjects))
+    else:
+        subject_ids = find_subjects(output_dir)
+
+    if len(subject_ids) == 0:
+        raise ValueError("Error: No subject ids found in %s." % output_dir)
+
+    selection = None
+    if args.topvars:
+        selection = StatsSelection.from_topvars().patterns
+    if args.select:
+        selection = (selection or []) + list(chain.from_iterable(args.select))
+
+    table = args.table or os.path.join(output_dir, 'cohort_stats')
+    table = os.path.abspath(os.path.expanduser(table))
+
+    outputs, failed = aggregate_cohort(output_dir, subject_ids, table,
+                                       processes=args.processes,
+                                       parse_hsfs=args.hsfs,
+                                       from_json=args.from_json,
+                                       batch_size=args.batch_size,
+                                       incremental=not args.rebuild,
+                                       selection=selection)
+
+    for subject_id, error in failed.items():
+        print("Warning: %s skipped, %s" % (subject_id, error))
+
+    print('Aggregated %d subjects into %s' % (len(subject_ids) - len(failed), ', '.join(outputs)))
+
+    if args.store:
+        store = os.path.abspath(os.path.expanduser(args.store))
+        added, failed = update_store(store, output_dir, subject_ids,
+                                     parse_hsfs=args.hsfs,
+                                     processes=args.processes,
+                                     selection=selection,
+                                     replace=args.rebuild,
+                                     batch_size=args.batch_size)
+        for subject_id, error in failed.items():
+            print("Warning: %s not added to the store, %s" % (subject_id, error))
+        print('Added %d subjects to the cohort stats store %s' % (len(added), store))
+    print('Done FS stats aggregation!!!')
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+
+# Copyright 2023 Population Health Sciences, German Center for Neurodegenerative Diseases (DZNE)
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+
+from __future__ import print_function
+
+import os, sys
+import argparse
+from itertools import chain
+
+from .stats_aggregator import find_subjects
+from .stats_compare import compare_runs
+
+
+def main():
+    """
+    Command line wrapper for comparing the stats of two runs
+    """
+    descr = 'Compare the Freesurfer stats of the same subjects in two runs, e.g. before and after a container rebuild.'
+    epilogstr = 'Example-1: {prog} -a ~/data/run_ref -b ~/data/run_new -p 8 \n' \
+                'Example-2: {prog} -a ~/data/run_ref -b ~/data/run_new --subjects subjid1 subjid2 ' \
+                '--rtol 1e-3 -o ~/data/diffs.csv\n\n' \
+                'Exits with 1 if any measure is outside the tolerance or missing in one run.\n'
+
+    parser = argparse.ArgumentParser(description=descr,
+                                     epilog=epilogstr.format(prog=os.path.basename\
+                                             (sys.argv[0])),\
+                                     formatter_class=argparse.\
+                                     RawTextHelpFormatter)
+
+    parser.add_argument('-a', '--reference', help='Reference run subjects_dir', required=True)
+
+    parser.add_argument('-b', '--test', help='Test run subjects_dir', required=True)
+
+    parser.add_argument('--subjects', help='One or more subject IDs'\
+                        '(space separated), if omitted, all subjects with a stats dir in both runs.', \
+                        default=None, required=False, nargs='+', action='append')
+
+    parser.add_argument('-f', '--hsfs', action='store_true', help='Also parse ?h.hippoSfVolumes*.txt files',
+                        required=False, default=False)
+
+    parser.add_argument('--parse', action='store_true',
+                        help='Parse the stats files even if <subject>_stats.json/.npz exist',
+                        required=False, default=False)
+
+    parser.add_argument('--rtol', help='relative tolerance', default=1e-4, type=float)
+
+    parser.add_argument('--atol', help='absolute tolerance', default=1e-6, type=float)
+
+    parser.add_argument('-n', '--top', help='worst offenders reported per measure class', \
+                        default=5, type=int)
+
+    parser.add_argument('-o', '--out', help='Write the per-measure differences to this csv file',
+                        default=None)
+
+    parser.add_argument('-p', '--processes', help='parallel processes', \
+                        default=1, type=int)
+
+    parser.add_argument('-c', '--chunk-size', dest='chunk_size', help='subjects compared at once', \
+                        default=128, type=int)
+
+    args = parser.parse_args()
+
+    reference_dir = os.path.abspath(os.path.expanduser(args.reference))
+    test_dir = os.path.abspath(os.path.expanduser(args.test))
+    for d in (reference_dir, test_dir):
+        if not os.path.exists(d):
+            raise ValueError("Error. %s directory doesn't exist." % d)
+
+    if args.subjects:
+        subject_ids = list(chain.from_iterable(args.subjects))
+    else:
+        ref_subjects = set(find_subjects(reference_dir))
+        test_subjects = set(find_subjects(test_dir))
+        for subject_id in sorted(ref_subjects ^ test_subjects):
+            print("Warning: %s is only in one of the runs" % subject_id)
+        subject_ids = sorted(ref_subjects & test_subjects)
+
+    if len(subject_ids) == 0:
+        raise ValueError("Error: No common subject ids found in %s and %s." % (reference_dir, test_dir))
+
+    comparison, failed = compare_runs(reference_dir, test_dir, subject_ids,
+                                      parse_hsfs=args.hsfs,
+                                      use_json=not args.parse,
+                                      rtol=args.rtol, atol=args.atol,
+                                      chunk_size=args.chunk_size,
+                                      processes=args.processes)
+
+    for subject_id, error in failed.items():
+        print("Warning: %s skipped, %s" % (subject_id, error))
+
+    print(comparison.report(args.top))
+    if args.out:
+        print('Per-measure differences written to %s' % comparison.write_csv(args.out))
+
+    n_failed = comparison.n_failed_measures()
+    if n_failed or failed:
+        print('%d measures differ between the runs' % n_failed)
+        return 1
+    print('All measures agree within tolerance')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+
+# Copyright 2023 Population Health Sciences, German Center for Neurodegenerative Diseases (DZNE)
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+
+from __future__ import print_function
+
+import os, sys
+import argparse
+import multiprocessing
+from itertools import chain
+
+from .stats_aggregator import find_subjects
+from .surface_stats import subject_surface_stats
+
+
+def _run_subject(args):
+    subjects_dir, subject_id, annots, use_cortex, overwrite = args
+    try:
+        return subject_id, subject_surface_stats(subjects_dir, subject_id, annots,
+                                                 use_cortex=use_cortex, overwrite=overwrite), None
+    except Exception as e:
+        return subject_id, [], '%s: %s' % (type(e).__name__, e)
+
+
+def main():
+    """
+    Command line wrapper for computing cortical parcellation stats without mris_anatomical_stats
+    """
+    descr = 'Compute ?h.aparc.<atlas>.stats parcellation tables from the surf and label files.'
+    epilogstr = 'Example-1: {prog} -o ~/data/outsubjectsdir -a HCP-MMP1 -p 10 \n' \
+                'Example-2: {prog} -o ~/data/outsubjectsdir --subjects subjid1 -a aparc.DKTatlas --overwrite\n\n'
+
+    parser = argparse.ArgumentParser(description=descr,
+                                     epilog=epilogstr.format(prog=os.path.basename\
+                                             (sys.argv[0])),\
+                                     formatter_class=argparse.\
+                                     RawTextHelpFormatter)
+
+    parser.add_argument('-o', '--outputdir', help='Freesurfer outputs directory (subjects_dir)', required=True)
+
+    parser.add_argument('--subjects', help='One or more subject IDs'\
+                        '(space separated), if omitted, all Freesurfer subjects in the outputdir.', \
+                        default=None, required=False, nargs='+', action='append')
+
+    parser.add_argument('-a', '--annot', help='One or more annotations, label/?h.<annot>.annot', \
+                        required=True, nargs='+', action='append')
+
+    parser.add_argument('--no-cortex', dest='no_cortex', action='store_true',
+                        help="Don't restrict the stats to ?h.cortex.label",
+                        required=False, default=False)
+
+    parser.add_argument('--overwrite', action='store_true',
+                        help='Replace existing stats tables', required=False, default=False)
+
+    parser.add_argument('-p', '--processes', help='parallel processes', \
+                        default=1, type=int)
+
+    args = parser.parse_args()
+
+    output_dir = os.path.abspath(os.path.expanduser(args.outputdir))
+    if not os.path.exists(output_dir):
+        raise ValueError("Error. %s directory doesn't exist." % output_dir)
+
+    if args.subjects:
+        subject_ids = list(chain.from_iterable(args.subjects))
+    else:
+        subject_ids = find_subjects(output_dir)
+
+    if len(subject_ids) == 0:
+        raise ValueError("Error: No subject ids found in %s." % output_dir)
+
+    annots = list(chain.from_iterable(args.annot))
+    tasks = [(output_dir, s, annots, not args.no_cortex, args.overwrite) for s in subject_ids]
+
+    n_written = 0
+    pool = multiprocessing.Pool(args.processes)
+    try:
+        for subject_id, written, error in pool.imap_unordered(_run_subject, tasks):
+            if error:
+                print("Warning: %s skipped, %s" % (subject_id, error))
+            n_written += len(written)
+        pool.close()
+        pool.join()
+    finally:
+        pool.terminate()
+
+    print('Wrote %d stats tables for %d subjects' % (n_written, len(subject_ids)))
+    print('Done FS surface stats!!!')
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -22,141 +22,275 @@ Created on Mon Dec  2 11:04:49 2019
 """
 import os
 
-def map_aseg2label(aseg):
-    import numpy
-    from .fs_colorlut import get_lut 
+def label_colormap(labels, lut_rgb=None):
+    '''
+    ListedColormap with the Freesurfer LUT colors of labels, entry i is the
+    color of labels[i]
+    '''
     import numpy as np
     import matplotlib.colors
+    from .fs_colorlut import get_lut_array
+
+    # dense freesurfer color lookup table, indexed by label id
+    lut_rgb = get_lut_array() if lut_rgb is None else lut_rgb
+    colors = lut_rgb[np.asarray(labels).astype(np.int64)].astype(float)
+    return matplotlib.colors.ListedColormap(colors / 255)
+
+
+def relabel_consecutive(aseg, labels=None):
     '''
-    Function to perform look-up table mapping of aseg.mgz data to label space (continue labels)
-    '''
-    labels=np.unique(aseg)
-    # retrieve freesurfer color map lookup table
-    cdict = get_lut()
-    colors = np.zeros((len(labels), 3))
-    mapped_aseg = np.zeros_like(aseg)
+    (sorted unique labels, aseg with every label replaced by its index in
+    labels) in the dtype of aseg. labels can be given if they are already
+    known, e.g. from scan_label_volume, and must include every label of aseg.
 
-    for idx, value in enumerate(labels):
-        mapped_aseg[aseg==value]=idx
-        r, g, b = cdict[str(value)]
-        colors[idx]=[r, g, b]
+    Non-negative integer labels are mapped with a single gather through an
+    index array over the label range, anything else with np.unique or
+    np.searchsorted.
+    '''
+    import numpy as np
 
-    colors = np.divide(colors ,255)
-    cmap = matplotlib.colors.ListedColormap(colors)
+    aseg = np.asarray(aseg)
+    if aseg.dtype.kind in 'ui' and aseg.size:
+        lo, hi = aseg.min(), aseg.max()
+        if lo >= 0 and hi < max(1 << 16, aseg.size) and (labels is None or labels[0] >= 0):
+            if labels is None:
+                present = np.zeros(int(hi) + 1, dtype=bool)
+                present[aseg] = True
+                labels = np.flatnonzero(present).astype(aseg.dtype)
+            index = np.zeros(max(int(hi), int(labels[-1])) + 1, dtype=aseg.dtype)
+            index[labels] = np.arange(len(labels))
+            return labels, index[aseg]
+    if labels is not None:
+        return labels, np.searchsorted(labels, aseg).astype(aseg.dtype)
+    labels, inverse = np.unique(aseg, return_inverse=True)
+    return labels, inverse.astype(aseg.dtype).reshape(aseg.shape)
+
+
+def scan_label_volume(dataobj, slab=32):
+    '''
+    Sorted unique labels and the per axis (first, last) index of the voxels
+    > 0 of a label volume, read in slabs along the last axis so that a
+    nibabel array proxy is never loaded as a whole.
+    '''
+    import numpy as np
 
-    return mapped_aseg,cmap
+    shape = dataobj.shape
+    present = np.zeros(1 << 16, dtype=bool)
+    other_labels = []
+    any0 = np.zeros(shape[0], dtype=bool)
+    any1 = np.zeros(shape[1], dtype=bool)
+    any2 = np.zeros(shape[2], dtype=bool)
+    for k in range(0, shape[2], slab):
+        block = np.asarray(dataobj[:, :, k:k + slab])
+        dtype = block.dtype
+        if dtype.kind in 'ui' and block.min() >= 0 and block.max() < len(present):
+            present[block] = True
+        else:
+            other_labels.append(np.unique(block))
+        mask = block > 0
+        any0 |= mask.any(axis=(1, 2))
+        any1 |= mask.any(axis=(0, 2))
+        any2[k:k + slab] = mask.any(axis=(0, 1))
+    if not any0.any():
+        raise ValueError("No labels > 0 in the label volume")
+
+    labels = np.flatnonzero(present).astype(dtype)
+    if other_labels:
+        labels = np.unique(np.concatenate([labels] + other_labels))
+    extent = [(int(np.argmax(a)), len(a) - 1 - int(np.argmax(a[::-1]))) for a in (any0, any1, any2)]
+    return labels, extent
+
+
+def nonzero_extent(img):
+    '''per axis (first, last) index of the voxels > 0 of img, from any() projections'''
+    import numpy as np
 
+    mask = np.asarray(img) > 0
+    if not mask.any():
+        raise ValueError("No voxels > 0 in the volume")
+    extent = []
+    for axis in range(mask.ndim):
+        proj = np.flatnonzero(mask.any(axis=tuple(a for a in range(mask.ndim) if a != axis)))
+        extent.append((int(proj[0]), int(proj[-1])))
+    return extent
 
 
 # calculates the bounding boxes of the 3 axes
-def bbox_3D(img,padd):
+def bbox_3D(img,padd,extent=None):
     import numpy as np
 
     min_shape=np.min(img.shape)
 
-    idx=np.where(img>0)
-    idx_min=max(np.min(idx),padd)
-    idx_max=min(np.max(idx),min_shape-padd)
+    extent = nonzero_extent(img) if extent is None else extent
+    idx_min=max(min(lo for lo, _ in extent),padd)
+    idx_max=min(max(hi for _, hi in extent),min_shape-padd)
 
     return idx_min,idx_max
 
-# creates the screenshotsof both original and overlay images. Supports both axial and sagittal views
-def save_slices_dual(slices_orig, slices_overlay, out_dir, suffix='',image_extension='png'):
-    import numpy as np
-    import matplotlib.image as mpimg
-    img_orig = mpimg.imread(slices_orig)
-    img_over = mpimg.imread(slices_overlay)
-    out_file = os.path.join(out_dir, 'img_%s.'% suffix +image_extension)
-    mpimg.imsave(out_file, np.concatenate((img_orig, img_over)),dpi=30)
-    #print ("Output %s is generated"%out_file)
-    return out_file
-        
-
-# this finction saves screenshots of the overlayed aseg+orig volumes in a sequence. Supports both axial and sagittal views
-def save_slices_overlay(orig_grid_path, aseg_grid_path, out_dir, suffix=''):
-    import matplotlib.image as mpimg    
-    img_orig = mpimg.imread(orig_grid_path)
-    img_aseg = mpimg.imread(aseg_grid_path)
-    out_file = os.path.join(out_dir, 'img_%s.png' % suffix)
-    mpimg.imsave(out_file, 0.3*img_orig+ 0.7 * img_aseg,dpi=30)
-    #print ("Output %s is generated"%out_file)
-    return out_file
-    
-    
-# this finction saves screenshots of the aseg or orig volumes in a grid layout (this sequence layout is a simpler version). Supports both axial and sagittal views
-def save_slices_grid(slices, cmap, out_dir, suffix='', rot_angle=0,order=3):
+
+def slices_mosaic(slices, rot_angle=0, order=3, nrows=1, spacing=0, dtype=None):
+    '''
+    Mosaic of equally sized 2D slices, row by row in an nrows x ceil(n / nrows)
+    grid, each slice rotated by rot_angle and surrounded by a border of
+    spacing zeros. Right angles are exact np.rot90 views, other angles are
+    interpolated with ndimage.rotate. The mosaic has the dtype of the slices
+    unless dtype is given.
+    '''
     import numpy as np
-    import matplotlib.image as mpimg
     from scipy import ndimage
 
-    out_file = os.path.join(out_dir,'img_%s.png' % suffix)
-    nrows = 1  # can be adjusted to support grid layout
-    ncols = int(float(len(slices)))  # can be adjusted to support grid layout
-    img = np.zeros((nrows,ncols),dtype=object)
-    grid = []
-    for i in range(nrows):
-        for j in range(ncols):
-                img[i,j] = ndimage.rotate(slices[i*ncols+j], rot_angle,order=order)
-        row = np.concatenate((img[i]), axis=1)
-        grid.append(row)
-    grid = np.concatenate((grid), axis=0)
-    if "aseg" in suffix:
-        mpimg.imsave(out_file, grid, cmap=cmap, vmin=0 ,vmax=int(np.max(grid)),dpi=30)
+    dtype = dtype or slices[0].dtype
+    if rot_angle % 90 == 0:
+        k = int(rot_angle // 90) % 4
+        rotate = lambda img: np.rot90(img, k)
     else:
-        mpimg.imsave(out_file, grid, cmap=cmap,dpi=30)
-    #print ("Output %s is generated"%out_file)
-    return out_file
+        rotate = lambda img: ndimage.rotate(np.asarray(img, dtype=dtype), rot_angle, order=order)
 
-#################################################################
-########     The highest level function to be called      #######
-######## arguments:
-######## 1. path to orig file                             #######
-######## 2. path to aseg file                             #######
-######## 3. output path, in which the screenshots will be put  ##
-######## 4. number of steps between sclices in each axis  ####### 
-#################################################################    
-def create_mri_screenshots(path_orig, path_aseg, out_dir,subject_id,
-                           num_slices=60,padd=4,spacing=3,image_extension='png'):
+    nrows = max(1, min(int(nrows), len(slices)))
+    ncols = -(-len(slices) // nrows)
+    rotated = [rotate(img) for img in slices]
+    h, w = rotated[0].shape[0] + 2 * spacing, rotated[0].shape[1] + 2 * spacing
+    grid = np.zeros((nrows * h, ncols * w), dtype=dtype)
+    for n, img in enumerate(rotated):
+        i, j = divmod(n, ncols)
+        grid[i * h + spacing:i * h + h - spacing, j * w + spacing:j * w + w - spacing] = img
+    return grid
+
+
+# the snapshots are composited in memory: RGBA uint8 arrays as mpimg.imsave
+# would encode them, and read back as by mpimg.imread, so that only the final
+# dual image has to be written
+_roundtrip_tables = {}
+
+
+def rgba_image(img, cmap=None, vmin=None, vmax=None, block=4096):
     '''
-    Function to create axial and sagittal screenshoots from the freesurfer mri outputs.
-    The screenshot is generated from a crop volume containing only aseg labels
+    RGBA uint8 image as mpimg.imsave encodes img; 2D images are color mapped
+    in blocks of columns to keep the float temporaries small
+    '''
+    import numpy as np
+    import matplotlib.cm
 
-    :arg
-        path_orig : path to the orig.mgz volume from the freesurfer output
-        path_aseg : path to the aseg.mgz volume from the freesurfer output
-        out_dir   : directory path for storing the generated screenshoots
-        num_slices(int) : The number of slices to be plot for each cross-sectional plane (default : 60)
-        padd (int) : number of extra slices to add in each direction of a crop aseg volume. (default : 4)
-        spacing(int) : include spacing between  plot images (default : 3)
-        image_extension ('jpep','png') : type of image to be created (default : png)
+    sm = matplotlib.cm.ScalarMappable(cmap=cmap)
+    if img.ndim != 2:
+        sm.set_clim(vmin, vmax)
+        return sm.to_rgba(img, bytes=True)
+    sm.set_clim(img.min() if vmin is None else vmin, img.max() if vmax is None else vmax)
+    rgba = np.empty(img.shape + (4,), dtype=np.uint8)
+    for j in range(0, img.shape[1], block):
+        rgba[:, j:j + block] = sm.to_rgba(img[:, j:j + block], bytes=True)
+    return rgba
 
-    :return
-        None
+
+def decoded_image(rgba):
+    import numpy as np
+    return np.divide(rgba, 255, dtype=np.float32)
+
+
+def _roundtrip_table(name):
+    '''
+    Byte lookup tables of the PNG round trips: 'decode' maps a byte to its
+    value after decoding and re-encoding, 'blend' maps an (orig, aseg) byte
+    pair to the encoded 0.3/0.7 blend of their decoded values
     '''
+    import numpy as np
 
-    import os
-    import nibabel as nib
-    import numpy as np    
-    from fs_pipeline.screenshot import (map_aseg2label,bbox_3D,save_slices_dual,save_slices_overlay,save_slices_grid)
+    if name not in _roundtrip_tables:
+        values = np.arange(256, dtype=np.uint8)
+        if name == 'decode':
+            table = rgba_image(decoded_image(values).reshape(-1, 1, 4)).reshape(256)
+        else:
+            a, b = np.meshgrid(values, values, indexing='ij')
+            blend = 0.3 * decoded_image(a) + 0.7 * decoded_image(b)
+            table = rgba_image(blend.reshape(-1, 1, 4)).reshape(256, 256)
+        _roundtrip_tables[name] = table
+    return _roundtrip_tables[name]
 
-    out_dir=os.path.join(out_dir,subject_id, 'qcsnapshots')
 
-    if not os.path.exists(out_dir):
-        os.makedirs(out_dir) 
+def render_slices_grid(slices, cmap, rot_angle=0, order=3, label_map=False, nrows=1, spacing=0):
+    import numpy as np
+
+    grid = slices_mosaic(slices, rot_angle, order, nrows, spacing, dtype=np.float64)
+    if label_map:
+        return rgba_image(grid, cmap, vmin=0, vmax=int(np.max(grid)))
+    return rgba_image(grid, cmap)
+
+
+def render_slices_overlay(orig_rgba, aseg_rgba):
+    return _roundtrip_table('blend')[orig_rgba, aseg_rgba]
+
+
+def render_slices_dual(orig_rgba, overlay_rgba):
+    import numpy as np
+    return _roundtrip_table('decode')[np.concatenate((orig_rgba, overlay_rgba))]
 
-    #load original image from file
+
+# RGBA colors of the surface contour mask values (surface_contours.SURFACES)
+SURFACE_COLORS = ((1, (255, 255, 0, 255)), (2, (255, 0, 0, 255)))
+
+
+def plane_slice(volume, axis, index):
+    '''2D slice of a conformed (LIA) volume, coronal slices are transposed
+    to have superior up'''
+    img = volume[(slice(None),) * axis + (index,)]
+    return img.T if axis == 2 else img
+
+
+def snapshot_file(out_dir, plane, image_extension='png'):
+    '''path of the dual image of a plane, image_extension is an encoder of
+    fs_pipeline.image_encoders'''
+    from .image_encoders import encoder_extension
+    return os.path.join(out_dir, 'img_dual_%s.%s' % (plane, encoder_extension(image_extension)))
+
+
+def render_plane_snapshot(slices_orig, slices_aseg, cmap, rot_angle=0, nrows=1, spacing=0,
+                          contour_slices=None):
+    '''
+    Render the gray, label and overlay mosaics of a plane in memory. Surface
+    contour masks, if given, are drawn on the gray mosaic.
+
+    :return
+        RGBA uint8 dual image (gray mosaic above the overlay)
+    '''
+    img_orig = render_slices_grid(slices_orig, "gray", rot_angle, order=3,
+                                  nrows=nrows, spacing=spacing)
+    img_aseg = render_slices_grid(slices_aseg, cmap, rot_angle, order=0, label_map=True,
+                                  nrows=nrows, spacing=spacing)
+    img_over = render_slices_overlay(img_orig, img_aseg)
+    if contour_slices is not None:
+        contours = slices_mosaic(contour_slices, rot_angle, 0, nrows, spacing)
+        for value, color in SURFACE_COLORS:
+            img_orig[contours == value] = color
+    return render_slices_dual(img_orig, img_over)
+
+
+def subject_plane_renderer(path_orig, path_aseg, num_slices=60, padd=4, spacing=3, nrows=1,
+                           coronal=True, surfaces=True):
+    '''
+    Read the cropped volumes and surfaces of a subject once for all its
+    snapshots, see create_mri_screenshots for the arguments
+
+    :return
+        (planes, render): the plane names and a function returning the RGBA
+        dual image of a plane. The shared arrays are only read, so render
+        can run for several planes in threads at once.
+    '''
+    import nibabel as nib
+    import numpy as np
+    from .surface_contours import SurfaceContours
+
+    # the volumes are only accessed through their array proxies: the aseg is
+    # scanned in slabs for its labels and bounding box, then only the crop is
+    # read, in the stored dtype
     orig = nib.load(path_orig)
-    orig_data = orig.get_data()
-    
-    #load aseg image from file
     aseg = nib.load(path_aseg)
-    aseg_data = aseg.get_data()
 
-    #map aseg labels to a continue label space and extract cmap colors
-    aseg_map,cmap=map_aseg2label(aseg_data)
+    #labels of the whole aseg, for a continue label space and the cmap colors
+    labels, extent = scan_label_volume(aseg.dataobj)
+    cmap = label_colormap(labels)
     
     # calculate bounding boxes of the volume
-    idx_min,idx_max=bbox_3D(aseg_data,padd)
+    idx_min,idx_max=bbox_3D(aseg.dataobj,padd,extent)
 
 
     #Add Padd slices to the bouding box
@@ -166,93 +300,190 @@ def create_mri_screenshots(path_orig, path_aseg, out_dir,subject_id,
     idx_max += padd
 
     #Calculate new volume size and asign values
-    size=idx_max-idx_min
+    idx_min, idx_max = int(idx_min), int(idx_max)
+    crop = np.s_[idx_min:idx_max, idx_min:idx_max, idx_min:idx_max]
+
+    new_orig = np.asanyarray(orig.dataobj[crop])
+    _, new_aseg = relabel_consecutive(aseg.dataobj[crop], labels)
+
+    # white and pial surfaces in the voxel grid of the crop
+    contours = None
+    if surfaces:
+        contours = SurfaceContours(path_orig, offset=idx_min)
+        if len(contours) == 0:
+            contours = None
+
+    # (plane, slicing axis, rotation) of the views, slices are taken between
+    # the label extent of each axis, from one projection per axis
+    labels_extent=nonzero_extent(new_aseg)
+    planes = [('sagittal', 0, 0), ('axial', 1, 90)]
+    if coronal:
+        planes.append(('coronal', 2, 0))
+
+    plane_axes = dict((plane, (axis, rot_angle)) for plane, axis, rot_angle in planes)
+
+    def render(plane):
+        axis, rot_angle = plane_axes[plane]
+        # Extract Starting and finish point of the plane
+        start=max(labels_extent[axis][0]-padd//2,0)
+        finish=min(labels_extent[axis][1]+padd//2,new_aseg.shape[axis])
+        plane_idx=[int(i) for i in np.round(np.linspace(start,finish,num_slices))[:-1]]
+
+        slices_orig = [plane_slice(new_orig, axis, i) for i in plane_idx]
+        slices_aseg = [plane_slice(new_aseg, axis, i) for i in plane_idx]
+        contour_slices = None
+        if contours is not None:
+            shape = [n for a, n in enumerate(new_orig.shape) if a != axis]
+            contour_slices = [contours.slice_mask(axis, i, shape) for i in plane_idx]
+            if axis == 2:
+                contour_slices = [mask.T for mask in contour_slices]
+
+        return render_plane_snapshot(slices_orig, slices_aseg, cmap, rot_angle,
+                                     nrows=nrows, spacing=spacing,
+                                     contour_slices=contour_slices)
+
+    return [plane for plane, _, _ in planes], render
+
+
+def render_subject_planes(path_orig, path_aseg, **kwargs):
+    '''
+    Generator of the (plane, RGBA dual image) snapshots of a subject, one
+    after another, kwargs as for subject_plane_renderer
+    '''
+    planes, render = subject_plane_renderer(path_orig, path_aseg, **kwargs)
+    for plane in planes:
+        yield plane, render(plane)
 
 
-    idx_max = idx_min+size
+# sidecar manifest in qcsnapshots/, the snapshots are up to date as long as
+# the inputs (mtime, size of orig, aseg and the surfaces) and the rendering
+# parameters did not change
+SNAPSHOT_VERSION = 2
+SNAPSHOT_MANIFEST = 'qc_snapshots.json'
 
-    spacing_size=size+2*spacing
 
-    new_orig=np.zeros(shape=(size,size,size))
-    new_aseg=np.zeros(shape=(size,size,size))
+def snapshot_params(num_slices=60, padd=4, spacing=3, image_extension='png', nrows=1,
+                    coronal=True, surfaces=True):
+    return {'num_slices': int(num_slices), 'padd': int(padd), 'spacing': int(spacing),
+            'image_extension': str(image_extension), 'nrows': int(nrows),
+            'coronal': bool(coronal), 'surfaces': bool(surfaces)}
 
-    new_orig[:,:,:]=orig_data[int(idx_min):int(idx_max),int(idx_min):int(idx_max),int(idx_min):int(idx_max)]
-    new_aseg[:,:,:]=aseg_map[int(idx_min):int(idx_max),int(idx_min):int(idx_max),int(idx_min):int(idx_max)]
 
-    
+def _file_stamp(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_mtime, st.st_size]
+
+
+def snapshot_manifest(path_orig, path_aseg, outputs=(), **params):
+    params = snapshot_params(**params)
+    for path in (path_orig, path_aseg):
+        os.stat(path)
+    inputs = {'orig': _file_stamp(path_orig), 'aseg': _file_stamp(path_aseg)}
+    if params['surfaces']:
+        from .surface_contours import surface_files
+        for (hemi, surf), path in surface_files(path_orig).items():
+            inputs['%s.%s' % (hemi, surf)] = _file_stamp(path)
+    return {'version': SNAPSHOT_VERSION, 'inputs': inputs, 'params': params,
+            'outputs': sorted(os.path.basename(o) for o in outputs)}
+
+
+def write_snapshot_manifest(qc_dir, path_orig, path_aseg, outputs, **params):
+    import json
+    fname = os.path.join(qc_dir, SNAPSHOT_MANIFEST)
+    with open(fname + '.tmp', 'w') as fp:
+        json.dump(snapshot_manifest(path_orig, path_aseg, outputs, **params), fp, indent=1)
+    os.rename(fname + '.tmp', fname)
+    return fname
 
-    #Plot sagittal images
-    # stack sagittal slices
-    slices_orig = []
-    slices_aseg = []
-    #Extract Starting and finish point for the sagittal plane
-    sagittal_labels_idx=np.where(new_aseg>0)
-    sagittal_start=max(np.min(sagittal_labels_idx[0])-padd//2,0)
-    sagittal_finish=min(np.max(sagittal_labels_idx[0])+padd//2,new_aseg.shape[0])
-
-    sagittal_idx=np.round(np.linspace(sagittal_start,sagittal_finish,num_slices))
-
-    for i in sagittal_idx[:-1]:
-        slice=int(i)
-        aseg_slice=np.zeros((spacing_size,spacing_size))
-        orig_slice=np.zeros((spacing_size,spacing_size))
-
-        aseg_slice[spacing:-spacing,spacing:-spacing]=new_aseg[slice, :, :]
-        orig_slice[spacing:-spacing, spacing:-spacing] =new_orig[slice, :, :]
-
-        slices_aseg.append(aseg_slice)
-        slices_orig.append(orig_slice)
-
-    # create screenshots for sagittal view
-    img_orig = save_slices_grid(slices_orig, "gray", out_dir, 'orig_sagittal', 0,order=3)
-    img_aseg = save_slices_grid(slices_aseg, cmap, out_dir, 'aseg_sagittal', 0,order=0,)
-    img_over = save_slices_overlay(img_orig, img_aseg, out_dir, 'overlay_sagittal')
-    save_slices_dual(img_orig, img_over, out_dir, "dual_sagittal",image_extension=image_extension)
-    
-    # remove intermediate files to save space 
-    os.remove(img_orig)
-    #print ("File %s is removed"%img_orig)
-    os.remove(img_aseg)
-    #print ("File %s is removed"%img_aseg)
-    os.remove(img_over)
-    #print ("File %s is removed"%img_over)
-    
-    # stack axial slices 
-    slices_orig = []
-    slices_aseg = []
-    # Extract Starting and finish point for the axial plane
-    axial_labels_idx=np.where(new_aseg>0)
-    axial_start=max(np.min(axial_labels_idx[1])-padd//2,0)
-    axial_finish=min(np.max(axial_labels_idx[1])+padd//2,new_aseg.shape[1])
-    axial_idx=np.round(np.linspace(axial_start,axial_finish,num_slices))
-
-    for i in axial_idx[:-1]:
-        slice=int(np.floor(i))
-        aseg_slice = np.zeros((spacing_size, spacing_size))
-        orig_slice = np.zeros((spacing_size, spacing_size))
-        aseg_slice[spacing:-spacing,spacing:-spacing] = new_aseg[:, slice, :]
-        orig_slice[spacing:-spacing,spacing:-spacing] = new_orig[:, slice, :]
-        slices_aseg.append(aseg_slice)
-        slices_orig.append(orig_slice)
-
-    # create screenshots for axial view
-    img_orig = save_slices_grid(slices_orig, "gray", out_dir, 'orig_axial',90,order=3,)
-    img_aseg = save_slices_grid(slices_aseg, cmap, out_dir, 'aseg_axial',90,order=0,)
-    img_over = save_slices_overlay(img_orig, img_aseg, out_dir, 'overlay_axial')
-    save_slices_dual(img_orig, img_over, out_dir, "dual_axial",image_extension=image_extension)
-    
-    # remove intermediate files to save space 
-    os.remove(img_orig)
-    #print ("File %s is removed"%img_orig)
-    os.remove(img_aseg)
-    #print ("File %s is removed"%img_aseg)
-    os.remove(img_over)
-    #print ("File %s is removed"%img_over)
 
-    del cmap ,orig,new_orig,aseg, aseg_map, new_aseg
+def snapshots_up_to_date(qc_dir, path_orig, path_aseg, **params):
+    '''
+    True if the manifest in qc_dir matches the current inputs and parameters
+    and all the snapshots it lists exist
+    '''
+    import json
+    try:
+        with open(os.path.join(qc_dir, SNAPSHOT_MANIFEST)) as fp:
+            recorded = json.load(fp)
+        current = snapshot_manifest(path_orig, path_aseg, **params)
+    except (IOError, OSError, ValueError):
+        return False
+    for key in ('version', 'inputs', 'params'):
+        if recorded.get(key) != current[key]:
+            return False
+    outputs = recorded.get('outputs') or []
+    return len(outputs) > 0 and all(os.path.exists(os.path.join(qc_dir, o)) for o in outputs)
 
-    dual_sagittal = os.path.abspath(out_dir + "dual_sagittal" + image_extension)
-    dual_axial = os.path.abspath(out_dir + "dual_axial" + image_extension)
 
-    return dual_sagittal,dual_axial
+#################################################################
+########     The highest level function to be called      #######
+######## arguments:
+######## 1. path to orig file                             #######
+######## 2. path to aseg file                             #######
+######## 3. output path, in which the screenshots will be put  ##
+######## 4. number of steps between sclices in each axis  ####### 
+#################################################################    
+def create_mri_screenshots(path_orig, path_aseg, out_dir,subject_id,
+                           num_slices=60,padd=4,spacing=3,image_extension='png',nrows=1,
+                           coronal=True,surfaces=True):
+    '''
+    Function to create axial, sagittal and coronal screenshoots from the freesurfer mri outputs.
+    The screenshot is generated from a crop volume containing only aseg labels, the white
+    (yellow) and pial (red) surface contours are drawn on the orig slices.
+
+    :arg
+        path_orig : path to the orig.mgz volume from the freesurfer output
+        path_aseg : path to the aseg.mgz volume from the freesurfer output
+        out_dir   : directory path for storing the generated screenshoots
+        num_slices(int) : The number of slices to be plot for each cross-sectional plane (default : 60)
+        padd (int) : number of extra slices to add in each direction of a crop aseg volume. (default : 4)
+        spacing(int) : include spacing between  plot images (default : 3)
+        image_extension (str) : image encoder, 'png', 'png-fast', 'png-small', 'png-palette',
+                                'jpeg', 'jpeg-small', 'webp', ... see
+                                fs_pipeline.image_encoders.ENCODERS (default : png)
+        nrows(int) : number of rows of the slice grid of each plane (default : 1)
+        coronal(bool) : also create the coronal view (default : True)
+        surfaces(bool) : draw the surf/?h.white and ?h.pial contours if they exist (default : True)
+
+    :return
+        paths of the sagittal, axial and coronal (None without coronal) dual images
+    '''
+
+    import os
+    from multiprocessing.pool import ThreadPool
+    from fs_pipeline.screenshot import (subject_plane_renderer,snapshot_file,
+                                        write_snapshot_manifest)
+    from fs_pipeline.image_encoders import encode_image
+
+    out_dir=os.path.abspath(os.path.join(out_dir,subject_id, 'qcsnapshots'))
+
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir) 
 
+    planes, render = subject_plane_renderer(path_orig, path_aseg, num_slices, padd, spacing,
+                                            nrows, coronal, surfaces)
+
+    def _snapshot(plane):
+        return encode_image(render(plane), snapshot_file(out_dir, plane, image_extension),
+                            image_extension)
+
+    # the planes are rendered and encoded concurrently, numpy, scipy and
+    # the encoders release the GIL for the bulk of the work
+    pool = ThreadPool(len(planes))
+    try:
+        snapshot_files = pool.map(_snapshot, planes)
+        pool.close()
+        pool.join()
+    finally:
+        pool.terminate()
+
+    write_snapshot_manifest(out_dir, path_orig, path_aseg, snapshot_files,
+                            num_slices=num_slices, padd=padd, spacing=spacing,
+                            image_extension=image_extension, nrows=nrows,
+                            coronal=coronal, surfaces=surfaces)
+
+    snapshots = dict(zip(planes, snapshot_files))
+    return snapshots['sagittal'], snapshots['axial'], snapshots.get('coronal')
@@ -0,0 +1,331 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2023 Population Health Sciences, German Center for Neurodegenerative Diseases (DZNE)
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+In-process replacement for mri_segstats --seg --pv [--i] --id ... --sum.
+
+NVoxels and the intensity stats come from bincounts over the segmentation.
+Volume_mm3 with a partial volume file reproduces Freesurfer's
+MRIvoxelsInLabelWithPartialVolumeEffects: voxels on either side of the
+6-connected label border get the fraction of the label they contain,
+estimated from the label means in the 15^3 neighbourhood, everything is
+accumulated in single precision in the same voxel order. Neighbourhood
+counts and sums are read from integral images instead of being summed per
+voxel.
+"""
+
+import time
+from collections import OrderedDict
+
+import numpy as np
+import nibabel as nb
+
+#labels at or above are ignored in the neighbourhoods, as MAX_CMA_LABELS in cma.h
+MAX_CMA_LABELS = 14176
+PV_WHALF = 7
+_MARGIN = PV_WHALF + 1
+
+_NBR_OFFSETS = np.array([(i, j, k) for i in (-1, 0, 1) for j in (-1, 0, 1) for k in (-1, 0, 1)])
+
+
+def load_volume(fname, dtype=None):
+    """(data, voxel volume in mm^3) of an image, read through the array proxy
+    in its stored type unless dtype is given"""
+    img = nb.load(fname)
+    data = np.asanyarray(img.dataobj)
+    if dtype is not None:
+        data = data.astype(dtype, copy=False)
+    zooms = np.asarray(img.header.get_zooms()[:3], dtype=np.float32)
+    return data, np.float32(zooms[0] * zooms[1] * zooms[2])
+
+
+def label_border(mask):
+    """6-connected border voxels on both sides of a label mask, voxels at the
+    volume edge are only compared with their in-volume neighbours"""
+    padded = np.pad(mask, 1, mode='edge')
+    center = padded[1:-1, 1:-1, 1:-1]
+    border = np.zeros(mask.shape, dtype=bool)
+    for axis in range(3):
+        for start in (0, 2):
+            sl = [slice(1, -1)] * 3
+            sl[axis] = slice(start, start + mask.shape[axis])
+            border |= padded[tuple(sl)] != center
+    return border
+
+
+def _integral(a, dtype):
+    out = np.zeros(tuple(s + 1 for s in a.shape), dtype=dtype)
+    out[1:, 1:, 1:] = a.cumsum(0, dtype=dtype).cumsum(1, dtype=dtype).cumsum(2, dtype=dtype)
+    return out
+
+
+def _box_sums(integral, lo, width):
+    x0, y0, z0 = lo.T
+    x1, y1, z1 = x0 + width, y0 + width, z0 + width
+    return (integral[x1, y1, z1] - integral[x0, y1, z1] - integral[x1, y0, z1]
+            - integral[x1, y1, z0] + integral[x0, y0, z1] + integral[x0, y1, z0]
+            + integral[x1, y0, z0] - integral[x0, y0, z0])
+
+
+def partial_volume(padded_seg, padded_vals, label, shape, voxel_volume):
+    """Partial volume corrected volume of label
+
+    padded_seg and padded_vals are the segmentation and the partial volume
+    intensities padded by PV_WHALF + 1 voxels in 'edge' mode, which gives
+    the same neighbourhoods as Freesurfer's clamped voxel indices.
+    """
+    m = _MARGIN
+    core = padded_seg[m:-m, m:-m, m:-m]
+    coords = np.nonzero(core == label)
+    if len(coords[0]) == 0:
+        return 0.0
+    r0 = np.maximum([c.min() - 1 for c in coords], 0)
+    r1 = np.minimum([c.max() + 2 for c in coords], shape)
+    n = r1 - r0
+
+    crop = tuple(slice(a, b + 2 * m) for a, b in zip(r0, r1))
+    seg = padded_seg[crop]
+    vals = padded_vals[crop]
+    in_label = seg == label
+
+    region = tuple(slice(m, m + k) for k in n)
+    border = label_border(in_label[tuple(slice(m - 1, m + k + 1) for k in n)])
+    border = border[1:-1, 1:-1, 1:-1]
+    inside = in_label[region]
+
+    voxel_volume = np.float32(voxel_volume)
+    contrib = np.zeros(n, dtype=np.float32)
+    contrib[inside & ~border] = voxel_volume
+
+    b = np.transpose(np.nonzero(border)) + m
+    if len(b):
+        nbrs = seg[tuple((b[:, np.newaxis, :] + _NBR_OFFSETS).transpose(2, 0, 1))]
+        valid = (nbrs >= 0) & (nbrs < MAX_CMA_LABELS)
+        candidates = np.unique(nbrs[valid])
+        val = vals[tuple(b.T)].astype(np.float32)
+        lo = b - PV_WHALF
+        width = 2 * PV_WHALF + 1
+
+        def _means(c):
+            mask = seg == c
+            counts = _box_sums(_integral(mask, np.int32), lo, width)
+            sums = _box_sums(_integral(np.where(mask, vals, 0), np.float64), lo, width)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                means = sums.astype(np.float32) / counts.astype(np.float32)
+            return counts, means
+
+        _, mean_label = _means(label)
+        max_count = np.zeros(len(b), dtype=np.int64)
+        mean_nbr = np.zeros(len(b), dtype=np.float32)
+        has_nbr = np.zeros(len(b), dtype=bool)
+        for c in candidates:
+            if c == label:
+                continue
+            is_nbr = (nbrs == c).any(axis=1)
+            counts, means = _means(c)
+            with np.errstate(invalid='ignore'):
+                better = is_nbr & (counts > max_count) & ((means - val) * (mean_label - val) < 0)
+            #Freesurfer keeps the (truncated) mean, not the count, as the running maximum
+            max_count[better] = means[better].astype(np.int64)
+            mean_nbr[better] = means[better]
+            has_nbr |= better
+
+        inside_b = in_label[tuple(b.T)]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            pv = (val - mean_nbr) / (mean_label - mean_nbr)
+        pv = np.minimum(pv, np.float32(1))
+        volume = np.where(has_nbr, voxel_volume * pv, voxel_volume).astype(np.float32)
+        volume[(~inside_b & ~has_nbr) | (has_nbr & (pv < 0))] = 0
+        contrib[tuple((b - m).T)] = volume
+
+    #sequential single precision sum in Freesurfer's x, y, z loop order
+    return float(np.cumsum(contrib.ravel(), dtype=np.float32)[-1])
+
+
+def compute_segstats(seg, segment_ids, voxel_volume, pv_vals=None, in_vals=None):
+    """Stats of the segment_ids labels of seg
+
+    :return
+        list of OrderedDicts with SegId, NVoxels, Volume_mm3 and, with
+        in_vals, Mean, StdDev, Min, Max and Range over the label voxels
+    """
+    segment_ids = [int(s) for s in segment_ids]
+    seg = np.asarray(seg)
+    if seg.min() < 0:
+        raise ValueError("Negative segmentation labels are not supported")
+    flat = seg.ravel()
+    nvoxels = np.bincount(flat)
+
+    def _count(s):
+        return int(nvoxels[s]) if s < len(nvoxels) else 0
+
+    volumes = {}
+    if pv_vals is not None:
+        padded_seg = np.pad(seg, _MARGIN, mode='edge')
+        padded_vals = np.pad(np.asarray(pv_vals, dtype=np.float32), _MARGIN, mode='edge')
+        for s in set(segment_ids):
+            volumes[s] = partial_volume(padded_seg, padded_vals, s, seg.shape, voxel_volume)
+        del padded_seg, padded_vals
+    else:
+        for s in set(segment_ids):
+            volumes[s] = float(_count(s) * np.float32(voxel_volume))
+
+    if in_vals is not None:
+        ids = np.unique(segment_ids)
+        lut = np.full(max(len(nvoxels), ids.max() + 1), -1, dtype=np.int64)
+        lut[ids] = np.arange(len(ids))
+        which = lut[flat]
+        selected = which >= 0
+        which = which[selected]
+        vals = np.asarray(in_vals).ravel()[selected].astype(np.float64)
+        n = np.bincount(which, minlength=len(ids))
+        sum1 = np.bincount(which, vals, minlength=len(ids))
+        sum2 = np.bincount(which, vals * vals, minlength=len(ids))
+        order = np.argsort(which, kind='mergesort')
+        sorted_vals = vals[order]
+        starts = np.concatenate([[0], np.cumsum(n)[:-1]])
+        nonempty = n > 0
+        mins = np.zeros(len(ids))
+        maxs = np.zeros(len(ids))
+        if nonempty.any():
+            mins[nonempty] = np.minimum.reduceat(sorted_vals, starts[nonempty])
+            maxs[nonempty] = np.maximum.reduceat(sorted_vals, starts[nonempty])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean = np.where(nonempty, sum1 / n, 0.0)
+            std = np.where(nonempty, np.sqrt(np.maximum(sum2 / n - mean * mean, 0)), 0.0)
+        intensity = dict((s, (mean[i], std[i], mins[i], maxs[i], maxs[i] - mins[i]))
+                         for i, s in enumerate(ids.tolist()))
+
+    rows = []
+    for s in segment_ids:
+        row = OrderedDict([('SegId', s), ('NVoxels', _count(s)), ('Volume_mm3', volumes[s])])
+        if in_vals is not None:
+            row.update(zip(('Mean', 'StdDev', 'Min', 'Max', 'Range'), intensity[s]))
+        rows.append(row)
+    return rows
+
+
+def write_segstats_summary(fname, rows, names=None, intensity_name='', header=None):
+    """Write rows of compute_segstats() in the mri_segstats summary format
+
+    names maps label ids to structure names, Seg%04d like mri_segstats if
+    a label is missing.
+    """
+    names = names or {}
+    intensity = rows and 'Mean' in rows[0]
+    columns = [('Index', 'Index', 'NA'), ('SegId', 'Segmentation Id', 'NA'),
+               ('NVoxels', 'Number of Voxels', 'unitless'), ('Volume_mm3', 'Volume', 'mm^3'),
+               ('StructName', 'Structure Name', 'NA')]
+    if intensity:
+        columns += [(intensity_name + c, '%s %s' % (intensity_name or 'Intensity', f), 'MR')
+                    for c, f in (('Mean', 'Mean'), ('StdDev', 'StdDev'), ('Min', 'Min'),
+                                 ('Max', 'Max'), ('Range', 'Range'))]
+
+    lines = ['# Title Segmentation Statistics ', '# ',
+             '# generating_program fs_pipeline.segstats',
+             '# CreationTime %s' % time.strftime('%Y/%m/%d-%H:%M:%S-GMT', time.gmtime())]
+    for key, value in (header or {}).items():
+        lines.append('# %s %s' % (key, value))
+    for i, (name, field, units) in enumerate(columns):
+        lines.append('# TableCol %2d ColHeader %s ' % (i + 1, name))
+        lines.append('# TableCol %2d FieldName %s ' % (i + 1, field))
+        lines.append('# TableCol %2d Units     %s ' % (i + 1, units))
+    lines.append('# NRows %d ' % len(rows))
+    lines.append('# NTableCols %d ' % len(columns))
+    lines.append('# ColHeaders  %s ' % ' '.join(c[0] for c in columns))
+
+    for i, row in enumerate(rows):
+        line = '%3d %3d %8d %10.1f  %-30s' % (i + 1, row['SegId'], row['NVoxels'], row['Volume_mm3'],
+                                             names.get(row['SegId'], 'Seg%04d' % row['SegId']))
+        if intensity:
+            line += ' ' + ' '.join('%10.4f' % row[c] for c in ('Mean', 'StdDev', 'Min', 'Max', 'Range'))
+        lines.append(line)
+
+    with open(fname, 'w') as fp:
+        fp.write('\n'.join(lines) + '\n')
+    return fname
+
+
+def segstats(segmentation_file, segment_ids, summary_file, partial_volume_file=None,
+             in_file=None, names=None, intensity_name=''):
+    """mri_segstats --seg segmentation_file --id segment_ids --sum summary_file
+    [--pv partial_volume_file] [--i in_file] in process"""
+    seg, voxel_volume = load_volume(segmentation_file, np.int32)
+    pv_vals = load_volume(partial_volume_file)[0] if partial_volume_file else None
+    in_vals = load_volume(in_file)[0] if in_file else None
+    rows = compute_segstats(seg, segment_ids, voxel_volume, pv_vals, in_vals)
+
+    header = OrderedDict([('SegVolFile', segmentation_file)])
+    if partial_volume_file:
+        header['PVVolFile'] = partial_volume_file
+    if in_file:
+        header['InVolFile'] = in_file
+    header['VoxelVolume_mm3'] = '%g' % voxel_volume
+    return write_segstats_summary(summary_file, rows, names, intensity_name, header)
+
+
+def read_segstats_summary(fname):
+    """{SegId: {column: value}} of the numeric columns of an mri_segstats summary"""
+    headers = None
+    table = OrderedDict()
+    with open(fname) as fp:
+        for line in fp:
+            if line.startswith('# ColHeaders'):
+                headers = line.split()[2:]
+            elif line.strip() and not line.startswith('#'):
+                values = dict(zip(headers, line.split()))
+                values.pop('StructName', None)
+                values.pop('Index', None)
+                table[int(values['SegId'])] = dict((k, float(v)) for k, v in values.items())
+    return table
+
+
+def validate_segstats(recorded_file, segmentation_file, partial_volume_file=None,
+                      in_file=None, volume_tolerance=0.051, intensity_tolerance=1e-4):
+    """Recompute a recorded mri_segstats summary (same ids and volumes) and
+    compare it column by column
+
+    Volumes are compared within volume_tolerance mm^3 (the summary is printed
+    with one decimal), intensities within intensity_tolerance.
+
+    :return
+        list of (SegId, column, recorded value, native value) mismatches
+    """
+    recorded = read_segstats_summary(recorded_file)
+    seg, voxel_volume = load_volume(segmentation_file, np.int32)
+    pv_vals = load_volume(partial_volume_file)[0] if partial_volume_file else None
+    in_vals = load_volume(in_file)[0] if in_file else None
+    rows = compute_segstats(seg, list(recorded), voxel_volume, pv_vals, in_vals)
+
+    mismatches = []
+    for row in rows:
+        expected = recorded[row['SegId']]
+        for column, value in expected.items():
+            key = column
+            for name in ('Mean', 'StdDev', 'Min', 'Max', 'Range'):
+                if column.endswith(name):
+                    key = name
+            if key not in row:
+                continue
+            if key == 'Volume_mm3':
+                tolerance = volume_tolerance
+            elif key in ('SegId', 'NVoxels'):
+                tolerance = 0
+            else:
+                tolerance = intensity_tolerance
+            if abs(row[key] - value) > tolerance:
+                mismatches.append((row['SegId'], column, value, row[key]))
+    return mismatches
@@ -0,0 +1,452 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2023 Population Health Sciences, German Center for Neurodegenerative Diseases (DZNE)
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+Cohort stats aggregation: collect the measures of many subjects into one
+subjects x measures table.
+
+Subjects are parsed in a process pool and spooled to disk in row batches,
+the wide table (CSV and a column-major .npy matrix with a json index) is
+only assembled once the full, sorted column set is known. A fingerprint
+index next to the table lets later runs re-parse only new or changed
+subjects.
+"""
+
+from __future__ import print_function
+
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import multiprocessing
+from collections import OrderedDict
+from os.path import join, exists
+
+import numpy as np
+
+from .parse_stats import Subject, Parser, StatsSelection
+from .stats_columns import column_name, split_column_name
+from .parse_hsfs_stats import HSFSSubject
+from .subject_index import get_subject_index, STATS, HSFS
+
+TABLE_VERSION = 1
+
+
+def get_stats_json(subjects_dir, subject_id):
+    return join(subjects_dir, subject_id, 'stats', subject_id + '_stats.json')
+
+
+def find_subjects(subjects_dir):
+    """All directories in subjects_dir that have a stats dir"""
+    return sorted(s for s in os.listdir(subjects_dir)
+                  if 'stats' in get_subject_index(subjects_dir, s).subdirs)
+
+
+def stats_files(subjects_dir, subject_id, parse_hsfs=False, from_json=False,
+                selection=None):
+    """Relative paths of the files the measures of a subject are read from"""
+    if from_json:
+        return [os.path.relpath(get_stats_json(subjects_dir, subject_id), subjects_dir)]
+    index = get_subject_index(subjects_dir, subject_id)
+    fnames = [f for f in index.files(STATS) if Parser.can_parse(f, selection)]
+    if parse_hsfs:
+        fnames.extend(index.files(HSFS))
+    return sorted(os.path.relpath(f, subjects_dir) for f in fnames)
+
+
+def file_digest(fname):
+    with open(fname, 'rb') as fp:
+        return hashlib.md5(fp.read()).hexdigest()
+
+
+def stats_fingerprint(subjects_dir, subject_id, parse_hsfs=False, from_json=False,
+                      selection=None, digest=True):
+    """[relpath, size, mtime, digest] of every stats file of a subject, the
+    digest is None when digest=False"""
+    fingerprint = []
+    for fname in stats_files(subjects_dir, subject_id, parse_hsfs, from_json, selection):
+        fullname = join(subjects_dir, fname)
+        st = os.stat(fullname)
+        fingerprint.append([fname, st.st_size, st.st_mtime,
+                            file_digest(fullname) if digest else None])
+    return fingerprint
+
+
+def is_unchanged(subjects_dir, current, previous):
+    """Compare a cheap fingerprint (without digests) against the stored one.
+
+    Files with the same size but a new mtime are digested and considered
+    unchanged if the content is the same, their mtime is updated in place.
+    """
+    if previous is None or len(current) != len(previous):
+        return False
+    for cur, prev in zip(current, previous):
+        if cur[0] != prev[0] or cur[1] != prev[1]:
+            return False
+        if cur[2] != prev[2]:
+            cur[3] = file_digest(join(subjects_dir, cur[0]))
+            if cur[3] != prev[3]:
+                return False
+        else:
+            cur[3] = prev[3]
+    return True
+
+
+def collect_subject(subjects_dir, subject_id, parse_hsfs=False, from_json=False,
+                    selection=None):
+    """Return the measures of a subject as an ordered {column: value} dict
+
+    The values are the ones written by JsonifyStats, either parsed from the
+    stats files or read back from an existing <subject>_stats.json. A
+    StatsSelection (or list of patterns) restricts the parsed measures.
+    """
+    measures = OrderedDict()
+    if from_json and selection is not None:
+        raise ValueError("A stats selection can only be applied when parsing the stats files")
+    if from_json:
+        with open(get_stats_json(subjects_dir, subject_id)) as fp:
+            data = json.load(fp)
+        for mclass in sorted(data):
+            for mname, value in data[mclass].items():
+                measures[column_name(mclass, mname)] = value
+        return measures
+
+    tables = Subject(subjects_dir, subject_id, selection).get_tables()
+    if parse_hsfs:
+        tables.extend(HSFSSubject(subjects_dir, subject_id, selection).get_tables())
+    for table in tables:
+        values = table.values()
+        values[np.isnan(values)] = 0.0
+        measures.update(zip([column_name(table.mclass, m) for m in table.mnames()],
+                            values.tolist()))
+    return measures
+
+
+def _collect_worker(args):
+    subjects_dir, subject_id, parse_hsfs, from_json, patterns = args
+    try:
+        selection = StatsSelection.create(patterns)
+        fingerprint = stats_fingerprint(subjects_dir, subject_id, parse_hsfs, from_json,
+                                        selection)
+        measures = collect_subject(subjects_dir, subject_id, parse_hsfs, from_json,
+                                   selection)
+    except Exception as e:
+        return subject_id, None, '%s: %s' % (type(e).__name__, e), None
+    return (subject_id, list(measures.keys()),
+            np.fromiter(measures.values(), dtype=np.float64, count=len(measures)),
+            fingerprint)
+
+
+class BatchSpool(object):
+    """Row batches of (subject, columns, values) rows spooled to npz files,
+    keeping only the union of the column names in memory"""
+
+    def __init__(self, spool_dir=None, batch_size=256):
+        self.spool_dir = tempfile.mkdtemp(prefix='fs_stats_spool_', dir=spool_dir)
+        self.batch_size = batch_size
+        self.columns = set()
+        self.batches = []
+        self._rows = []
+
+    def add(self, subject_id, columns, values):
+        self.columns.update(columns)
+        self._rows.append((subject_id, columns, values))
+        if len(self._rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self._rows:
+            return
+        columns = sorted(set(c for _, cols, _ in self._rows for c in cols))
+        col_idx = dict((c, i) for i, c in enumerate(columns))
+        values = np.full((len(self._rows), len(columns)), np.nan)
+        for i, (_, cols, vals) in enumerate(self._rows):
+            values[i, [col_idx[c] for c in cols]] = vals
+        fname = join(self.spool_dir, 'batch_%06d.npz' % len(self.batches))
+        np.savez(fname, subjects=np.array([r[0] for r in self._rows]),
+                 columns=np.array(columns), values=values)
+        self.batches.append(fname)
+        self._rows = []
+
+    def __iter__(self):
+        self.flush()
+        for fname in self.batches:
+            with np.load(fname) as batch:
+                yield (batch['subjects'].tolist(), batch['columns'].tolist(),
+                       batch['values'])
+
+    def iter_rows(self):
+        for subjects, columns, values in self:
+            for subject_id, row in zip(subjects, values):
+                yield subject_id, columns, row
+
+    def cleanup(self):
+        shutil.rmtree(self.spool_dir, ignore_errors=True)
+
+
+def _format_row(subject_id, values):
+    return ','.join([subject_id] + [repr(v) if v == v else '' for v in values.tolist()])
+
+
+def write_cohort_table(batches, columns, n_subjects, out_prefix):
+    """Write row batches into <out_prefix>.csv, <out_prefix>.npy and
+    <out_prefix>_index.json using the given (stable) column order
+
+    batches yields (subjects, batch_columns, values) tuples and must provide
+    n_subjects rows in total, a fourth item can give already formatted CSV
+    lines of the rows (None where a row is to be formatted). The .npy matrix
+    is written column-major so that single measures can be read contiguously
+    through a memory map.
+    """
+    col_idx = dict((c, i) for i, c in enumerate(columns))
+    csv_file = out_prefix + '.csv'
+    npy_file = out_prefix + '.npy'
+    index_file = out_prefix + '_index.json'
+
+    matrix = np.lib.format.open_memmap(npy_file + '.tmp', mode='w+', dtype=np.float64,
+                                       shape=(n_subjects, len(columns)),
+                                       fortran_order=True)
+    subjects = []
+    with open(csv_file + '.tmp', 'w') as fp:
+        fp.write(','.join(['subject_id'] + columns) + '\n')
+        for batch in batches:
+            batch_subjects, batch_columns, values = batch[:3]
+            lines = batch[3] if len(batch) > 3 else [None] * len(batch_subjects)
+            block = np.full((len(batch_subjects), len(columns)), np.nan)
+            block[:, [col_idx[c] for c in batch_columns]] = values
+            row = len(subjects)
+            matrix[row:row + len(batch_subjects)] = block
+            for subject_id, block_row, line in zip(batch_subjects, block, lines):
+                fp.write(line if line is not None else _format_row(subject_id, block_row) + '\n')
+            subjects.extend(batch_subjects)
+    matrix.flush()
+    del matrix
+
+    if len(subjects) != n_subjects:
+        raise ValueError("Expected %d subjects, got %d" % (n_subjects, len(subjects)))
+
+    with open(index_file + '.tmp', 'w') as fp:
+        json.dump({'version': TABLE_VERSION, 'subjects': subjects, 'columns': columns}, fp)
+    for fname in (csv_file, npy_file, index_file):
+        os.rename(fname + '.tmp', fname)
+
+    return csv_file, npy_file, index_file
+
+
+def load_cohort_table(out_prefix, mmap_mode='r'):
+    """Return (subjects, columns, matrix) of a table written by write_cohort_table"""
+    with open(out_prefix + '_index.json') as fp:
+        index = json.load(fp)
+    matrix = np.load(out_prefix + '.npy', mmap_mode=mmap_mode)
+    return index['subjects'], index['columns'], matrix
+
+
+def _present_columns(previous, unchanged, chunk=256):
+    """Columns of the previous table with a value in any unchanged row, read
+    through the column-major memory map chunk by chunk"""
+    old_subjects, old_columns, old_matrix = previous
+    rows = np.array([i for i, s in enumerate(old_subjects) if s in unchanged], dtype=int)
+    present = set()
+    if not len(rows):
+        return present
+    for start in range(0, len(old_columns), chunk):
+        block = old_matrix[:, start:start + chunk][rows]
+        present.update(old_columns[start + j] for j in np.flatnonzero(~np.isnan(block).all(axis=0)))
+    return present
+
+
+def _csv_lines(csv_file):
+    """(subject_id, line) of the rows of a cohort CSV"""
+    with open(csv_file) as fp:
+        next(fp)
+        for line in fp:
+            yield line[:line.index(',')] if ',' in line else line.rstrip('\n'), line
+
+
+def _merged_batches(subject_ids, columns, spool, previous, unchanged, batch_size,
+                    previous_csv=None):
+    """Row batches in subject_ids order, taking the rows of unchanged subjects
+    from the previous table and all others from the spool
+
+    With previous_csv (only valid if the columns did not change) the CSV
+    lines of the unchanged rows are copied from it instead of formatted
+    again, which is most of the cost of writing the table.
+    """
+    col_idx = dict((c, i) for i, c in enumerate(columns))
+    new_rows = spool.iter_rows()
+    old_lines = _csv_lines(previous_csv) if previous_csv else iter(())
+    old_row = {}
+    if previous is not None:
+        old_subjects, old_columns, old_matrix = previous
+        old_row = dict((s, i) for i, s in enumerate(old_subjects) if s in unchanged)
+        # columns only other subjects had are dropped, they are empty in these rows
+        kept = [(j, col_idx[c]) for j, c in enumerate(old_columns) if c in col_idx]
+        old_keep, old_cols = [np.array(x, dtype=int) for x in zip(*kept)] if kept else \
+            (np.zeros(0, dtype=int), np.zeros(0, dtype=int))
+
+    for start in range(0, len(subject_ids), batch_size):
+        chunk = subject_ids[start:start + batch_size]
+        block = np.full((len(chunk), len(columns)), np.nan)
+        old = [(i, old_row[s]) for i, s in enumerate(chunk) if s in old_row]
+        if old:
+            block_rows, matrix_rows = [np.array(x, dtype=int) for x in zip(*old)]
+            order = np.argsort(matrix_rows)
+            block[np.ix_(block_rows[order], old_cols)] = old_matrix[matrix_rows[order]][:, old_keep]
+        lines = [None] * len(chunk)
+        for i, subject_id in enumerate(chunk):
+            if subject_id in old_row:
+                # both tables are sorted by subject, the old lines are read once
+                for old_id, line in old_lines:
+                    if old_id == subject_id:
+                        lines[i] = line
+                        break
+                continue
+            spooled_id, spooled_cols, row = next(new_rows)
+            assert spooled_id == subject_id
+            block[i, [col_idx[c] for c in spooled_cols]] = row
+        yield chunk, columns, block, lines
+
+
+def aggregate_cohort(subjects_dir, subject_ids, out_prefix, processes=1,
+                     parse_hsfs=False, from_json=False, batch_size=256,
+                     incremental=True, selection=None):
+    """Collect the measures of subject_ids into one wide cohort table
+
+    A fingerprint index of the stats files of every subject is kept in
+    <out_prefix>_fingerprints.json. With incremental=True only new or
+    changed subjects are parsed, unchanged rows are copied over from the
+    existing table and subjects no longer in subject_ids are dropped.
+    The table files are still rewritten as a whole; while the column set
+    stays the same the CSV lines of unchanged rows are copied, otherwise
+    every row is formatted again. selection is a list of StatsSelection patterns, all measures if None.
+
+    :return
+        (written files, {subject_id: error message} of skipped subjects)
+    """
+    fingerprint_file = out_prefix + '_fingerprints.json'
+    selection = StatsSelection.create(selection)
+    patterns = selection.patterns if selection is not None else None
+    options = {'parse_hsfs': bool(parse_hsfs), 'from_json': bool(from_json),
+               'selection': patterns}
+    subject_ids = sorted(set(subject_ids))
+
+    fingerprints = {}
+    previous = None
+    if incremental and exists(fingerprint_file) and exists(out_prefix + '.npy'):
+        with open(fingerprint_file) as fp:
+            index = json.load(fp)
+        if index.get('version') == TABLE_VERSION and index.get('options') == options:
+            fingerprints = index['subjects']
+            previous = load_cohort_table(out_prefix)
+
+    unchanged = set()
+    current = {}
+    if previous is not None:
+        old_subjects = set(previous[0])
+        for subject_id in subject_ids:
+            if subject_id not in old_subjects:
+                continue
+            try:
+                current[subject_id] = stats_fingerprint(subjects_dir, subject_id, parse_hsfs,
+                                                        from_json, selection, digest=False)
+            except (IOError, OSError):
+                continue
+            if is_unchanged(subjects_dir, current[subject_id], fingerprints.get(subject_id)):
+                unchanged.add(subject_id)
+
+    todo = [s for s in subject_ids if s not in unchanged]
+    if previous is not None and not todo and set(previous[0]) == unchanged:
+        # nothing to re-parse and nobody deleted, only refresh the mtimes
+        outputs = (out_prefix + '.csv', out_prefix + '.npy', out_prefix + '_index.json')
+        _write_fingerprints(fingerprint_file, options, current)
+        return outputs, OrderedDict()
+
+    tasks = [(subjects_dir, s, parse_hsfs, from_json, patterns) for s in todo]
+    spool = BatchSpool(os.path.dirname(os.path.abspath(out_prefix)), batch_size)
+    failed = OrderedDict()
+    new_fingerprints = dict((s, current[s]) for s in unchanged)
+    pool = multiprocessing.Pool(processes)
+    try:
+        for subject_id, columns, values, fingerprint in pool.imap(
+                _collect_worker, tasks, chunksize=max(1, batch_size // (4 * processes))):
+            if columns is None:
+                failed[subject_id] = values
+            else:
+                spool.add(subject_id, columns, values)
+                new_fingerprints[subject_id] = fingerprint
+        pool.close()
+        pool.join()
+
+        kept = [s for s in subject_ids if s not in failed]
+        # the columns of the kept subjects only, as a full rebuild would have
+        columns = set(spool.columns)
+        if previous is not None:
+            columns.update(_present_columns(previous, unchanged))
+        columns = sorted(columns)
+        previous_csv = out_prefix + '.csv' if previous is not None and columns == previous[1] else None
+        outputs = write_cohort_table(_merged_batches(kept, columns, spool, previous, unchanged,
+                                                     batch_size, previous_csv),
+                                     columns, len(kept), out_prefix)
+    finally:
+        pool.terminate()
+        spool.cleanup()
+        previous = None
+
+    _write_fingerprints(fingerprint_file, options, new_fingerprints)
+    return outputs, failed
+
+
+def _write_fingerprints(fingerprint_file, options, fingerprints):
+    with open(fingerprint_file + '.tmp', 'w') as fp:
+        json.dump({'version': TABLE_VERSION, 'options': options,
+                   'subjects': fingerprints}, fp)
+    os.rename(fingerprint_file + '.tmp', fingerprint_file)
+
+
+def write_cohort_stats(compact_stats, subjects_dir, out_prefix, parse_hsfs=False,
+                       selection=None, batch_size=256):
+    """JoinNode function: stream the compact stats of all subjects of a run
+    (JsonifyStats.compact_stats) into one cohort table
+
+    Rows are spooled to disk every batch_size subjects, the stats files are
+    not read again. A fingerprint index without digests is written as well,
+    so aggregate_fs_stats can later update the table incrementally.
+    """
+    import os
+    from fs_pipeline.stats_aggregator import (BatchSpool, write_cohort_table,
+                                              stats_fingerprint, _write_fingerprints)
+    from fs_pipeline.parse_stats import StatsSelection
+    from fs_pipeline.stats_binary import read_columns
+
+    out_prefix = os.path.abspath(out_prefix)
+    selection = StatsSelection.create(selection)
+    spool = BatchSpool(os.path.dirname(out_prefix), batch_size)
+    fingerprints = {}
+    try:
+        for subject_id, chash, values in sorted(compact_stats, key=lambda s: s[0]):
+            spool.add(subject_id, read_columns(subjects_dir, chash), values)
+            fingerprints[subject_id] = stats_fingerprint(subjects_dir, subject_id, parse_hsfs,
+                                                         False, selection, digest=False)
+        outputs = write_cohort_table(spool, sorted(spool.columns), len(compact_stats), out_prefix)
+    finally:
+        spool.cleanup()
+
+    _write_fingerprints(out_prefix + '_fingerprints.json',
+                        {'parse_hsfs': bool(parse_hsfs), 'from_json': False,
+                         'selection': selection.patterns if selection is not None else None},
+                        fingerprints)
+    return list(outputs)
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2023 Population Health Sciences, German Center for Neurodegenerative Diseases (DZNE)
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+Compact binary form of the <subject>_stats.json measures.
+
+The sorted 'mclass/mname' column names are stored once per SUBJECTS_DIR in
+.fs_stats_columns/<hash>.json, each subject only gets a small
+stats/<subject>_stats.npz with the format version, the hash of its column
+dictionary and the value vector (float64, or float32 to halve the size).
+load_stats_binary() rebuilds the same nested dict as the json file.
+"""
+
+import os
+import json
+import hashlib
+from os.path import join, exists, dirname, abspath
+
+import numpy as np
+
+from .stats_columns import column_name, split_column_name
+
+BINARY_VERSION = 1
+COLUMNS_DIR = '.fs_stats_columns'
+
+_columns_cache = {}
+
+
+def get_stats_binary(subjects_dir, subject_id):
+    return join(subjects_dir, subject_id, 'stats', subject_id + '_stats.npz')
+
+
+def columns_hash(columns):
+    return hashlib.sha1('\n'.join(columns).encode('utf-8')).hexdigest()
+
+
+def _columns_file(subjects_dir, chash):
+    return join(subjects_dir, COLUMNS_DIR, chash + '.json')
+
+
+def write_columns(subjects_dir, columns):
+    """Store a column dictionary once per subjects_dir, return its hash"""
+    chash = columns_hash(columns)
+    fname = _columns_file(subjects_dir, chash)
+    if exists(fname):
+        return chash
+    if not exists(dirname(fname)):
+        try:
+            os.makedirs(dirname(fname))
+        except OSError:
+            #created by a parallel node
+            if not exists(dirname(fname)):
+                raise
+    tmp = '%s.%d.tmp' % (fname, os.getpid())
+    with open(tmp, 'w') as fp:
+        json.dump({'version': BINARY_VERSION, 'columns': list(columns)}, fp)
+    os.rename(tmp, fname)
+    return chash
+
+
+def read_columns(subjects_dir, chash):
+    key = (abspath(subjects_dir), chash)
+    if key not in _columns_cache:
+        with open(_columns_file(subjects_dir, chash)) as fp:
+            columns = json.load(fp)['columns']
+        if columns_hash(columns) != chash:
+            raise ValueError("Corrupt stats column dictionary %s" % chash)
+        _columns_cache[key] = columns
+    return _columns_cache[key]
+
+
+def flatten_measures(measures, dtype='float64'):
+    """(sorted column names, value vector) of a get_measures_dict() style dict"""
+    columns = []
+    values = []
+    for mclass in sorted(measures):
+        for mname in sorted(measures[mclass]):
+            columns.append(column_name(mclass, mname))
+            values.append(measures[mclass][mname])
+    return columns, np.array(values, dtype=dtype)
+
+
+def compact_measures(subjects_dir, measures, dtype='float64'):
+    """(columns hash, value vector) of a get_measures_dict() style dict, the
+    column dictionary is stored in subjects_dir"""
+    columns, values = flatten_measures(measures, dtype)
+    return write_columns(subjects_dir, columns), values
+
+
+def write_stats_binary(subjects_dir, subject_id, measures, dtype='float64', fname=None):
+    """Write a get_measures_dict() style dict as <subject>_stats.npz"""
+    chash, values = compact_measures(subjects_dir, measures, dtype)
+    fname = fname or get_stats_binary(subjects_dir, subject_id)
+    #an interrupted write must not leave a truncated file for the aggregator
+    tmp = '%s.%d.tmp' % (fname, os.getpid())
+    with open(tmp, 'wb') as fp:
+        np.savez(fp, version=np.array(BINARY_VERSION), columns_hash=np.array(chash),
+                 values=values)
+    os.rename(tmp, fname)
+    return fname
+
+
+def load_stats_values(fname, subjects_dir=None):
+    """(columns, values) of a <subject>_stats.npz, subjects_dir defaults to
+    the one the file is in"""
+    if subjects_dir is None:
+        subjects_dir = dirname(dirname(dirname(abspath(fname))))
+    with np.load(fname) as data:
+        version = int(data['version'])
+        if version != BINARY_VERSION:
+            raise ValueError("Unsupported binary stats version %d in %s" % (version, fname))
+        chash = str(data['columns_hash'])
+        values = data['values']
+    columns = read_columns(subjects_dir, chash)
+    if len(columns) != len(values):
+        raise ValueError("%s doesn't match its column dictionary %s" % (fname, chash))
+    return columns, values
+
+
+def load_stats_binary(fname, subjects_dir=None):
+    """Nested {mclass: {mname: value}} dict of a <subject>_stats.npz"""
+    columns, values = load_stats_values(fname, subjects_dir)
+    data = {}
+    for column, value in zip(columns, values.astype(np.float64).tolist()):
+        mclass, mname = split_column_name(column)
+        data.setdefault(mclass, {})[mname] = value
+    return data
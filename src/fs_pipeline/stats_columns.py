@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2023 Population Health Sciences, German Center for Neurodegenerative Diseases (DZNE)
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+Names of the cohort table and stats store columns: 'mclass/mname', the
+measure class and the measure name of the <subject>_stats.json files.
+"""
+
+
+def column_name(mclass, mname):
+    return '%s/%s' % (mclass, mname)
+
+
+def split_column_name(column):
+    return tuple(column.split('/', 1))
@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2023 Population Health Sciences, German Center for Neurodegenerative Diseases (DZNE)
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+Reproducibility check of the stats of two runs of the same subjects.
+
+Subjects are loaded in chunks into aligned subjects x measures arrays of the
+reference and the test run. Absolute and relative differences are computed
+per chunk and only reduced per-measure statistics (worst difference, the
+subject it occurred in, counts outside the tolerance) are kept, so memory
+only depends on the chunk size and the number of measures.
+"""
+
+from __future__ import print_function
+
+import os
+import multiprocessing
+from collections import OrderedDict
+from os.path import exists
+
+import numpy as np
+
+from .stats_aggregator import collect_subject, get_stats_json
+from .stats_columns import split_column_name
+from .stats_binary import get_stats_binary, load_stats_values
+
+
+def load_measures(subjects_dir, subject_id, parse_hsfs=False, use_json=True):
+    """(columns, values) of a subject, from <subject>_stats.json or
+    <subject>_stats.npz if present and use_json, parsed otherwise"""
+    if use_json and exists(get_stats_json(subjects_dir, subject_id)):
+        measures = collect_subject(subjects_dir, subject_id, from_json=True)
+    elif use_json and exists(get_stats_binary(subjects_dir, subject_id)):
+        columns, values = load_stats_values(get_stats_binary(subjects_dir, subject_id),
+                                            subjects_dir)
+        return list(columns), values.astype(np.float64)
+    else:
+        measures = collect_subject(subjects_dir, subject_id, parse_hsfs)
+    return list(measures.keys()), np.array(list(measures.values()), dtype=np.float64)
+
+
+def _load_worker(args):
+    reference_dir, test_dir, subject_id, parse_hsfs, use_json = args
+    try:
+        ref = load_measures(reference_dir, subject_id, parse_hsfs, use_json)
+        test = load_measures(test_dir, subject_id, parse_hsfs, use_json)
+    except Exception as e:
+        return subject_id, None, '%s: %s' % (type(e).__name__, e)
+    return subject_id, ref, test
+
+
+class StatsComparison(object):
+    """Per-measure difference statistics, updated chunk by chunk
+
+    A value pair is outside the tolerance like in numpy.isclose, if
+    |a - b| > atol + rtol * max(|a|, |b|).
+    """
+
+    def __init__(self, rtol=1e-4, atol=1e-6):
+        self.rtol = rtol
+        self.atol = atol
+        self.columns = []
+        self._col_idx = {}
+        self.n_subjects = 0
+        self.n_compared = np.zeros(0, dtype=np.int64)
+        self.n_failed = np.zeros(0, dtype=np.int64)
+        self.n_missing = np.zeros(0, dtype=np.int64)
+        self.max_abs = np.zeros(0)
+        self.max_rel = np.zeros(0)
+        self.worst_subject = np.zeros(0, dtype=np.int64)
+        self.worst_values = np.zeros((0, 2))
+        self.subjects = []
+
+    def _column_indices(self, columns):
+        new = [c for c in columns if c not in self._col_idx]
+        if new:
+            for c in new:
+                self._col_idx[c] = len(self.columns)
+                self.columns.append(c)
+            n = len(new)
+            self.n_compared = np.concatenate([self.n_compared, np.zeros(n, dtype=np.int64)])
+            self.n_failed = np.concatenate([self.n_failed, np.zeros(n, dtype=np.int64)])
+            self.n_missing = np.concatenate([self.n_missing, np.zeros(n, dtype=np.int64)])
+            self.max_abs = np.concatenate([self.max_abs, np.full(n, -1.0)])
+            self.max_rel = np.concatenate([self.max_rel, np.full(n, -1.0)])
+            self.worst_subject = np.concatenate([self.worst_subject, np.full(n, -1, dtype=np.int64)])
+            self.worst_values = np.concatenate([self.worst_values, np.full((n, 2), np.nan)])
+        return np.array([self._col_idx[c] for c in columns], dtype=np.int64)
+
+    def update(self, rows):
+        """Add a chunk of (subject_id, (ref columns, values), (test columns, values)) rows"""
+        if not rows:
+            return
+        columns = sorted(set(c for _, ref, test in rows for c in ref[0] + test[0]))
+        local = dict((c, j) for j, c in enumerate(columns))
+        a = np.full((len(rows), len(columns)), np.nan)
+        b = np.full((len(rows), len(columns)), np.nan)
+        for i, (_, ref, test) in enumerate(rows):
+            a[i, [local[c] for c in ref[0]]] = ref[1]
+            b[i, [local[c] for c in test[0]]] = test[1]
+        first_subject = len(self.subjects)
+        self.subjects.extend(r[0] for r in rows)
+        self._update(self._column_indices(columns), first_subject, a, b)
+
+    def _update(self, cols, first_subject, a, b):
+        present_a = ~np.isnan(a)
+        present_b = ~np.isnan(b)
+        both = present_a & present_b
+        absdiff = np.abs(a - b)
+        scale = np.fmax(np.abs(a), np.abs(b))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            reldiff = np.where(scale > 0, absdiff / scale, 0.0)
+        failed = both & (absdiff > self.atol + self.rtol * scale)
+
+        self.n_compared[cols] += both.sum(axis=0)
+        self.n_failed[cols] += failed.sum(axis=0)
+        self.n_missing[cols] += (present_a != present_b).sum(axis=0)
+        self.max_abs[cols] = np.fmax(self.max_abs[cols], np.where(both, absdiff, -1.0).max(axis=0))
+
+        reldiff = np.where(both, reldiff, -1.0)
+        worst = reldiff.argmax(axis=0)
+        ncols = np.arange(len(cols))
+        chunk_max = reldiff[worst, ncols]
+        better = chunk_max > self.max_rel[cols]
+        upd = cols[better]
+        self.max_rel[upd] = chunk_max[better]
+        self.worst_subject[upd] = first_subject + worst[better]
+        self.worst_values[upd, 0] = a[worst[better], ncols[better]]
+        self.worst_values[upd, 1] = b[worst[better], ncols[better]]
+
+    def n_failed_measures(self):
+        """Measures outside the tolerance or missing in one run, each counted once"""
+        return int(np.count_nonzero((self.n_failed > 0) | (self.n_missing > 0)))
+
+    def _ranked(self):
+        """Column indices, measures outside the tolerance or missing in one
+        run first, then by decreasing relative difference"""
+        flagged = (self.n_failed > 0) | (self.n_missing > 0)
+        return np.lexsort((-self.max_rel, ~flagged))
+
+    def worst_offenders(self, top=5):
+        """{mclass: [column indices]} of the worst measures of each class"""
+        by_class = OrderedDict()
+        for j in self._ranked():
+            mclass = split_column_name(self.columns[j])[0]
+            offenders = by_class.setdefault(mclass, [])
+            if len(offenders) < top and (self.max_rel[j] > 0 or self.n_missing[j]):
+                offenders.append(j)
+        return OrderedDict((k, by_class[k]) for k in sorted(by_class))
+
+    def _measure_row(self, j):
+        s = self.worst_subject[j]
+        return (self.columns[j], int(self.n_compared[j]), int(self.n_failed[j]),
+                int(self.n_missing[j]), max(float(self.max_abs[j]), 0.0),
+                max(float(self.max_rel[j]), 0.0), self.subjects[s] if s >= 0 else '',
+                float(self.worst_values[j, 0]), float(self.worst_values[j, 1]))
+
+    def report(self, top=5):
+        lines = ['Compared %d subjects, %d measures (rtol=%g, atol=%g)'
+                 % (self.n_subjects, len(self.columns), self.rtol, self.atol)]
+        offenders = self.worst_offenders(top)
+        for mclass, cols in offenders.items():
+            in_class = np.array([split_column_name(c)[0] == mclass for c in self.columns])
+            lines.append('%s: %d measures, %d outside tolerance, %d missing in one run'
+                         % (mclass, in_class.sum(), np.count_nonzero(self.n_failed[in_class]),
+                            np.count_nonzero(self.n_missing[in_class])))
+            for j in cols:
+                column, n, nf, nm, mabs, mrel, subject, va, vb = self._measure_row(j)
+                lines.append('    %-60s rel %.3g abs %.6g (%s: %r vs %r) failed %d/%d missing %d'
+                             % (split_column_name(column)[1], mrel, mabs, subject, va, vb, nf, n, nm))
+        return '\n'.join(lines)
+
+    def write_csv(self, fname):
+        """All per-measure statistics, worst first"""
+        with open(fname, 'w') as fp:
+            fp.write('measure,n_compared,n_failed,n_missing,max_abs_diff,max_rel_diff,'
+                     'worst_subject,reference_value,test_value\n')
+            for j in self._ranked():
+                fp.write(','.join(repr(v) if isinstance(v, (int, float)) else v
+                                  for v in self._measure_row(j)) + '\n')
+        return fname
+
+
+def compare_runs(reference_dir, test_dir, subject_ids, parse_hsfs=False, use_json=True,
+                 rtol=1e-4, atol=1e-6, chunk_size=128, processes=1):
+    """Compare the measures of subject_ids in two subjects dirs
+
+    :return
+        (StatsComparison, {subject_id: error message} of skipped subjects)
+    """
+    comparison = StatsComparison(rtol, atol)
+    failed = OrderedDict()
+    tasks = [(reference_dir, test_dir, s, parse_hsfs, use_json) for s in subject_ids]
+    pool = multiprocessing.Pool(processes)
+    try:
+        rows = []
+        for subject_id, ref, test in pool.imap(_load_worker, tasks,
+                                               chunksize=max(1, chunk_size // (4 * processes))):
+            if ref is None:
+                failed[subject_id] = test
+                continue
+            rows.append((subject_id, ref, test))
+            if len(rows) >= chunk_size:
+                comparison.update(rows)
+                rows = []
+        comparison.update(rows)
+        pool.close()
+        pool.join()
+    finally:
+        pool.terminate()
+    comparison.n_subjects = len(comparison.subjects)
+    return comparison, failed
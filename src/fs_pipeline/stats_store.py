@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2023 Population Health Sciences, German Center for Neurodegenerative Diseases (DZNE)
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+Queryable cohort stats store.
+
+A store is a directory with a row-major float64 matrix (subjects x measures,
+NaN for missing measures) that is memory mapped for lookups, and a json
+manifest with the subject ids and the 'mclass/mname' measure keys of the
+<subject>_stats.json files. The manifest is replaced atomically on every
+update, so readers always see a consistent state; the values file of the
+previous generation is only removed by the rewrite after the next one:
+
+    >>> store = CohortStatsStore('/data/cohort_store')
+    >>> store.get(subject_ids, ['aseg/etiv', 'aseg/left_hippocampus_volume_mm3'])
+"""
+
+import os
+import re
+import json
+import multiprocessing
+from os.path import join, exists
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from .stats_aggregator import BatchSpool, _collect_worker
+from .stats_columns import column_name, split_column_name
+
+STORE_VERSION = 1
+MANIFEST = 'manifest.json'
+VALUES_RE = re.compile(r'^values_(\d+)\.f8$')
+
+
+def _flatten(measures):
+    """{'mclass/mname': value} of a nested get_measures_dict() style dict,
+    flat dicts are passed through"""
+    flat = {}
+    for key, value in measures.items():
+        if isinstance(value, dict):
+            for mname, v in value.items():
+                flat[column_name(key, mname)] = v
+        else:
+            flat[key] = value
+    return flat
+
+
+class CohortStatsStore(object):
+    """Memory mapped subjects x measures matrix with subject and measure indexes
+
+    mode 'r' opens an existing store read-only, mode 'a' creates it if needed
+    and allows appending subjects.
+    """
+
+    def __init__(self, path, mode='r'):
+        self.path = os.path.abspath(path)
+        self.mode = mode
+        if not exists(join(self.path, MANIFEST)):
+            if mode == 'r':
+                raise IOError("No cohort stats store found in %s" % self.path)
+            if not exists(self.path):
+                os.makedirs(self.path)
+            self._commit({'version': STORE_VERSION, 'generation': 0,
+                          'values': 'values_000000.f8', 'subjects': [], 'measures': []})
+            open(join(self.path, 'values_000000.f8'), 'ab').close()
+        self.reload()
+
+    def __repr__(self):
+        return "<CohortStatsStore(%s)[%d x %d]>" % (self.path, len(self.subjects), len(self.measures))
+
+    def __len__(self):
+        return len(self.subjects)
+
+    def __contains__(self, subject_id):
+        return subject_id in self._subject_idx
+
+    def reload(self):
+        """Re-read the manifest, picking up updates by other processes"""
+        with open(join(self.path, MANIFEST)) as fp:
+            manifest = json.load(fp)
+        if manifest.get('version') != STORE_VERSION:
+            raise ValueError("Unsupported cohort stats store version %s" % manifest.get('version'))
+        self.manifest = manifest
+        self.subjects = manifest['subjects']
+        self.measures = manifest['measures']
+        self._subject_idx = dict((s, i) for i, s in enumerate(self.subjects))
+        self._measure_idx = dict((m, j) for j, m in enumerate(self.measures))
+        self._classes = {}
+        for j, m in enumerate(self.measures):
+            self._classes.setdefault(split_column_name(m)[0], []).append(j)
+
+        shape = (len(self.subjects), len(self.measures))
+        if shape[0] and shape[1]:
+            #the values file may be longer than the committed rows
+            self._matrix = np.memmap(join(self.path, manifest['values']), dtype=np.float64,
+                                     mode='r', shape=shape)
+        else:
+            self._matrix = np.zeros(shape)
+
+    def _rows(self, subjects):
+        if subjects is None:
+            return np.arange(len(self.subjects))
+        try:
+            return np.array([self._subject_idx[s] for s in subjects], dtype=int)
+        except KeyError as e:
+            raise KeyError("Subject %s not in cohort stats store" % e)
+
+    def _columns(self, measures):
+        if measures is None:
+            return np.arange(len(self.measures))
+        cols = []
+        for m in measures:
+            if isinstance(m, tuple):
+                m = column_name(*m)
+            if m not in self._measure_idx:
+                raise KeyError("Measure %s not in cohort stats store" % m)
+            cols.append(self._measure_idx[m])
+        return np.array(cols, dtype=int)
+
+    def get(self, subjects=None, measures=None):
+        """len(subjects) x len(measures) array, all of them if None
+
+        Measures are 'mclass/mname' strings or (mclass, mname) tuples. Only
+        the requested cells are read from the memory mapped matrix.
+        """
+        rows = self._rows(subjects)
+        cols = self._columns(measures)
+        order = np.argsort(rows)
+        out = np.empty((len(rows), len(cols)))
+        if len(rows) and len(cols):
+            #index rows and columns together, so only the requested cells are read
+            out[order] = self._matrix[rows[order][:, np.newaxis], cols]
+        return out
+
+    def measure(self, measure, subjects=None):
+        """Values of a single measure for subjects (all if None)"""
+        return self.get(subjects, [measure])[:, 0]
+
+    def measure_class(self, mclass, subjects=None):
+        """(mnames, values) of all measures of one class, e.g. 'aseg'"""
+        cols = self._classes.get(mclass, [])
+        names = [split_column_name(self.measures[j])[1] for j in cols]
+        return names, self.get(subjects, [self.measures[j] for j in cols])
+
+    def row(self, subject_id):
+        """Measures of one subject as a nested dict like get_measures_dict()"""
+        values = self.get([subject_id])[0]
+        data = {}
+        for m, value in zip(self.measures, values.tolist()):
+            if value == value:
+                mclass, mname = split_column_name(m)
+                data.setdefault(mclass, {})[mname] = value
+        return data
+
+    def _commit(self, manifest):
+        fname = join(self.path, MANIFEST)
+        with open(fname + '.tmp', 'w') as fp:
+            json.dump(manifest, fp)
+        os.rename(fname + '.tmp', fname)
+
+    def append(self, records, batch_size=256):
+        """Add or replace subjects
+
+        records yields (subject_id, measures) with measures a nested
+        get_measures_dict() style dict or a flat {'mclass/mname': value}
+        dict. New subjects with known measures are appended to the values
+        file, new measures or replaced subjects write a new values file.
+        Either way the update only becomes visible with the atomic swap of
+        the manifest.
+        """
+        if self.mode == 'r':
+            raise IOError("Cohort stats store %s is opened read-only" % self.path)
+
+        lock = open(join(self.path, '.lock'), 'w')
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        spool = BatchSpool(self.path, batch_size)
+        try:
+            self.reload()
+            added = []
+            for subject_id, measures in records:
+                flat = _flatten(measures)
+                keys = sorted(flat)
+                spool.add(subject_id, keys,
+                          np.array([flat[k] for k in keys], dtype=np.float64))
+                added.append(subject_id)
+            if not added:
+                return []
+
+            new_measures = sorted(spool.columns.difference(self._measure_idx))
+            replaced = set(added).intersection(self._subject_idx)
+            if len(set(added)) != len(added):
+                raise ValueError("Duplicate subjects in cohort stats store update")
+
+            if new_measures or replaced or not self.measures:
+                self._rewrite(spool, self.measures + new_measures, replaced, batch_size)
+            else:
+                self._append_rows(spool)
+        finally:
+            spool.cleanup()
+            lock.close()
+        self.reload()
+        return added
+
+    def _append_rows(self, spool):
+        manifest = dict(self.manifest)
+        fname = join(self.path, manifest['values'])
+        col_idx = self._measure_idx
+        n_cols = len(self.measures)
+        subjects = list(self.subjects)
+        with open(fname, 'r+b') as fp:
+            #drop rows of an interrupted update that were never committed
+            fp.truncate(len(subjects) * n_cols * 8)
+            fp.seek(0, os.SEEK_END)
+            for batch_subjects, batch_columns, values in spool:
+                block = np.full((len(batch_subjects), n_cols), np.nan)
+                block[:, [col_idx[c] for c in batch_columns]] = values
+                fp.write(np.ascontiguousarray(block, dtype=np.float64).tobytes())
+                subjects.extend(batch_subjects)
+            fp.flush()
+            os.fsync(fp.fileno())
+        manifest['subjects'] = subjects
+        self._commit(manifest)
+
+    def _rewrite(self, spool, measures, replaced, batch_size):
+        manifest = dict(self.manifest)
+        generation = manifest['generation'] + 1
+        values = 'values_%06d.f8' % generation
+        col_idx = dict((m, j) for j, m in enumerate(measures))
+        old_cols = np.arange(len(self.measures))
+        kept = [i for i, s in enumerate(self.subjects) if s not in replaced]
+        subjects = [self.subjects[i] for i in kept]
+
+        with open(join(self.path, values), 'wb') as fp:
+            for start in range(0, len(kept), batch_size):
+                rows = kept[start:start + batch_size]
+                block = np.full((len(rows), len(measures)), np.nan)
+                block[:, old_cols] = self._matrix[rows]
+                fp.write(block.tobytes())
+            for batch_subjects, batch_columns, batch_values in spool:
+                block = np.full((len(batch_subjects), len(measures)), np.nan)
+                block[:, [col_idx[c] for c in batch_columns]] = batch_values
+                fp.write(block.tobytes())
+                subjects.extend(batch_subjects)
+            fp.flush()
+            os.fsync(fp.fileno())
+
+        manifest.update({'generation': generation, 'values': values,
+                         'subjects': subjects, 'measures': measures})
+        self._commit(manifest)
+        #a reader may have loaded the previous manifest and not opened its
+        #values file yet, only generations before that one are removed
+        for fname in os.listdir(self.path):
+            match = VALUES_RE.match(fname)
+            if match and int(match.group(1)) < generation - 1:
+                os.remove(join(self.path, fname))
+
+
+def update_store(store_path, subjects_dir, subject_ids, parse_hsfs=False,
+                 processes=1, selection=None, replace=False, batch_size=256):
+    """Parse the subjects that are not yet in the store (all of subject_ids
+    with replace=True) and append them
+
+    :return
+        (added subject ids, {subject_id: error message} of skipped subjects)
+    """
+    store = CohortStatsStore(store_path, mode='a')
+    todo = [s for s in subject_ids if replace or s not in store]
+    tasks = [(subjects_dir, s, parse_hsfs, False, selection) for s in todo]
+    failed = {}
+
+    def _records(pool):
+        for subject_id, columns, values, _ in pool.imap(_collect_worker, tasks):
+            if columns is None:
+                failed[subject_id] = values
+            else:
+                yield subject_id, dict(zip(columns, values.tolist()))
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        added = store.append(_records(pool), batch_size)
+        pool.close()
+        pool.join()
+    finally:
+        pool.terminate()
+    return added, failed
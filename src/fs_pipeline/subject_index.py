@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2023 Population Health Sciences, German Center for Neurodegenerative Diseases (DZNE)
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+Per-subject file index of a Freesurfer subject directory.
+
+Each relevant directory (the subject dir, stats/, mri/ and surf/) is listed
+once, non-recursively, and its files are classified by role. Indexes are
+cached per process and only rebuilt when one of the directories changed.
+"""
+
+import os
+from os.path import join
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+#file roles
+STATS = 'stats'
+HSFS = 'hsfs'
+QC = 'qc'
+
+FS_SUBDIRS = ('mri', 'label', 'stats', 'surf')
+INDEXED_SUBDIRS = ('stats', 'mri', 'surf')
+
+QC_INPUTS = {'mri': ('orig.mgz', 'aseg.mgz', 'norm.mgz'),
+             'surf': ('lh.white', 'rh.white', 'lh.pial', 'rh.pial',
+                      'lh.orig.nofix', 'rh.orig.nofix')}
+
+
+def _list_dir(path):
+    """{name: is_dir} of the entries of path, empty if it doesn't exist"""
+    try:
+        if scandir is not None:
+            return dict((e.name, e.is_dir()) for e in scandir(path))
+        return dict((name, os.path.isdir(join(path, name))) for name in os.listdir(path))
+    except OSError:
+        return {}
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+def classify(subdir, fname):
+    """Role of a file in a subject subdirectory, None if not of interest"""
+    if subdir == 'stats' and fname.endswith('.stats'):
+        return STATS
+    if subdir == 'mri' and 'hippoSfVolumes' in fname and fname.endswith('.txt'):
+        return HSFS
+    if fname in QC_INPUTS.get(subdir, ()):
+        return QC
+    return None
+
+
+class SubjectIndex(object):
+    """Files of one subject directory, classified by role"""
+
+    def __init__(self, subjects_dir, subject_id):
+        self.subject_id = subject_id
+        self.subject_dir = join(subjects_dir, subject_id)
+        self.scan()
+
+    def __repr__(self):
+        return "<SubjectIndex(%s)[%s]>" % (self.subject_id,
+            ', '.join('%s:%d' % (r, len(f)) for r, f in sorted(self.roles.items())))
+
+    def scan(self):
+        self.mtimes = {'': _mtime(self.subject_dir)}
+        self.subdirs = set(name for name, is_dir in _list_dir(self.subject_dir).items() if is_dir)
+        self.roles = {}
+        self.names = {}
+        for subdir in INDEXED_SUBDIRS:
+            if subdir not in self.subdirs:
+                continue
+            path = join(self.subject_dir, subdir)
+            self.mtimes[subdir] = _mtime(path)
+            entries = _list_dir(path)
+            self.names[subdir] = set(name for name, is_dir in entries.items() if not is_dir)
+            for name in self.names[subdir]:
+                role = classify(subdir, name)
+                if role is not None:
+                    self.roles.setdefault(role, []).append(join(path, name))
+        for files in self.roles.values():
+            files.sort()
+
+    def is_stale(self):
+        return any(_mtime(join(self.subject_dir, subdir)) != mtime
+                   for subdir, mtime in self.mtimes.items())
+
+    def is_fs_subject(self):
+        """True if it looks like a Freesurfer output directory"""
+        return set(FS_SUBDIRS).issubset(self.subdirs)
+
+    def files(self, role):
+        return list(self.roles.get(role, []))
+
+    def has(self, subdir, fname):
+        return fname in self.names.get(subdir, ())
+
+    def path(self, subdir, fname):
+        """Full path of subdir/fname, None if the index doesn't have it"""
+        if self.has(subdir, fname):
+            return join(self.subject_dir, subdir, fname)
+        return None
+
+
+_cache = {}
+
+
+def get_subject_index(subjects_dir, subject_id, refresh=False):
+    """Cached SubjectIndex, rescanned when one of its directories changed"""
+    key = os.path.abspath(join(subjects_dir, subject_id))
+    index = _cache.get(key)
+    if index is None or refresh or index.is_stale():
+        index = SubjectIndex(subjects_dir, subject_id)
+        _cache[key] = index
+    return index
+
+
+def find_fs_subjects(subjects_dir, subject_ids=None):
+    """Subject ids in subjects_dir (or out of subject_ids) that look like
+    Freesurfer output directories"""
+    if subject_ids is None:
+        subject_ids = sorted(name for name, is_dir in _list_dir(subjects_dir).items() if is_dir)
+    return [s for s in subject_ids
+            if get_subject_index(subjects_dir, s).is_fs_subject()]
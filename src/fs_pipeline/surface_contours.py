@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2023 Population Health Sciences, German Center for Neurodegenerative Diseases (DZNE)
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+White and pial surface contours of volume slices, for the QC snapshots.
+
+The surfaces are moved to the voxel grid of orig.mgz with its tkr
+vox2ras. For a slice, the triangles spanning its plane are selected with
+per-axis vertex coordinate ranges computed once, cut with the plane in one
+vectorized step (the two crossing edges of each triangle give a segment) and
+the segments are rasterized by sampling them at sub-voxel steps.
+"""
+
+import os
+from os.path import join, exists, dirname
+
+import numpy as np
+
+# contour mask values, white surface drawn over pial
+SURFACES = (('pial', 2), ('white', 1))
+HEMIS = ('lh', 'rh')
+
+
+def surface_files(path_orig):
+    """{(hemi, surface): path} of the subject of an mri/orig.mgz"""
+    surf_dir = join(dirname(dirname(os.path.abspath(path_orig))), 'surf')
+    return dict(((hemi, surf), join(surf_dir, '%s.%s' % (hemi, surf)))
+                for hemi in HEMIS for surf, _ in SURFACES)
+
+
+def plane_segments(vertices, faces, axis, value, face_range=None):
+    """(n, 2, 3) end points of the segments where the triangles cross the
+    plane vertices[:, axis] == value"""
+    if face_range is None:
+        face_range = _face_range(vertices, faces, axis)
+    crossing = faces[(face_range[0] < value) & (face_range[1] >= value)]
+    if not len(crossing):
+        return np.zeros((0, 2, 3))
+
+    corners = vertices[crossing]
+    above = corners[:, :, axis] >= value
+    start = corners
+    end = np.roll(corners, -1, axis=1)
+    cut = above != np.roll(above, -1, axis=1)
+    # exactly two of the three edges of a spanning triangle are cut
+    a = start[cut].reshape(-1, 2, 3)
+    b = end[cut].reshape(-1, 2, 3)
+    da = a[:, :, axis] - value
+    db = b[:, :, axis] - value
+    t = (da / (da - db))[:, :, np.newaxis]
+    return a + t * (b - a)
+
+
+def _face_range(vertices, faces, axis):
+    coords = vertices[faces, axis]
+    return coords.min(axis=1), coords.max(axis=1)
+
+
+def rasterize_segments(points, shape, step=0.5):
+    """Flat indices into an array of shape of the pixels along 2D segments
+    given as (n, 2, 2) end points"""
+    if not len(points):
+        return np.zeros(0, dtype=np.intp)
+    length = np.sqrt(((points[:, 1] - points[:, 0]) ** 2).sum(axis=1)).max()
+    t = np.linspace(0, 1, max(2, int(np.ceil(length / step)) + 1))
+    samples = points[:, 0, np.newaxis] + t[np.newaxis, :, np.newaxis] * \
+        (points[:, 1] - points[:, 0])[:, np.newaxis]
+    rc = np.rint(samples.reshape(-1, 2)).astype(np.intp)
+    inside = (rc[:, 0] >= 0) & (rc[:, 0] < shape[0]) & (rc[:, 1] >= 0) & (rc[:, 1] < shape[1])
+    return np.unique(np.ravel_multi_index((rc[inside, 0], rc[inside, 1]), shape))
+
+
+class SurfaceContours(object):
+    """Contour masks of the surfaces of a subject in the voxel grid of orig,
+    shifted by offset voxels (the origin of a crop)"""
+
+    def __init__(self, path_orig, offset=0):
+        import nibabel as nib
+        from nibabel.freesurfer import read_geometry
+
+        ras2vox = np.linalg.inv(nib.load(path_orig).header.get_vox2ras_tkr())
+        files = surface_files(path_orig)
+        self.surfaces = []
+        for surf, value in SURFACES:
+            for hemi in HEMIS:
+                if not exists(files[hemi, surf]):
+                    continue
+                coords, faces = read_geometry(files[hemi, surf])
+                vox = coords.dot(ras2vox[:3, :3].T) + ras2vox[:3, 3] - offset
+                self.surfaces.append((value, vox, faces.astype(np.intp), {}))
+
+    def __len__(self):
+        return len(self.surfaces)
+
+    def slice_mask(self, axis, index, shape):
+        """uint8 mask of shape (the slice without axis) of the contours in
+        slice index along axis, with the SURFACES values"""
+        mask = np.zeros(shape, dtype=np.uint8)
+        other = [a for a in range(3) if a != axis]
+        for value, vertices, faces, face_ranges in self.surfaces:
+            if axis not in face_ranges:
+                face_ranges[axis] = _face_range(vertices, faces, axis)
+            segments = plane_segments(vertices, faces, axis, index, face_ranges[axis])
+            mask.flat[rasterize_segments(segments[:, :, other], shape)] = value
+        return mask
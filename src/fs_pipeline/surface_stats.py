@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2023 Population Health Sciences, German Center for Neurodegenerative Diseases (DZNE)
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+Cortical parcellation stats (the NumVert, SurfArea, GrayVol, ThickAvg and
+ThickStd columns of mris_anatomical_stats) computed from the surf and label
+files of a subject.
+
+The surfaces, thickness and cortex label of a hemisphere are read once;
+per-vertex areas (a third of the adjacent white face areas) and gray matter
+volumes (the white-pial prism of each face split into three tetrahedra, a
+third to each corner) are summed per parcel with np.bincount for every
+annotation. The ?h.aparc.<atlas>.stats tables can be read by Parser.
+"""
+
+import os
+from collections import OrderedDict
+from os.path import join, exists
+
+import numpy as np
+from nibabel.freesurfer import read_geometry, read_morph_data, read_annot, read_label
+
+from .parse_stats import Parser
+
+COLUMNS = [('NumVert', 'Number of Vertices', 'unitless'),
+           ('SurfArea', 'Surface Area', 'mm^2'),
+           ('GrayVol', 'Gray Matter Volume', 'mm^3'),
+           ('ThickAvg', 'Average Thickness', 'mm'),
+           ('ThickStd', 'Thickness StdDev', 'mm')]
+
+SKIPPED_PARCELS = ('unknown', 'corpuscallosum', 'Medial_wall')
+
+
+def face_areas(vertices, faces):
+    a, b, c = (vertices[faces[:, i]] for i in range(3))
+    return 0.5 * np.sqrt((np.cross(b - a, c - a) ** 2).sum(axis=1))
+
+
+def face_volumes(white, pial, faces):
+    """Volume of the prism between the white and pial face, as the sum of the
+    three tetrahedra (w0 w1 w2 p0), (w1 w2 p0 p1), (w2 p0 p1 p2)"""
+    w0, w1, w2 = (white[faces[:, i]] for i in range(3))
+    p0, p1, p2 = (pial[faces[:, i]] for i in range(3))
+
+    def _tetra(a, b, c, d):
+        return np.abs((np.cross(b - a, c - a) * (d - a)).sum(axis=1)) / 6.0
+
+    return _tetra(w0, w1, w2, p0) + _tetra(w1, w2, p0, p1) + _tetra(w2, p0, p1, p2)
+
+
+def _per_vertex(face_values, faces, n_vertices):
+    """A third of each face value to each of its corners"""
+    return np.bincount(faces.ravel(), np.repeat(face_values / 3.0, 3), minlength=n_vertices)
+
+
+class HemisphereSurfaces(object):
+    """Per-vertex area, gray matter volume and thickness of one hemisphere"""
+
+    def __init__(self, subject_dir, hemi, use_cortex=True):
+        self.subject_dir = subject_dir
+        self.hemi = hemi
+        surf = join(subject_dir, 'surf')
+        white, faces = read_geometry(join(surf, hemi + '.white'))
+        pial, _ = read_geometry(join(surf, hemi + '.pial'))
+        self.n_vertices = len(white)
+        self.area = _per_vertex(face_areas(white, faces), faces, self.n_vertices)
+        self.volume = _per_vertex(face_volumes(white, pial, faces), faces, self.n_vertices)
+        self.thickness = read_morph_data(join(surf, hemi + '.thickness')).astype(np.float64)
+
+        self.cortex = np.ones(self.n_vertices, dtype=bool)
+        cortex_label = join(subject_dir, 'label', hemi + '.cortex.label')
+        if use_cortex and exists(cortex_label):
+            self.cortex[:] = False
+            self.cortex[read_label(cortex_label)] = True
+
+    def header_measures(self):
+        mask = self.cortex
+        return [('Cortex', 'NumVert', 'Number of Vertices', int(mask.sum()), 'unitless'),
+                ('Cortex', 'WhiteSurfArea', 'White Surface Total Area', self.area[mask].sum(), 'mm^2'),
+                ('Cortex', 'MeanThickness', 'Mean Thickness', self.thickness[mask].mean(), 'mm')]
+
+    def parcel_stats(self, annot_file):
+        """OrderedDict {parcel name: (NumVert, SurfArea, GrayVol, ThickAvg,
+        ThickStd)} of the parcels of an annotation with any cortex vertices"""
+        labels, _, names = read_annot(annot_file)
+        names = [n.decode() if isinstance(n, bytes) else n for n in names]
+        keep = self.cortex & (labels >= 0)
+        idx = labels[keep]
+        n = len(names)
+
+        numvert = np.bincount(idx, minlength=n)
+        area = np.bincount(idx, self.area[keep], minlength=n)
+        volume = np.bincount(idx, self.volume[keep], minlength=n)
+        thick = self.thickness[keep]
+        tsum = np.bincount(idx, thick, minlength=n)
+        tsum2 = np.bincount(idx, thick * thick, minlength=n)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            tavg = tsum / numvert
+            tstd = np.sqrt(np.maximum(tsum2 / numvert - tavg * tavg, 0))
+
+        stats = OrderedDict()
+        for i, name in enumerate(names):
+            if numvert[i] == 0 or name in SKIPPED_PARCELS:
+                continue
+            stats[name] = (int(numvert[i]), area[i], volume[i], tavg[i], tstd[i])
+        return stats
+
+
+def write_aparc_stats(fname, hemi, stats, header_measures=(), annot_file=None):
+    """Write parcel stats as a ?h.aparc*.stats table"""
+    lines = ['# Table of FreeSurfer cortical parcellation anatomical statistics ', '#',
+             '# generating_program fs_pipeline.surface_stats']
+    if annot_file:
+        lines.append('# AnnotationFile %s ' % annot_file)
+    lines.append('# hemi %s ' % hemi)
+    for structure, name, field, value, units in header_measures:
+        lines.append('# Measure %s, %s, %s, %s, %s' % (structure, name, field,
+                                                       value if isinstance(value, int) else '%f' % value,
+                                                       units))
+    columns = [('StructName', 'Structure Name', 'NA')] + COLUMNS
+    lines.append('# NTableCols %d' % len(columns))
+    for i, (name, field, units) in enumerate(columns):
+        lines.append('# TableCol %2d ColHeader %s ' % (i + 1, name))
+        lines.append('# TableCol %2d FieldName %s ' % (i + 1, field))
+        lines.append('# TableCol %2d Units     %s ' % (i + 1, units))
+    lines.append('# ColHeaders %s' % ' '.join(c[0] for c in columns))
+    for name, (numvert, area, volume, tavg, tstd) in stats.items():
+        lines.append('%-40s %5d %5.0f %5.0f %6.3f %5.3f' % (name, numvert, area, volume, tavg, tstd))
+
+    with open(fname, 'w') as fp:
+        fp.write('\n'.join(lines) + '\n')
+    return fname
+
+
+def stats_name(hemi, annot):
+    """?h.<annot>.stats like Freesurfer, ?h.aparc.<annot>.stats for atlases
+    Parser doesn't know by name"""
+    name = '%s.%s.stats' % (hemi, annot)
+    if not Parser.can_parse(name):
+        name = '%s.aparc.%s.stats' % (hemi, annot)
+    return name
+
+
+def subject_surface_stats(subjects_dir, subject_id, annots, use_cortex=True,
+                          out_dir=None, overwrite=False):
+    """Write ?h.<annot>.stats for every annotation in label/?h.<annot>.annot
+
+    out_dir defaults to the stats dir of the subject, existing tables are
+    only replaced with overwrite=True.
+
+    :return
+        written files
+    """
+    subject_dir = join(subjects_dir, subject_id)
+    out_dir = out_dir or join(subject_dir, 'stats')
+    written = []
+    for hemi in ('lh', 'rh'):
+        todo = []
+        for annot in annots:
+            annot_file = join(subject_dir, 'label', '%s.%s.annot' % (hemi, annot))
+            fname = join(out_dir, stats_name(hemi, annot))
+            if not exists(annot_file):
+                raise IOError("Annotation %s not found" % annot_file)
+            if exists(fname) and not overwrite:
+                raise IOError("%s exists, use overwrite to replace it" % fname)
+            todo.append((annot_file, fname))
+        if not todo:
+            continue
+        surfaces = HemisphereSurfaces(subject_dir, hemi, use_cortex)
+        header = surfaces.header_measures()
+        for annot_file, fname in todo:
+            tmp = fname + '.tmp'
+            write_aparc_stats(tmp, hemi, surfaces.parcel_stats(annot_file), header, annot_file)
+            os.rename(tmp, fname)
+            written.append(fname)
+    return written
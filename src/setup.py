@@ -25,7 +25,12 @@ def main(**extra_args):
           entry_points={
             'console_scripts': [
                              "run_fs_pipeline=fs_pipeline.run_fs_pipeline:main",
-                             "run_fs_qc_creator=fs_pipeline.run_fs_qc_creator:main"
+                             "run_fs_qc_creator=fs_pipeline.run_fs_qc_creator:main",
+                             "aggregate_fs_stats=fs_pipeline.run_fs_stats_aggregator:main",
+                             "compare_fs_stats=fs_pipeline.run_fs_stats_compare:main",
+                             "rank_fs_qc=fs_pipeline.run_fs_qc_ranking:main",
+                             "surface_fs_stats=fs_pipeline.run_fs_surface_stats:main",
+                             "gallery_fs_qc=fs_pipeline.run_fs_qc_gallery:main"
                               ]
                        },
           license='DZNE License',
@@ -40,7 +45,7 @@ def main(**extra_args):
           maintainer = 'RheinlandStudy MRI-IT group, DZNE',
           maintainer_email = 'mohammad.shahid@dzne.de',
           package_data = {'':['']}, 
-          install_requires=["nipype","pycrypto","psycopg2","pyxnat"],
+          install_requires=["nipype","pycrypto","psycopg2","pyxnat","Pillow"],
           **extra_args
          )
 
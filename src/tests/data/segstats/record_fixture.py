@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2023 Population Health Sciences, German Center for Neurodegenerative Diseases (DZNE)
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+Record a segstats test fixture from a Freesurfer subject: aseg.mgz and
+norm.mgz are cropped to a block around the cortex/white matter border and
+mri_segstats is run on the crop with the arguments of the pipeline's
+segstats node, giving <out_dir>/{aseg.mgz,norm.mgz,wmgm.aseg.stats}.
+
+Needs a Freesurfer install (mri_segstats on the PATH):
+
+    python record_fixture.py <subjects_dir>/<subject> <case name> [--size 40]
+"""
+
+import argparse
+import os
+import subprocess
+
+import numpy as np
+import nibabel as nb
+
+SEGMENT_IDS = ['41', '2', '42', '3', '77']
+
+
+def crop_block(aseg, size):
+    """slices of a size^3 block centred on the white matter hypointensities
+    if there are any, else on the left white matter/cortex border"""
+    for label in (77, 2):
+        found = np.argwhere(aseg == label)
+        if len(found):
+            break
+    centre = found[len(found) // 2]
+    start = [int(min(max(c - size // 2, 0), n - size)) for c, n in zip(centre, aseg.shape)]
+    return tuple(slice(s, s + size) for s in start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('subject_dir', help='Freesurfer subject directory')
+    parser.add_argument('case', help='fixture name, written next to this script')
+    parser.add_argument('--size', type=int, default=40, help='edge of the cropped block in voxels')
+    args = parser.parse_args()
+
+    out_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), args.case)
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    aseg_img = nb.load(os.path.join(args.subject_dir, 'mri', 'aseg.mgz'))
+    block = crop_block(np.asanyarray(aseg_img.dataobj), args.size)
+    for name in ('aseg.mgz', 'norm.mgz'):
+        img = nb.load(os.path.join(args.subject_dir, 'mri', name))
+        nb.save(img.slicer[block], os.path.join(out_dir, name))
+
+    subprocess.check_call(['mri_segstats', '--ctab-default', '--id'] + SEGMENT_IDS +
+                          ['--seg', 'aseg.mgz', '--pv', 'norm.mgz', '--sum', 'wmgm.aseg.stats'],
+                          cwd=out_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2023 Population Health Sciences, German Center for Neurodegenerative Diseases (DZNE)
+#
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+"""
+The in-process segstats against summaries recorded with mri_segstats.
+
+Every directory of data/segstats with aseg.mgz, norm.mgz and the
+wmgm.aseg.stats mri_segstats wrote for them (see record_fixture.py) is
+recomputed with validate_segstats and must match.
+"""
+
+import os
+
+import numpy as np
+import pytest
+
+from fs_pipeline.segstats import compute_segstats, validate_segstats
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'segstats')
+SEGMENT_IDS = [41, 2, 42, 3, 77]
+
+
+def recorded_cases():
+    return sorted(d for d in os.listdir(DATA_DIR)
+                  if os.path.exists(os.path.join(DATA_DIR, d, 'wmgm.aseg.stats')))
+
+
+@pytest.mark.parametrize('case', recorded_cases() or
+                         [pytest.param(None, marks=pytest.mark.skip(
+                             reason='no recorded mri_segstats fixtures, see data/segstats/record_fixture.py'))])
+def test_recorded_segstats(case):
+    case_dir = os.path.join(DATA_DIR, case)
+    assert validate_segstats(os.path.join(case_dir, 'wmgm.aseg.stats'),
+                             os.path.join(case_dir, 'aseg.mgz'),
+                             partial_volume_file=os.path.join(case_dir, 'norm.mgz')) == []
+
+
+def test_counts_without_partial_volume():
+    seg = np.zeros((24, 24, 24), dtype=np.int32)
+    seg[4:20, 4:12] = 2
+    seg[4:20, 12:20] = 41
+    seg[4:20, 4:12, 4:8] = 3
+    seg[4:20, 12:20, 4:8] = 42
+    seg[10:13, 6:9, 10:13] = 77
+    rows = compute_segstats(seg, SEGMENT_IDS, np.float32(0.99))
+    for row in rows:
+        count = int((seg == row['SegId']).sum())
+        assert row['NVoxels'] == count
+        assert abs(row['Volume_mm3'] - count * 0.99) < 1e-3